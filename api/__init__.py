@@ -1,20 +1,171 @@
+import os
+
 from flask import Flask
 from flask_jwt_extended import JWTManager
 from datetime import datetime, UTC
 
-from api.core.database import init_database
-from api.core.errors import register_error_handlers
-
 def create_app(test_config=None):
     """Create and configure the app"""
     app = Flask(__name__)
     
     # Load default configuration
     app.config.from_mapping(
+        DATABASE_BACKEND='mongodb',  # 'mongodb' or 'memory' (in-process)
         MONGO_URI='mongodb://localhost:27017/',
         MONGO_DB_NAME='cloud_storage',
+        # Return projected reads (entry and index listings) as raw BSON,
+        # decoded field by field as they are read
+        MONGO_RAW_READS=True,
+        # Partition name -> URI of each deployment holding users' data, by
+        # consistent hashing of user IDs; MONGO_URI then only holds users and
+        # jobs. Empty keeps everything in MONGO_URI.
+        DATABASE_PARTITIONS={},
+        # 'background' creates indexes off the startup path; requests other
+        # than health checks get 503 until it finishes. 'sync' blocks startup.
+        DATABASE_BOOTSTRAP='background',
         SECRET_KEY='dev',
-        JWT_SECRET_KEY='dev'
+        JWT_SECRET_KEY='dev',
+        # Token buckets per user and route class: (burst, refill per second).
+        # Uploads are charged by request size in bytes.
+        RATELIMIT_ENABLED=True,
+        RATELIMIT_STORAGE='shared',  # 'shared' across forked workers or 'memory'
+        RATELIMIT_SLOTS=65536,
+        RATELIMIT_LIMITS={
+            'read': (120, 20.0),
+            'write': (60, 10.0),
+            'upload': (64 * 1024 * 1024, 4 * 1024 * 1024),
+            'search': (30, 2.0)
+        },
+        RATELIMIT_EXEMPT={'metrics', 'health_live', 'health_ready'},
+        METRICS_ENABLED=True,
+        # Commands slower than this are logged with their query shape (None disables).
+        # A sample is re-run as explain('executionStats'). Records go to a capped
+        # collection unless SLOW_QUERY_LOG_FILE names a rotating log file.
+        SLOW_QUERY_THRESHOLD_MS=100,
+        SLOW_QUERY_EXPLAIN_SAMPLE_RATE=0.1,
+        SLOW_QUERY_LOG_FILE=None,
+        SLOW_QUERY_LOG_MAX_BYTES=10 * 1024 * 1024,
+        SLOW_QUERY_LOG_BACKUPS=5,
+        SLOW_QUERY_COLLECTION_SIZE=16 * 1024 * 1024,
+        # Opt-in request profiling. Requests are profiled when they carry an
+        # X-Profile token from POST /admin/profile-token (signed with
+        # PROFILER_SECRET) or are sampled at PROFILER_SAMPLE_RATE, at most
+        # PROFILER_MAX_PER_MINUTE per process.
+        PROFILER_ENABLED=False,
+        PROFILER_SAMPLE_RATE=0.0,
+        PROFILER_MAX_PER_MINUTE=10,
+        PROFILER_DIR='profiles',
+        PROFILER_MAX_FILES=500,
+        PROFILER_SECRET=None,
+        # Index archive imports: threads writing files, entries per
+        # insert_many, and file bytes read ahead of the writers
+        IMPORT_WORKERS=4,
+        IMPORT_BATCH_SIZE=500,
+        IMPORT_MAX_PENDING_BYTES=64 * 1024 * 1024,
+        # Multi-file uploads: threads storing the parts of one request, and
+        # the most parts accepted per request
+        UPLOAD_WORKERS=4,
+        UPLOAD_MAX_FILES=500,
+        # Read preference per operation class ('read', 'search', 'download'),
+        # e.g. {'search': 'secondaryPreferred'}; unlisted classes and writes use
+        # the primary. Max staleness is in seconds (at least 90, None for no
+        # limit). A caller reads from the primary for READ_PRIMARY_PIN_SECONDS
+        # after each successful write, to see its own writes.
+        READ_PREFERENCES={},
+        READ_MAX_STALENESS_SECONDS=None,
+        READ_PRIMARY_PIN_SECONDS=5,
+        READ_PRIMARY_PIN_SLOTS=65536,
+        # Write coalescing: endpoint -> longest delay in seconds an insert waits
+        # to be batched with concurrent ones (routes not listed insert at once),
+        # the most documents per insert_many, and its write concern (e.g.
+        # {'w': 1, 'j': False}; None for the client's)
+        WRITE_COALESCING={},
+        WRITE_COALESCING_MAX_BATCH=500,
+        WRITE_COALESCING_WRITE_CONCERN=None,
+        # Resumable uploads: default and largest chunk (each chunk is stored
+        # as one GridFS chunk), largest file, seconds an idle session lives,
+        # and how often a process sweeps expired sessions
+        UPLOAD_CHUNK_SIZE=4 * 1024 * 1024,
+        UPLOAD_MAX_CHUNK_SIZE=8 * 1024 * 1024,
+        UPLOAD_MAX_SIZE=10 * 1024 * 1024 * 1024,
+        UPLOAD_SESSION_TTL=24 * 3600,
+        UPLOAD_SWEEP_INTERVAL=300,
+        # Background jobs: worker threads started in each web process (0 to
+        # leave jobs to `flask admin jobs-worker`), seconds a claimed job is
+        # leased for, seconds between polls of an empty queue, and the first
+        # and longest retry delays
+        JOBS_WORKERS=1,
+        JOBS_LEASE_SECONDS=60,
+        JOBS_POLL_INTERVAL=1.0,
+        JOBS_BACKOFF_BASE=5,
+        JOBS_BACKOFF_MAX=3600,
+        # Keywords extracted from text entries and text files by background
+        # jobs: keywords added per entry, terms per entry counted in the
+        # index statistics, and bytes of text (or of a PDF) read per entry
+        KEYWORDS_ENABLED=True,
+        KEYWORD_LIMIT=10,
+        KEYWORD_MAX_TERMS=200,
+        KEYWORD_MAX_TEXT_BYTES=1024 * 1024,
+        KEYWORD_MAX_PDF_BYTES=20 * 1024 * 1024,
+        # Downscaled copies of uploaded images, by name and longest side in
+        # pixels, generated by background jobs (requires Pillow); whoever
+        # generates them holds the entry for at most RENDITION_LEASE_SECONDS
+        RENDITIONS_ENABLED=True,
+        RENDITION_SIZES={'thumb': 128, 'small': 320, 'medium': 800},
+        RENDITION_QUALITY=85,
+        RENDITION_LEASE_SECONDS=30,
+        # Storage quota per user: file bytes, files and entries (None for no limit)
+        QUOTA_BYTES=None,
+        QUOTA_FILES=None,
+        QUOTA_ENTRIES=None,
+        # List totals: most documents counted for X-Total-Count before it is
+        # reported as a lower bound, and filtered counts cached per process
+        COUNT_LIMIT=10000,
+        COUNT_CACHE_SIZE=1024,
+        # Per-process caches of entries and index owners: values kept per cache
+        # and seconds each is kept at most. Writers publish invalidations to a
+        # capped collection of INVALIDATION_LOG_SIZE bytes, which a thread in
+        # each process follows with a change stream ('auto', on replica sets)
+        # or polls every INVALIDATION_POLL_INTERVAL seconds ('poll', and the
+        # fallback of 'auto'); None runs no listener and relies on CACHE_TTL.
+        CACHE_SIZE=10000,
+        CACHE_TTL=30,
+        INVALIDATION_MODE='auto',
+        INVALIDATION_POLL_INTERVAL=1.0,
+        INVALIDATION_LOG_SIZE=16 * 1024 * 1024,
+        # Live entry feeds (Server-Sent Events): entry events are logged to a
+        # capped collection of ENTRY_FEED_LOG_SIZE bytes, followed like the
+        # invalidations ('auto', 'poll' or None). Each open stream holds a
+        # worker thread, so SSE_MAX_STREAMS per process defaults to two
+        # fewer than GUNICORN_THREADS, leaving threads for other requests.
+        # Streams queue at most SSE_QUEUE_SIZE events, send a heartbeat
+        # every SSE_HEARTBEAT_SECONDS, close after SSE_MAX_SECONDS and
+        # replay at most SSE_REPLAY_LIMIT missed events on reconnection.
+        ENTRY_FEED_MODE='auto',
+        ENTRY_FEED_POLL_INTERVAL=0.5,
+        ENTRY_FEED_LOG_SIZE=64 * 1024 * 1024,
+        SSE_MAX_STREAMS=max(1, int(os.environ.get('GUNICORN_THREADS', 4)) - 2),
+        SSE_QUEUE_SIZE=256,
+        SSE_HEARTBEAT_SECONDS=15,
+        SSE_MAX_SECONDS=300,
+        SSE_REPLAY_LIMIT=1000,
+        # Garbage collection of entries of deleted indexes and of GridFS files
+        # no entry refers to: seconds a file or entry is left alone after it
+        # was written, documents per batch, and bytes deleted per second
+        # (None for no limit)
+        GC_GRACE_SECONDS=3600,
+        GC_BATCH_SIZE=500,
+        GC_IO_BUDGET=8 * 1024 * 1024,
+        # Consistency checks (flask admin fsck): documents per batch,
+        # documents checked per second and per process (None for no limit),
+        # processes the command splits the scan over by _id range (jobs use
+        # one), and IDs reported per kind of problem
+        FSCK_BATCH_SIZE=500,
+        FSCK_RATE=2000,
+        FSCK_PROCESSES=1,
+        FSCK_EXAMPLES=10,
+        # Usernames allowed to use the /admin endpoints
+        ADMIN_USERNAMES=set()
     )
     
     # Override with test config if passed
@@ -41,11 +192,66 @@ def create_app(test_config=None):
         }
     
     # Initialize database
+    from api.core.database import init_database
     init_database(app)
     
     # Register error handlers
+    from api.core.errors import register_error_handlers
     register_error_handlers(app)
     
+    # Register request metrics, ahead of hooks that may reject requests
+    if app.config.get('METRICS_ENABLED'):
+        from api.core.metrics import init_metrics
+        init_metrics(app)
+    
+    # Register health probes and hold back requests until the database is ready
+    from api.core.health import init_health
+    init_health(app)
+    
+    # Register rate limiting
+    if app.config.get('RATELIMIT_ENABLED'):
+        from api.core.ratelimit import init_rate_limiting
+        init_rate_limiting(app)
+    
+    # Register the tenant of each request, which picks its database partition
+    from api.core.tenants import init_tenants
+    init_tenants(app)
+    
+    # Register read routing to replica set secondaries
+    from api.core.read_preferences import init_read_preferences
+    init_read_preferences(app)
+    
+    # Register the request profiler
+    if app.config.get('PROFILER_ENABLED'):
+        from api.core.profiler import init_profiler
+        init_profiler(app)
+    
+    # Register the background job worker
+    from api.core.jobs import init_jobs
+    init_jobs(app)
+    
+    # Register the image rendition generator
+    if app.config.get('RENDITIONS_ENABLED'):
+        from api.core.renditions import init_renditions
+        init_renditions(app)
+    
+    # Register the cache of list totals
+    from api.core.pagination import init_pagination
+    init_pagination(app)
+    
+    # Register the write coalescers of routes that batch their inserts
+    if app.config['WRITE_COALESCING']:
+        from api.core.coalescer import init_coalescing
+        init_coalescing(app)
+    
+    # Register the per-process caches and their invalidation listener
+    from api.core.invalidation import init_invalidation
+    init_invalidation(app)
+    
+    # Register the live entry feed
+    from api.core.feed import init_feed
+    init_feed(app)
+    
     # Only register blueprints if not testing or explicitly requested
     if not app.config.get('TESTING') or test_config and test_config.get('REGISTER_BLUEPRINTS', True):
         # Register blueprints
@@ -54,5 +260,8 @@ def create_app(test_config=None):
         
         from api.indexes import bp as indexes_bp
         app.register_blueprint(indexes_bp, url_prefix='/api/indexes')
+        
+        from api.admin import bp as admin_bp
+        app.register_blueprint(admin_bp, url_prefix='/admin')
     
     return app
\ No newline at end of file
@@ -0,0 +1,193 @@
+import signal
+
+import click
+from flask import jsonify, request, current_app
+
+from api.admin import bp
+from api.core.auth import admin_required
+from api.core.database import each_partition, tenant_context
+from api.core.errors import ValidationError
+from api.core.fsck import PROBLEMS, check_consistency, problems_found, schedule_consistency_check
+from api.core.garbage import collect_garbage, schedule_garbage_collection
+from api.core.jobs import JobWorker, job_counts, retry_failed
+from api.core.models import User
+from api.core.quota import reconcile_usage, schedule_reconcile
+from api.core.profiler import sign_profile_token
+from api.core.tenants import move_tenant
+
+@bp.route('/slow-queries', methods=['GET'])
+@admin_required
+def get_slow_queries():
+    """List the slowest query shapes by total time"""
+    slow_query_log = current_app.extensions.get('slow_query_log')
+    if slow_query_log is None:
+        return jsonify({'enabled': False, 'shapes': []})
+    
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify({
+        'enabled': True,
+        'threshold_ms': current_app.config['SLOW_QUERY_THRESHOLD_MS'],
+        'dropped': slow_query_log.dropped,
+        'shapes': slow_query_log.top_shapes(limit=limit)
+    })
+
+
+@bp.route('/profile-token', methods=['POST'])
+@admin_required
+def create_profile_token():
+    """Issue a signed token for the X-Profile header"""
+    profiler = current_app.extensions.get('profiler')
+    if profiler is None or not profiler.secret:
+        raise ValidationError('Profiling is not enabled')
+    
+    ttl = min(request.args.get('ttl', 300, type=int), 3600)
+    return jsonify({
+        'header': 'X-Profile',
+        'token': sign_profile_token(profiler.secret, ttl),
+        'expires_in': ttl
+    })
+
+@bp.route('/profiles', methods=['GET'])
+@admin_required
+def get_profiles():
+    """List the most recent request profiles"""
+    profiler = current_app.extensions.get('profiler')
+    if profiler is None:
+        return jsonify({'enabled': False, 'profiles': []})
+    
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({
+        'enabled': True,
+        'directory': profiler.directory,
+        'profiles': profiler.list_profiles(limit=limit)
+    })
+
+@bp.route('/jobs', methods=['GET'])
+@admin_required
+def get_jobs():
+    """Count background jobs by kind and status"""
+    return jsonify({'jobs': job_counts()})
+
+@bp.route('/jobs/retry', methods=['POST'])
+@admin_required
+def retry_jobs():
+    """Queue failed jobs again"""
+    return jsonify({'retried': retry_failed(request.args.get('kind'))})
+
+@bp.cli.command('jobs-worker')
+@click.option('--threads', type=int, default=1, help='Jobs run concurrently')
+@click.option('--kind', 'kinds', multiple=True, help='Only run jobs of this kind (repeatable)')
+@click.option('--burst', is_flag=True, help='Exit once no jobs are due')
+def jobs_worker_command(threads, kinds, burst):
+    """Run background jobs until stopped"""
+    worker = JobWorker.from_config(current_app._get_current_object(), threads=threads,
+                                   kinds=list(kinds) or None)
+    if burst:
+        click.echo(f'Ran {worker.drain(limit=float("inf"))} jobs')
+        return
+    
+    # Finish the jobs in hand on SIGTERM, as on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    worker.start()
+    click.echo(f'Running jobs on {threads} threads', err=True)
+    try:
+        while not worker.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    worker.stop()
+
+@bp.cli.command('jobs-retry')
+@click.option('--kind', help='Only retry jobs of this kind')
+def jobs_retry_command(kind):
+    """Queue failed jobs again"""
+    click.echo(f'Queued {retry_failed(kind)} failed jobs')
+
+@bp.cli.command('reconcile-usage')
+@click.option('--user', 'username', help='Only this user (default: every user)')
+@click.option('--now', is_flag=True, help='Reconcile here instead of queueing jobs')
+def reconcile_usage_command(username, now):
+    """Repair users' storage usage counters"""
+    user_id = None
+    if username:
+        user = User.find_by_username(username)
+        if not user:
+            raise click.ClickException('User not found')
+        user_id = user['_id']
+    if not now:
+        click.echo(f'Queued {schedule_reconcile(user_id)} reconciliation jobs')
+        return
+    users = [user] if user_id else User.get_collection().find_many({})
+    for user in users:
+        with tenant_context(user['_id']):
+            usage = reconcile_usage(user['_id'])
+        click.echo(f"{user['username']}: {usage['entries']} entries, {usage['files']} files, "
+                   f"{usage['bytes']} bytes")
+
+
+@bp.cli.command('move-tenant')
+@click.argument('username')
+@click.argument('partition')
+@click.option('--batch-size', type=int, default=500, help='Documents copied per batch')
+@click.option('--settle', type=float, default=2.0,
+              help='Seconds to let in-flight requests finish before copying the last changes '
+                   'and before deleting the old copy')
+def move_tenant_command(username, partition, batch_size, settle):
+    """Move a user's data to another database partition"""
+    user = User.find_by_username(username)
+    if not user:
+        raise click.ClickException('User not found')
+    try:
+        counts = move_tenant(user['_id'], partition, batch_size=batch_size,
+                             settle_seconds=settle, log=click.echo)
+    except ValidationError as e:
+        raise click.ClickException(str(e))
+    if not counts:
+        click.echo(f'{username} is already in {partition}')
+        return
+    click.echo(', '.join(f'{count} {name}' for name, count in counts.items()))
+
+@bp.cli.command('collect-garbage')
+@click.option('--now', is_flag=True, help='Collect here instead of queueing jobs')
+@click.option('--grace', type=float, help='Seconds a file or entry is left alone after it was written')
+@click.option('--batch-size', type=int, help='Files or entries looked at per batch')
+@click.option('--io-budget', type=float, help='Bytes deleted per second (0 for no limit)')
+@click.option('--dry-run', is_flag=True, help='Report what would be deleted')
+def collect_garbage_command(now, grace, batch_size, io_budget, dry_run):
+    """Delete entries of deleted indexes and GridFS files no entry refers to"""
+    if not now and not dry_run:
+        click.echo(f'Queued {schedule_garbage_collection()} garbage collection jobs')
+        return
+    for partition in each_partition():
+        counts = collect_garbage(current_app.config, grace_seconds=grace, batch_size=batch_size,
+                                 io_budget=io_budget, dry_run=dry_run)
+        verb = 'Would delete' if dry_run else 'Deleted'
+        click.echo(f"{partition or 'database'}: {verb} {counts['dangling_entries']} of "
+                   f"{counts['entries_scanned']} entries and {counts['orphan_files']} of "
+                   f"{counts['files_scanned']} files, {counts['bytes_reclaimed']} bytes reclaimed")
+
+@bp.cli.command('fsck')
+@click.option('--repair', is_flag=True, help='Repair the problems found')
+@click.option('--queue', is_flag=True, help='Queue a job per partition instead of checking here')
+@click.option('--processes', type=int, help='Processes splitting the scan by _id range')
+@click.option('--rate', type=float, help='Documents checked per second and per process (0 for no limit)')
+@click.option('--batch-size', type=int, help='Documents looked at per batch')
+@click.option('--examples', type=int, help='IDs listed per kind of problem')
+def fsck_command(repair, queue, processes, rate, batch_size, examples):
+    """Check entries, indexes and GridFS files for inconsistencies"""
+    if queue:
+        click.echo(f'Queued {schedule_consistency_check(repair)} consistency check jobs')
+        return
+    unrepaired = 0
+    for partition in each_partition():
+        report = check_consistency(current_app.config, repair=repair, processes=processes, rate=rate,
+                                   batch_size=batch_size, examples=examples, partition=partition)
+        click.echo(f"{partition or 'database'}: checked {report['files_scanned']} files and "
+                   f"{report['entries_scanned']} entries, repaired {report['repaired']}")
+        for problem in PROBLEMS:
+            if report[problem]:
+                click.echo(f"  {report[problem]} {problem.replace('_', ' ')}: {', '.join(report['examples'][problem])}")
+        unrepaired += problems_found(report) - report['repaired']
+    if unrepaired > 0:
+        # Lets cron and monitoring tell a clean run from one needing attention
+        raise SystemExit(1)
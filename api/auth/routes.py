@@ -8,6 +8,7 @@ from api.auth import bp
 from api.core.database import get_db
 from api.core.errors import ValidationError, AuthenticationError
 from api.core.models import User
+from api.core.quota import quota_limits, user_usage
 
 @bp.route('/register', methods=['POST'])
 def register():
@@ -96,5 +97,7 @@ def get_current_user():
     
     return jsonify({
         'id': str(user['_id']),
-        'username': user['username']
+        'username': user['username'],
+        'usage': user_usage(user),
+        'quota': quota_limits(current_app.config)
     })
\ No newline at end of file
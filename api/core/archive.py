@@ -0,0 +1,447 @@
+"""Index archives: the format written by index export and read by import.
+
+An archive is a tar or zip file containing, in order:
+
+    index.json                  index name and description, export options
+    manifest/00000.ndjson       a batch of entries, one JSON object per line
+    files/<file_id>             the contents of each file entry in that batch
+    manifest/00001.ndjson       ...
+    summary.json                entry and file counts, written last
+
+Entries are exported in _id order. A batch's files follow its manifest, so
+an interrupted export can be resumed after the last entry whose file was
+received in full.
+"""
+import json
+import logging
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, UTC
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from .database import BulkInsertError, get_file_storage
+from .feed import publish_entries
+from .index_stats import record_entries
+from .keywords import schedule_keywords
+from .models import Entry, Index
+from .quota import Reservation
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_VERSION = 1
+ENTRY_TYPES = ('text', 'file')
+FORMATS = {
+    'tar': ('application/x-tar', 'tar'),
+    'zip': ('application/zip', 'zip')
+}
+
+class ArchiveError(Exception):
+    """Raised when an archive cannot be imported"""
+    pass
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def dump_json(value: Any) -> str:
+    """Serialize a document, writing IDs as strings and dates as ISO 8601"""
+    return json.dumps(value, default=_json_default, separators=(',', ':'))
+
+def entry_record(entry: Dict) -> Dict[str, Any]:
+    """Manifest record of an entry"""
+    return {
+        'id': entry['_id'],
+        'type': entry['type'],
+        'content': entry.get('content'),
+        'file_id': entry.get('file_id'),
+        'metadata': entry.get('metadata'),
+        'keywords': entry.get('keywords', []),
+        'created_at': entry['created_at']
+    }
+
+def read_chunks(stream: BinaryIO, size: int, chunk_size: int) -> Iterator[bytes]:
+    """Read exactly size bytes from a stream in chunks"""
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(min(chunk_size, remaining))
+        if not chunk:
+            raise IOError(f'Stream ended {remaining} bytes early')
+        remaining -= len(chunk)
+        yield chunk
+
+class _Sink:
+    """Write target collecting archive output until it is drained"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class TarWriter:
+    """Streams a tar archive, writing headers directly so file contents are never buffered"""
+
+    def __init__(self):
+        self._offset = 0
+
+    def _emit(self, data: bytes) -> bytes:
+        self._offset += len(data)
+        return data
+
+    def _header(self, name: str, size: int) -> bytes:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        return self._emit(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def _padding(self, size: int) -> Iterator[bytes]:
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            yield self._emit(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def add_bytes(self, name: str, data: bytes) -> Iterator[bytes]:
+        yield self._header(name, len(data))
+        yield self._emit(data)
+        yield from self._padding(len(data))
+
+    def add_stream(self, name: str, stream: BinaryIO, size: int, chunk_size: int) -> Iterator[bytes]:
+        yield self._header(name, size)
+        for chunk in read_chunks(stream, size, chunk_size):
+            yield self._emit(chunk)
+        yield from self._padding(size)
+
+    def close(self) -> Iterator[bytes]:
+        # Two empty blocks, padded to a whole record
+        end = self._offset + 2 * tarfile.BLOCKSIZE
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-end) % tarfile.RECORDSIZE)
+
+class ZipWriter:
+    """Streams a zip archive to a non-seekable sink.
+
+    Manifests are deflated and files stored as-is. The central directory
+    holds one small record per member until the archive is closed.
+    """
+
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def _drain(self) -> Iterator[bytes]:
+        data = self._sink.drain()
+        if data:
+            yield data
+
+    def add_bytes(self, name: str, data: bytes) -> Iterator[bytes]:
+        self._zip.writestr(name, data)
+        yield from self._drain()
+
+    def add_stream(self, name: str, stream: BinaryIO, size: int, chunk_size: int) -> Iterator[bytes]:
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = size
+        with self._zip.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+            for chunk in read_chunks(stream, size, chunk_size):
+                member.write(chunk)
+                yield from self._drain()
+        yield from self._drain()
+
+    def close(self) -> Iterator[bytes]:
+        self._zip.close()
+        yield from self._drain()
+
+WRITERS = {
+    'tar': TarWriter,
+    'zip': ZipWriter
+}
+
+def export_index(index: Dict, archive_format: str = 'tar', after: Optional[ObjectId] = None,
+                 batch_size: int = 500, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    """Stream an index as an archive.
+
+    Entries are read in keyset pages of batch_size and files are copied
+    from storage chunk_size bytes at a time, so memory use does not grow
+    with the size of the index. No cursor is held open between pages.
+    """
+    writer = WRITERS[archive_format]()
+    storage = get_file_storage()
+
+    yield from writer.add_bytes('index.json', dump_json({
+        'version': ARCHIVE_VERSION,
+        'name': index['name'],
+        'description': index.get('description', ''),
+        'created_at': index.get('created_at'),
+        'exported_at': datetime.now(UTC),
+        'after': after
+    }).encode())
+
+    entries = files = 0
+    last_entry_id = after
+    missing_files = []
+    part = 0
+    while True:
+        batch = Entry.find_after(index['_id'], after=last_entry_id, limit=batch_size)
+        if not batch:
+            break
+        manifest = ''.join(dump_json(entry_record(entry)) + '\n' for entry in batch)
+        yield from writer.add_bytes(f'manifest/{part:05d}.ndjson', manifest.encode())
+        part += 1
+
+        for entry in batch:
+            if entry.get('file_id'):
+                try:
+                    stream, size, _, _ = storage.open_file(str(entry['file_id']))
+                except FileNotFoundError:
+                    missing_files.append(str(entry['file_id']))
+                    continue
+                try:
+                    yield from writer.add_stream(f"files/{entry['file_id']}", stream, size, chunk_size)
+                finally:
+                    stream.close()
+                files += 1
+        entries += len(batch)
+        last_entry_id = batch[-1]['_id']
+
+    yield from writer.add_bytes('summary.json', dump_json({
+        'entries': entries,
+        'files': files,
+        'missing_files': missing_files,
+        'last_entry_id': last_entry_id
+    }).encode())
+    yield from writer.close()
+
+def iter_archive(fileobj: BinaryIO, archive_format: str = 'tar') -> Iterator[tuple[str, int, BinaryIO]]:
+    """Members of an archive as (name, size, stream), in archive order.
+    
+    Tar archives are read as a stream. Zip archives need a seekable file.
+    """
+    if archive_format == 'zip':
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as stream:
+                        yield info.filename, info.file_size, stream
+    else:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, member.size, archive.extractfile(member)
+
+class ArchiveImporter:
+    """Imports an index archive, creating the index unless one is given.
+    
+    Files are written to storage by a thread pool while the archive is
+    read. At most max_pending_bytes of file data wait to be written, so a
+    slow store slows down reading instead of growing memory. The entries of
+    a manifest batch are inserted with unordered insert_many calls once
+    their files are stored. A failing entry is reported and skipped.
+    
+    With a reservation, the files and entries of each manifest batch are
+    reserved against the user's quota before any of them is stored, and a
+    batch that does not fit stops the import with QuotaExceededError.
+    """
+    
+    def __init__(self, user_id: ObjectId, index_id: Optional[ObjectId] = None,
+                 name: Optional[str] = None, workers: int = 4, batch_size: int = 500,
+                 max_pending_bytes: int = 64 * 1024 * 1024, max_errors: int = 100,
+                 reservation: Optional[Reservation] = None):
+        self.user_id = user_id
+        self.reservation = reservation
+        self.index_id = index_id
+        self.name = name
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_pending_bytes = max_pending_bytes
+        self.max_errors = max_errors
+        self.created_index = False
+        self.result: Dict[str, Any] = {'entries': 0, 'files': 0, 'bytes': 0, 'failed': 0, 'errors': []}
+        self._storage = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Manifest records of the current batch, and those with files by archive file ID
+        self._records: List[Dict] = []
+        self._file_records: Dict[str, Dict] = {}
+        self._stored: Dict[str, Future] = {}
+        self._pending_bytes = 0
+        self._capacity = threading.Condition()
+    
+    @classmethod
+    def from_config(cls, config, user_id: ObjectId, **kwargs) -> 'ArchiveImporter':
+        kwargs.setdefault('workers', config.get('IMPORT_WORKERS', 4))
+        kwargs.setdefault('batch_size', config.get('IMPORT_BATCH_SIZE', 500))
+        kwargs.setdefault('max_pending_bytes', config.get('IMPORT_MAX_PENDING_BYTES', 64 * 1024 * 1024))
+        return cls(user_id, **kwargs)
+    
+    def run(self, fileobj: BinaryIO, archive_format: str = 'tar') -> Dict[str, Any]:
+        """Import an archive and return counts and per-entry errors"""
+        started = time.perf_counter()
+        self._storage = get_file_storage()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='import')
+        try:
+            for name, size, stream in iter_archive(fileobj, archive_format):
+                if name == 'index.json':
+                    self._open_index(json.load(stream))
+                elif name.startswith('manifest/'):
+                    self._flush()
+                    self._read_manifest(stream)
+                elif name.startswith('files/'):
+                    self._store_file(name[len('files/'):], size, stream)
+            self._flush()
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError, ValueError) as e:
+            raise ArchiveError(f'Invalid archive: {e}')
+        finally:
+            self._executor.shutdown(wait=True)
+            # Files stored for entries that were never inserted
+            for future in self._stored.values():
+                self._discard_file(future)
+        
+        self.result['index_id'] = str(self.index_id) if self.index_id else None
+        self.result['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        return self.result
+    
+    def _open_index(self, meta: Dict) -> None:
+        if meta.get('version', 0) > ARCHIVE_VERSION:
+            raise ArchiveError(f"Unsupported archive version {meta.get('version')}")
+        if self.index_id is not None:
+            return
+        name = (self.name or meta.get('name') or '').strip()
+        if not name:
+            raise ArchiveError('Index name is required')
+        if Index.get_collection().find_one({'user_id': self.user_id, 'name': name}):
+            raise ArchiveError('Index with this name already exists')
+        index = Index.create(user_id=self.user_id, name=name, description=meta.get('description', ''))
+        self.index_id = index['_id']
+        self.created_index = True
+    
+    def _read_manifest(self, stream: BinaryIO) -> None:
+        if self.index_id is None:
+            raise ArchiveError('Archive must start with index.json')
+        for line in stream:
+            if line.strip():
+                record = json.loads(line)
+                self._records.append(record)
+                if record.get('file_id'):
+                    self._file_records[record['file_id']] = record
+        if self.reservation is not None:
+            reserved = self.reservation.amounts
+            self.reservation.settle(bytes=reserved['bytes'], files=reserved['files'] + len(self._file_records),
+                                    entries=reserved['entries'] + len(self._records))
+    
+    def _store_file(self, archive_file_id: str, size: int, stream: BinaryIO) -> None:
+        record = self._file_records.pop(archive_file_id, None)
+        if record is None:
+            return  # Not referenced by the current batch
+        
+        # Wait for room unless nothing else is pending, so large files still go through
+        with self._capacity:
+            while self._pending_bytes and self._pending_bytes + size > self.max_pending_bytes:
+                self._capacity.wait()
+            self._pending_bytes += size
+        data = stream.read()
+        metadata = record['metadata'] = dict(record.get('metadata') or {}, size=len(data))
+        self._stored[archive_file_id] = self._executor.submit(
+            self._write_file, data,
+            metadata.get('filename') or archive_file_id,
+            metadata.get('content_type') or 'application/octet-stream'
+        )
+    
+    def _write_file(self, data: bytes, filename: str, content_type: str) -> str:
+        try:
+            return self._storage.store_file(data, filename=filename, content_type=content_type)
+        finally:
+            with self._capacity:
+                self._pending_bytes -= len(data)
+                self._capacity.notify_all()
+    
+    def _discard_file(self, future: Future) -> None:
+        if future.exception() is not None:
+            return  # Never stored
+        try:
+            self._storage.delete_file(future.result())
+        except Exception:
+            logger.exception('Failed to delete an imported file')
+    
+    def _error(self, record: Dict, message: str) -> None:
+        self.result['failed'] += 1
+        if len(self.result['errors']) < self.max_errors:
+            self.result['errors'].append({'id': record.get('id'), 'error': message})
+    
+    def _build_entry(self, record: Dict) -> tuple[Dict, Optional[str]]:
+        """Entry document for a manifest record and the ID of its stored file"""
+        if record.get('type') not in ENTRY_TYPES:
+            raise ValueError(f"Unknown entry type {record.get('type')!r}")
+        created_at = datetime.fromisoformat(record['created_at'])
+        file_id = None
+        if record['type'] == 'file':
+            future = self._stored.pop(record.get('file_id'), None)
+            if future is None:
+                raise ValueError('File missing from archive')
+            file_id = future.result()
+        entry = Entry(
+            index_id=self.index_id,
+            user_id=self.user_id,
+            type=record['type'],
+            content=record.get('content'),
+            file_id=ObjectId(file_id) if file_id else None,
+            metadata=record.get('metadata'),
+            keywords=record.get('keywords')
+        ).to_dict()
+        entry['_id'] = ObjectId()
+        entry['created_at'] = created_at
+        return entry, file_id
+    
+    def _flush(self) -> None:
+        """Insert the entries of the current batch"""
+        records, self._records = self._records, []
+        self._file_records = {}
+        
+        built = []
+        for record in records:
+            try:
+                built.append((record, *self._build_entry(record)))
+            except Exception as e:
+                self._error(record, str(e))
+        # Files of the batch that no entry claimed
+        for future in self._stored.values():
+            self._discard_file(future)
+        self._stored = {}
+        
+        for start in range(0, len(built), self.batch_size):
+            chunk = built[start:start + self.batch_size]
+            try:
+                Entry.get_collection().insert_many([entry for _, entry, _ in chunk], ordered=False)
+                failed = {}
+            except BulkInsertError as e:
+                failed = dict(e.errors)
+            created = [entry for position, (_, entry, _) in enumerate(chunk) if position not in failed]
+            record_entries(self.index_id, created)
+            publish_entries('created', created)
+            for entry in created:
+                schedule_keywords(current_app, entry)
+            for position, (record, entry, file_id) in enumerate(chunk):
+                if position in failed:
+                    self._error(record, failed[position])
+                    if file_id:
+                        self._storage.delete_file(file_id)
+                    continue
+                self.result['entries'] += 1
+                if file_id:
+                    self.result['files'] += 1
+                    self.result['bytes'] += entry['metadata']['size']
@@ -0,0 +1,26 @@
+from functools import wraps
+
+from bson.objectid import ObjectId
+from flask import current_app
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+from .errors import PermissionDeniedError
+from .models import User
+
+def is_admin(user_id: str) -> bool:
+    """Check whether a user is listed in ADMIN_USERNAMES"""
+    admins = current_app.config.get('ADMIN_USERNAMES') or ()
+    if not admins:
+        return False
+    user = User.get_collection().find_one({'_id': ObjectId(user_id)})
+    return bool(user) and user['username'] in admins
+
+def admin_required(fn):
+    """Require a valid access token belonging to an admin user"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_jwt_in_request()
+        if not is_admin(get_jwt_identity()):
+            raise PermissionDeniedError('Admin access required')
+        return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,158 @@
+"""Capped collections of events that every process follows.
+
+A process appends events to the log, and a listener thread in each
+process hands it every event as it arrives: from a change stream where
+the deployment offers one (replica sets), otherwise by polling the log
+every poll_interval seconds. Logs live in the directory database when
+it is partitioned, so one listener sees the events of every partition.
+"""
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, UTC
+from typing import Dict, List, Optional
+
+from bson.objectid import ObjectId
+
+from .database import CollectionInterface, PartitionedDatabase, get_database
+
+logger = logging.getLogger(__name__)
+
+class CappedLog:
+    """A capped collection of events and the thread following it in this process"""
+
+    # Events are re-read this far back on each poll, as their IDs come from
+    # the publishers' clocks and a slow insert may land behind newer ones
+    POLL_LOOKBACK_SECONDS = 5.0
+
+    def __init__(self, collection_name: str, mode: Optional[str] = 'auto', poll_interval: float = 1.0,
+                 size: int = 16 * 1024 * 1024):
+        if mode not in (None, 'auto', 'poll'):
+            raise ValueError(f'Unknown log mode: {mode}')
+        self.collection_name = collection_name
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.size = size
+        self._nonce = uuid.uuid4().hex
+        self._since: Optional[datetime] = None
+        self._seen: Dict[ObjectId, datetime] = {}
+        self._ready = False
+        self._change_streams: Optional[bool] = None if mode == 'auto' else False
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def origin(self) -> str:
+        """Identifies this process in the events it appends"""
+        return f'{self._nonce}-{os.getpid()}'
+
+    def handle(self, event: Dict, source: str) -> bool:
+        """Act on an event read from the log, returning whether it was applied"""
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        """Called when events may have been missed"""
+
+    def append(self, events: List[Dict]) -> List[Dict]:
+        """Add events to the log, returning them with their IDs"""
+        for event in events:
+            event.setdefault('_id', ObjectId())
+            event['origin'] = self.origin
+            event.setdefault('at', datetime.now(UTC))
+        if events:
+            self.collection().insert_many(events)
+        return events
+
+    def poll_once(self) -> int:
+        """Handle events appended since the last poll, returning how many were applied"""
+        now = datetime.now(UTC)
+        since = (self._since or now) - timedelta(seconds=self.POLL_LOOKBACK_SECONDS)
+        events = self.collection().find_many({'_id': {'$gte': ObjectId.from_datetime(since)}},
+                                             sort=[('_id', 1)])
+        self._since = now
+        applied = 0
+        for event in events:
+            if event['_id'] in self._seen:
+                continue
+            self._seen[event['_id']] = now
+            applied += self.handle(event, 'poll')
+        for event_id, seen in list(self._seen.items()):
+            if seen < since:
+                del self._seen[event_id]
+        return applied
+
+    def follow_changes(self) -> None:
+        """Handle events as a change stream delivers them, until stopped"""
+        stream = self.collection().watch([{'$match': {'operationType': 'insert'}}],
+                                         max_await_ms=int(self.poll_interval * 1000))
+        caught_up = False
+        for change in stream:
+            if not caught_up:
+                # Events appended before the stream opened
+                self.poll_once()
+                caught_up = True
+            if self._stop.is_set():
+                return
+            # A reopened stream catches up from here
+            self._since = datetime.now(UTC)
+            if change is None:
+                continue
+            event = change['fullDocument']
+            self._seen[event['_id']] = self._since
+            self.handle(event, 'change_stream')
+
+    def run(self) -> None:
+        """Handle events until stopped"""
+        while not self._stop.is_set():
+            try:
+                if self._change_streams is not False:
+                    self.follow_changes()
+                    self._change_streams = True
+                else:
+                    self.poll_once()
+                    self._stop.wait(self.poll_interval)
+            except NotImplementedError:
+                logger.info('Change streams are not available, polling %s', self.collection_name)
+                self._change_streams = False
+            except Exception:
+                logger.exception('Failed to read %s', self.collection_name)
+                self.reset()
+                self._since = None
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """Follow the log on a background thread of this process"""
+        if self.mode is None or (self._pid == os.getpid() and self._thread):
+            return
+        with self._lock:
+            # Threads do not survive a fork, so a forked worker starts its own
+            if self._pid == os.getpid() and self._thread:
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            # State copied across the fork may predate events the parent saw
+            self.reset()
+            self._since = None
+            self._thread = threading.Thread(target=self.run, name=self.collection_name, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def collection(self) -> CollectionInterface:
+        db = get_database()
+        if isinstance(db, PartitionedDatabase):
+            db = db.directory
+        if not self._ready:
+            try:
+                db.run_command({'create': self.collection_name, 'capped': True, 'size': self.size})
+            except Exception:
+                pass  # Already exists
+            self._ready = True
+        return db.get_collection(self.collection_name)
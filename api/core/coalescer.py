@@ -0,0 +1,121 @@
+"""Coalescing of concurrent single-document inserts into insert_many batches.
+
+Request threads inserting into the same collection join an open batch.
+The first thread to join leads it: it waits until the batch is full or
+its deadline passes, then writes the whole batch with one unordered
+insert_many and wakes the others. Every thread gets its own document's
+outcome, so one failed document does not fail its batch mates. There is
+no background thread, which keeps the coalescer safe across forks.
+
+Routes opt in through WRITE_COALESCING, a mapping of endpoint to the
+longest delay in seconds an insert may wait for company. A joiner with
+a shorter delay than the batch's pulls its deadline in.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from flask import current_app, request
+
+from .database import BulkInsertError, PartitionedDatabase, get_database, partition_context
+from .metrics import COALESCED_BATCH_SIZE
+
+class CoalescedInsertError(Exception):
+    """Raised to a thread whose document could not be inserted with its batch"""
+
+class _Batch:
+    """Documents waiting to be inserted together"""
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.documents: List[Dict] = []
+        self.futures: List[Future] = []
+
+    def add(self, document: Dict) -> Future:
+        future: Future = Future()
+        self.documents.append(document)
+        self.futures.append(future)
+        return future
+
+class WriteCoalescer:
+    """Gathers concurrent inserts into one collection into batches"""
+
+    def __init__(self, collection_name: str, max_batch: int = 500,
+                 write_concern: Optional[Dict] = None, partition: Optional[str] = None):
+        self.collection_name = collection_name
+        self.partition = partition
+        self.max_batch = max_batch
+        self.write_concern = write_concern
+        self._batch: Optional[_Batch] = None
+        self._condition = threading.Condition()
+
+    def insert(self, document: Dict, max_delay: float) -> str:
+        """Insert a document with whatever batch it joins, returning its ID"""
+        deadline = time.monotonic() + max_delay
+        with self._condition:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch(deadline)
+            elif deadline < batch.deadline:
+                batch.deadline = deadline
+                self._condition.notify_all()
+            future = batch.add(document)
+            if len(batch.documents) >= self.max_batch:
+                # Full: close it so later inserts start a new batch
+                self._batch = None
+                self._condition.notify_all()
+            if leader:
+                while self._batch is batch:
+                    remaining = batch.deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._batch = None
+                        break
+                    self._condition.wait(remaining)
+        if leader:
+            self._flush(batch)
+        return future.result()
+
+    def _flush(self, batch: _Batch) -> None:
+        COALESCED_BATCH_SIZE.observe(len(batch.documents), self.collection_name)
+        failed: Dict[int, str] = {}
+        try:
+            with partition_context(self.partition):
+                get_database().get_collection(self.collection_name).insert_many(
+                    batch.documents, ordered=False, write_concern=self.write_concern
+                )
+        except BulkInsertError as e:
+            failed = dict(e.errors)
+        except BaseException as e:
+            for future in batch.futures:
+                future.set_exception(e)
+            raise
+        for i, (document, future) in enumerate(zip(batch.documents, batch.futures)):
+            if i in failed:
+                future.set_exception(CoalescedInsertError(failed[i]))
+            else:
+                future.set_result(str(document['_id']))
+
+def coalescing_delay() -> Optional[float]:
+    """Longest delay the current route lets inserts wait to be batched, None when it does not coalesce"""
+    return current_app.config['WRITE_COALESCING'].get(request.endpoint)
+
+def coalesced_insert(collection_name: str, document: Dict, max_delay: float) -> str:
+    """Insert a document through the app's coalescer for a collection (and partition)"""
+    db = get_database()
+    partition = db.current_partition() if isinstance(db, PartitionedDatabase) else None
+    coalescers = current_app.extensions.setdefault('write_coalescers', {})
+    coalescer = coalescers.get((collection_name, partition))
+    if coalescer is None:
+        coalescer = coalescers.setdefault((collection_name, partition), WriteCoalescer(
+            collection_name,
+            max_batch=current_app.config['WRITE_COALESCING_MAX_BATCH'],
+            write_concern=current_app.config['WRITE_COALESCING_WRITE_CONCERN'],
+            partition=partition
+        ))
+    return coalescer.insert(document, max_delay)
+
+def init_coalescing(app) -> None:
+    """Register the write coalescers with the Flask app"""
+    app.extensions['write_coalescers'] = {}
@@ -1,4 +1,5 @@
 from .interface import (
+    BulkInsertError,
     DatabaseInterface,
     CollectionInterface,
     FileStorageInterface,
@@ -6,21 +7,47 @@ from .interface import (
 )
 
 from .factory import (
+    DatabaseBootstrap,
     DatabaseProvider,
+    current_read_preference,
+    each_partition,
     get_database as get_db,  # Alias for backward compatibility
     get_database,
     get_file_storage,
-    init_database
+    init_database,
+    load_backend,
+    set_read_preference
+)
+
+from .partitioned import (
+    PartitionedDatabase,
+    PartitionedFactory,
+    current_tenant,
+    partition_context,
+    set_tenant,
+    tenant_context
 )
 
 __all__ = [
+    'BulkInsertError',
     'DatabaseInterface',
     'CollectionInterface',
     'FileStorageInterface',
     'DatabaseFactory',
+    'DatabaseBootstrap',
     'DatabaseProvider',
+    'current_read_preference',
+    'each_partition',
     'get_db',
     'get_database',
     'get_file_storage',
-    'init_database'
+    'init_database',
+    'load_backend',
+    'set_read_preference',
+    'PartitionedDatabase',
+    'PartitionedFactory',
+    'current_tenant',
+    'partition_context',
+    'set_tenant',
+    'tenant_context'
 ]
\ No newline at end of file
@@ -1,13 +1,45 @@
-from typing import Optional, Type
+import importlib
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple, Type
 from flask import current_app
 
 from .interface import DatabaseFactory, DatabaseInterface, FileStorageInterface
-from .mongodb import MongoDBFactory
+from .partitioned import PartitionedDatabase, PartitionedFactory, partition_context
+from ..metrics import CommandMetricsListener
+from ..profiler import ProfilingCommandListener
+from ..slowlog import SlowQueryListener, SlowQueryLog
+
+logger = logging.getLogger(__name__)
+
+# Factories selectable through the DATABASE_BACKEND setting, as (module, class).
+# Only the configured backend is imported.
+BACKENDS = {
+    'mongodb': ('mongodb', 'MongoDBFactory'),
+    'memory': ('memory', 'MemoryFactory')
+}
+
+def load_backend(name: str) -> Type[DatabaseFactory]:
+    """Import the factory class of a database backend"""
+    module_name, class_name = BACKENDS[name]
+    module = importlib.import_module(f'.{module_name}', __package__)
+    return getattr(module, class_name)
 
 class DatabaseProvider:
-    """Singleton provider for database factory"""
+    """Singleton provider for database factory.
+    
+    The factory holds connection pools, which must not be shared across
+    forked processes. The provider remembers how the factory was built and
+    rebuilds it when used from a new process.
+    """
     _instance: Optional[DatabaseFactory] = None
     _initialized: bool = False
+    _factory_class: Optional[Type[DatabaseFactory]] = None
+    _factory_kwargs: Dict[str, Any] = {}
+    _pid: Optional[int] = None
     
     @classmethod
     def initialize(cls, factory_class: Type[DatabaseFactory], **kwargs) -> None:
@@ -18,7 +50,10 @@ class DatabaseProvider:
         
         # Create new instance
         if not cls._initialized:
+            cls._factory_class = factory_class
+            cls._factory_kwargs = kwargs
             cls._instance = factory_class(**kwargs)
+            cls._pid = os.getpid()
             cls._initialized = True
     
     @classmethod
@@ -26,8 +61,37 @@ class DatabaseProvider:
         """Get the database factory instance"""
         if not cls._initialized:
             raise RuntimeError("DatabaseProvider not initialized")
+        if cls._pid != os.getpid():
+            cls.after_fork()
         return cls._instance
     
+    @classmethod
+    def after_fork(cls) -> None:
+        """Build a fresh factory in a forked worker.
+        
+        The inherited factory's connections belong to the parent process,
+        so it is dropped without being closed. An in-process database has
+        no connections and holds the data, so it is kept.
+        """
+        if cls._initialized:
+            if not cls._instance.in_process:
+                cls._instance = cls._factory_class(**cls._factory_kwargs)
+            cls._pid = os.getpid()
+    
+    @classmethod
+    def in_process(cls) -> bool:
+        """Whether the database lives in this process, so it cannot be shared by several workers"""
+        return cls._initialized and cls._instance.in_process
+    
+    @classmethod
+    def disconnect(cls) -> None:
+        """Close open connections, keeping the factory for reconnecting"""
+        if cls._instance:
+            try:
+                cls._instance.create_database().disconnect()
+            except Exception:
+                pass
+    
     @classmethod
     def reset(cls) -> None:
         """Reset the provider (mainly for testing)"""
@@ -39,6 +103,24 @@ class DatabaseProvider:
                 pass
         cls._instance = None
         cls._initialized = False
+        cls._factory_class = None
+        cls._factory_kwargs = {}
+        cls._pid = None
+
+# Read preference of the current context as (mode, max staleness in seconds),
+# None for the primary
+_read_preference: ContextVar[Optional[Tuple[str, Optional[int]]]] = ContextVar('read_preference', default=None)
+
+def set_read_preference(mode: Optional[str], max_staleness: Optional[int] = None) -> None:
+    """Route reads of the current context by a read preference mode, or to the primary with None.
+    
+    Writes always go to the primary, and backends without replicas ignore it.
+    """
+    _read_preference.set((mode, max_staleness) if mode and mode != 'primary' else None)
+
+def current_read_preference() -> Optional[Tuple[str, Optional[int]]]:
+    """Read preference of the current context"""
+    return _read_preference.get()
 
 def get_database() -> DatabaseInterface:
     """Get the database instance"""
@@ -48,19 +130,18 @@ def get_file_storage() -> FileStorageInterface:
     """Get the file storage instance"""
     return DatabaseProvider.get_factory().create_file_storage()
 
-def init_database(app) -> None:
-    """Initialize database with Flask app"""
-    # Initialize database factory based on configuration
-    DatabaseProvider.initialize(
-        MongoDBFactory,
-        uri=app.config['MONGO_URI'],
-        database_name=app.config['MONGO_DB_NAME']
-    )
-    
-    # Get database instance
+def each_partition() -> Iterator[Optional[str]]:
+    """Run a loop body against each partition in turn, once when the database is not partitioned"""
     db = get_database()
-    
-    # Create indexes
+    if not isinstance(db, PartitionedDatabase):
+        yield None
+        return
+    for name in db.partition_names:
+        with partition_context(name):
+            yield name
+
+def ensure_indexes(db: DatabaseInterface) -> None:
+    """Create the indexes the application relies on"""
     users = db.get_collection('users')
     users.create_index([('username', 1)], unique=True)
     
@@ -84,5 +165,114 @@ def init_database(app) -> None:
         ('keywords', 'text')
     ])
     
-    # Register teardown
-    app.teardown_appcontext(lambda exc: db.disconnect())
\ No newline at end of file
+    upload_sessions = db.get_collection('upload_sessions')
+    upload_sessions.create_index([('expires_at', 1)])
+    
+    term_stats = db.get_collection('term_stats')
+    term_stats.create_index([('index_id', 1), ('term', 1)], unique=True)
+    
+    # Claims look for due jobs by priority and for expired leases
+    jobs = db.get_collection('jobs')
+    jobs.create_index([('status', 1), ('priority', -1), ('run_at', 1)])
+    jobs.create_index([('status', 1), ('lease_until', 1)])
+
+class DatabaseBootstrap:
+    """Prepares the database before the app serves requests.
+    
+    In the background mode indexes are created by a thread, retrying with
+    backoff until the database is reachable, so the process can start
+    serving health checks right away. A process forked before the bootstrap
+    finished restarts it on the next readiness check.
+    """
+    
+    def __init__(self, retry_interval: float = 0.5, max_retry_interval: float = 30.0):
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.error: Optional[str] = None
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    def run(self) -> None:
+        """Bootstrap the database on the calling thread"""
+        for _ in each_partition():
+            ensure_indexes(get_database())
+        self.error = None
+        self._ready.set()
+    
+    def start(self) -> None:
+        """Bootstrap the database on a background thread"""
+        with self._lock:
+            if self._ready.is_set() or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._run, name='database-bootstrap', daemon=True)
+            self._thread.start()
+    
+    def _run(self) -> None:
+        delay = self.retry_interval
+        while True:
+            try:
+                self.run()
+                return
+            except Exception as e:
+                self.error = str(e)
+                logger.warning('Database bootstrap failed, retrying in %.1fs: %s', delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_interval)
+    
+    def is_ready(self) -> bool:
+        """Check whether the bootstrap has finished"""
+        if self._ready.is_set():
+            return True
+        # Threads do not survive a fork, so restart an unfinished bootstrap
+        if self._thread is not None and not self._thread.is_alive():
+            self.start()
+        return False
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the bootstrap to finish"""
+        return self._ready.wait(timeout)
+
+def init_database(app) -> None:
+    """Initialize database with Flask app"""
+    # Monitor database commands for the metrics endpoint
+    event_listeners = []
+    if app.config.get('METRICS_ENABLED'):
+        event_listeners.append(CommandMetricsListener())
+    if app.config.get('PROFILER_ENABLED'):
+        event_listeners.append(ProfilingCommandListener())
+    if app.config.get('SLOW_QUERY_THRESHOLD_MS') is not None:
+        slow_query_log = SlowQueryLog.from_config(app.config)
+        app.extensions['slow_query_log'] = slow_query_log
+        event_listeners.append(
+            SlowQueryListener(slow_query_log, app.config['SLOW_QUERY_THRESHOLD_MS'])
+        )
+    
+    # Initialize database factory based on configuration
+    backend = load_backend(app.config.get('DATABASE_BACKEND', 'mongodb'))
+    if app.config.get('DATABASE_PARTITIONS'):
+        DatabaseProvider.initialize(
+            PartitionedFactory,
+            backend=backend,
+            uri=app.config['MONGO_URI'],
+            database_name=app.config['MONGO_DB_NAME'],
+            partitions=app.config['DATABASE_PARTITIONS'],
+            event_listeners=event_listeners,
+            raw_reads=app.config.get('MONGO_RAW_READS', False)
+        )
+    else:
+        DatabaseProvider.initialize(
+            backend,
+            uri=app.config['MONGO_URI'],
+            database_name=app.config['MONGO_DB_NAME'],
+            event_listeners=event_listeners,
+            raw_reads=app.config.get('MONGO_RAW_READS', False)
+        )
+    
+    # Create indexes, blocking startup only in the sync mode
+    bootstrap = DatabaseBootstrap()
+    app.extensions['database_bootstrap'] = bootstrap
+    if app.config.get('DATABASE_BOOTSTRAP', 'sync') == 'background':
+        bootstrap.start()
+    else:
+        bootstrap.run()
@@ -1,8 +1,18 @@
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, TypeVar, Generic
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Set, TypeVar, Generic
 
 T = TypeVar('T')
 
+class BulkInsertError(Exception):
+    """Raised when some documents of an insert_many could not be inserted"""
+
+    def __init__(self, inserted_ids: List[str], errors: List[tuple[int, str]]):
+        super().__init__(f'{len(errors)} of the documents could not be inserted')
+        self.inserted_ids = inserted_ids
+        # (position in the batch, error message) of each failed document
+        self.errors = errors
+
 class DatabaseInterface(ABC):
     """Base interface for database operations"""
     
@@ -20,6 +30,11 @@ class DatabaseInterface(ABC):
     def get_collection(self, name: str) -> 'CollectionInterface':
         """Get a collection by name"""
         pass
+    
+    @abstractmethod
+    def run_command(self, command: Dict) -> Dict:
+        """Run a database command and return its reply"""
+        pass
 
 class CollectionInterface(ABC, Generic[T]):
     """Base interface for collection operations"""
@@ -31,8 +46,13 @@ class CollectionInterface(ABC, Generic[T]):
     
     @abstractmethod
     def find_many(self, query: Dict, sort: Optional[List] = None, 
-                 skip: int = 0, limit: int = 0) -> List[T]:
-        """Find multiple documents"""
+                 skip: int = 0, limit: int = 0, fields: Optional[Sequence[str]] = None) -> List[T]:
+        """Find multiple documents.
+        
+        fields limits the documents to those top-level fields and _id. The
+        documents of such reads are for reading only: backends may return
+        read-only mappings that are decoded when first accessed.
+        """
         pass
     
     @abstractmethod
@@ -41,8 +61,14 @@ class CollectionInterface(ABC, Generic[T]):
         pass
     
     @abstractmethod
-    def insert_many(self, documents: List[Dict]) -> List[str]:
-        """Insert multiple documents"""
+    def insert_many(self, documents: List[Dict], ordered: bool = True,
+                    write_concern: Optional[Dict] = None) -> List[str]:
+        """Insert multiple documents.
+        
+        Ordered inserts stop at the first failure, unordered inserts try
+        every document. Failures raise BulkInsertError. write_concern
+        overrides the collection's, e.g. {'w': 1, 'j': False}.
+        """
         pass
     
     @abstractmethod
@@ -50,11 +76,26 @@ class CollectionInterface(ABC, Generic[T]):
         """Update a single document"""
         pass
     
+    @abstractmethod
+    def find_one_and_update(self, query: Dict, update: Dict,
+                            sort: Optional[List] = None) -> Optional[T]:
+        """Atomically update the first matching document and return it as updated"""
+        pass
+    
     @abstractmethod
     def update_many(self, query: Dict, update: Dict) -> int:
         """Update multiple documents"""
         pass
     
+    @abstractmethod
+    def bulk_update(self, updates: List[tuple[Dict, Dict]], upsert: bool = False) -> int:
+        """Apply (query, update) pairs to one document each in a single round trip.
+        
+        With upsert, a pair that matches nothing inserts a document built
+        from the query's equality fields. Returns the documents written.
+        """
+        pass
+    
     @abstractmethod
     def delete_one(self, query: Dict) -> bool:
         """Delete a single document"""
@@ -66,8 +107,16 @@ class CollectionInterface(ABC, Generic[T]):
         pass
     
     @abstractmethod
-    def count_documents(self, query: Dict) -> int:
-        """Count documents matching query"""
+    def count_documents(self, query: Dict, limit: int = 0) -> int:
+        """Count documents matching query, stopping at limit when it is set"""
+        pass
+    
+    @abstractmethod
+    def watch(self, pipeline: Optional[List[Dict]] = None, max_await_ms: int = 1000) -> Iterator[Optional[Dict]]:
+        """Follow changes to the collection, yielding None when none arrived within max_await_ms.
+        
+        Raises NotImplementedError where change streams are not available.
+        """
         pass
     
     @abstractmethod
@@ -93,13 +142,52 @@ class FileStorageInterface(ABC):
         """Get file data, filename, and content type"""
         pass
     
+    @abstractmethod
+    def open_file(self, file_id: str) -> tuple[BinaryIO, int, str, str]:
+        """Open a file for streaming: readable stream, length, filename, and content type"""
+        pass
+    
     @abstractmethod
     def delete_file(self, file_id: str) -> bool:
         """Delete a file"""
         pass
+    
+    @abstractmethod
+    def write_chunk(self, file_id: str, n: int, data: bytes) -> None:
+        """Write chunk n of a file that is not finalized yet, replacing any previous write"""
+        pass
+    
+    @abstractmethod
+    def finalize_file(self, file_id: str, length: int, chunk_size: int,
+                      filename: str, content_type: str) -> None:
+        """Make a file from chunks written with write_chunk, all chunk_size long but the last"""
+        pass
+    
+    @abstractmethod
+    def delete_chunks(self, file_id: str) -> int:
+        """Delete the chunks of a file, returning how many were deleted"""
+        pass
+    
+    @abstractmethod
+    def list_files(self, after: Optional[str] = None, uploaded_before: Optional[datetime] = None,
+                   limit: int = 1000, before: Optional[str] = None) -> List[Dict]:
+        """Files in ID order after a file ID (and before another), as dicts of _id (a string), length and upload_date"""
+        pass
+    
+    @abstractmethod
+    def existing_files(self, file_ids: List[str]) -> Set[str]:
+        """Those of the file IDs that have a stored file"""
+        pass
+    
+    @abstractmethod
+    def missing_chunks(self, file_ids: List[str]) -> Dict[str, int]:
+        """Files among the IDs that lack chunks, mapped to how many they lack"""
+        pass
 
 class DatabaseFactory(ABC):
     """Factory interface for creating database instances"""
+    # Whether data lives in this process's memory, so forked processes each get a copy
+    in_process: bool = False
     
     @abstractmethod
     def create_database(self) -> DatabaseInterface:
@@ -0,0 +1,556 @@
+import copy
+import functools
+import io
+import re
+import threading
+from datetime import datetime, UTC
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Set, TypeVar
+
+from bson.objectid import ObjectId
+
+from .interface import (
+    BulkInsertError,
+    DatabaseInterface,
+    CollectionInterface,
+    FileStorageInterface,
+    DatabaseFactory
+)
+
+T = TypeVar('T')
+
+_MISSING = object()
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+class DuplicateKeyError(Exception):
+    """Raised when an insert or update violates a unique index"""
+    pass
+
+def _type_rank(value: Any) -> int:
+    """Rank values by type the way MongoDB orders mixed types"""
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+def _compare(a: Any, b: Any) -> int:
+    """Compare two values, ordering by type first"""
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a == 1:
+        return 0
+    if isinstance(a, datetime) and isinstance(b, datetime):
+        a, b = _aware(a), _aware(b)
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return 0
+
+def _aware(value: datetime) -> datetime:
+    """Treat naive datetimes as UTC, as BSON does"""
+    return value if value.tzinfo else value.replace(tzinfo=UTC)
+
+def _get_values(doc: Any, path: str) -> List[Any]:
+    """Resolve a dotted path, expanding arrays along the way"""
+    values = [doc]
+    for part in path.split('.'):
+        resolved = []
+        for value in values:
+            if isinstance(value, dict):
+                resolved.append(value.get(part, _MISSING))
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    resolved.append(value[int(part)])
+                else:
+                    resolved.extend(
+                        item.get(part, _MISSING) for item in value if isinstance(item, dict)
+                    )
+            else:
+                resolved.append(_MISSING)
+        values = resolved
+    return values
+
+def _candidates(values: List[Any]) -> List[Any]:
+    """Values to test a condition against, including array members"""
+    result = []
+    for value in values:
+        result.append(value)
+        if isinstance(value, list):
+            result.extend(value)
+    return result
+
+def _equals(a: Any, b: Any) -> bool:
+    if a is _MISSING:
+        a = None
+    if isinstance(a, datetime) and isinstance(b, datetime):
+        return _aware(a) == _aware(b)
+    return _type_rank(a) == _type_rank(b) and a == b
+
+def _match_operator(values: List[Any], op: str, arg: Any) -> bool:
+    """Evaluate a single query operator against the resolved values"""
+    candidates = _candidates(values)
+    present = [v for v in candidates if v is not _MISSING]
+    if op == '$eq':
+        return any(_equals(v, arg) for v in candidates)
+    if op == '$ne':
+        return not any(_equals(v, arg) for v in candidates)
+    if op == '$in':
+        return any(_equals(v, a) for v in candidates for a in arg)
+    if op == '$nin':
+        return not any(_equals(v, a) for v in candidates for a in arg)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        for value in present:
+            if _type_rank(value) != _type_rank(arg):
+                continue
+            result = _compare(value, arg)
+            if ((op == '$gt' and result > 0) or (op == '$gte' and result >= 0)
+                    or (op == '$lt' and result < 0) or (op == '$lte' and result <= 0)):
+                return True
+        return False
+    if op == '$exists':
+        return bool(present) == bool(arg)
+    if op == '$not':
+        return not _match_condition(values, arg)
+    if op == '$all':
+        return all(any(_equals(v, a) for v in candidates) for a in arg)
+    if op == '$size':
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+    if op == '$regex':
+        pattern = re.compile(arg) if isinstance(arg, str) else arg
+        return any(isinstance(v, str) and pattern.search(v) for v in present)
+    if op == '$elemMatch':
+        return any(
+            isinstance(v, list) and any(_matches(item, arg) for item in v if isinstance(item, dict))
+            for v in values
+        )
+    if op == '$options':
+        return True
+    raise NotImplementedError(f'Query operator {op} is not supported by the memory backend')
+
+def _match_condition(values: List[Any], condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        if '$regex' in condition and '$options' in condition:
+            flags = re.IGNORECASE if 'i' in condition['$options'] else 0
+            condition = dict(condition, **{'$regex': re.compile(condition['$regex'], flags)})
+        return all(_match_operator(values, op, arg) for op, arg in condition.items())
+    if isinstance(condition, re.Pattern):
+        return _match_operator(values, '$regex', condition)
+    return _match_operator(values, '$eq', condition)
+
+def _matches(doc: Dict, query: Dict, text_fields: Optional[List[str]] = None) -> bool:
+    """Check whether a document matches a query"""
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_matches(doc, q, text_fields) for q in condition):
+                return False
+        elif key == '$or':
+            if not any(_matches(doc, q, text_fields) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(_matches(doc, q, text_fields) for q in condition):
+                return False
+        elif key == '$text':
+            if not _text_score(doc, condition['$search'], text_fields or []):
+                return False
+        elif not _match_condition(_get_values(doc, key), condition):
+            return False
+    return True
+
+def _text_score(doc: Dict, search: str, text_fields: List[str]) -> int:
+    """Count search terms found in the text indexed fields"""
+    words = set()
+    for field in text_fields:
+        for value in _candidates(_get_values(doc, field)):
+            if isinstance(value, str):
+                words.update(w.lower() for w in _WORD.findall(value))
+    return sum(1 for term in _WORD.findall(search.lower()) if term in words)
+
+def _set_path(doc: Dict, path: str, value: Any) -> None:
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+def _get_path(doc: Dict, path: str, default: Any = None) -> Any:
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return default
+        doc = doc[part]
+    return doc
+
+def _unset_path(doc: Dict, path: str) -> None:
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+def _apply_update(doc: Dict, update: Dict, inserting: bool = False) -> None:
+    """Apply update operators to a document in place"""
+    if not any(key.startswith('$') for key in update):
+        update = {'$set': update}
+    for op, fields in update.items():
+        for path, value in fields.items():
+            value = copy.deepcopy(value)
+            if op == '$set':
+                _set_path(doc, path, value)
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set_path(doc, path, value)
+            elif op == '$unset':
+                _unset_path(doc, path)
+            elif op == '$inc':
+                _set_path(doc, path, _get_path(doc, path, 0) + value)
+            elif op in ('$max', '$min'):
+                current = _get_path(doc, path, _MISSING)
+                if current is _MISSING or _compare(value, current) == (1 if op == '$max' else -1):
+                    _set_path(doc, path, value)
+            elif op in ('$push', '$addToSet'):
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                array = _get_path(doc, path, _MISSING)
+                if array is _MISSING:
+                    array = []
+                    _set_path(doc, path, array)
+                for item in items:
+                    if op == '$push' or not any(_equals(existing, item) for existing in array):
+                        array.append(item)
+            elif op == '$pull':
+                array = _get_path(doc, path, [])
+                if isinstance(value, dict):
+                    array[:] = [item for item in array if not _match_condition([item], value)]
+                else:
+                    array[:] = [item for item in array if not _equals(item, value)]
+            else:
+                raise NotImplementedError(f'Update operator {op} is not supported by the memory backend')
+
+def _sort_documents(documents: List[Dict], sort: List) -> List[Dict]:
+    """Sort documents by a list of (key, direction) pairs"""
+    keys = [(key, direction) for key, direction in sort if not isinstance(direction, dict)]
+
+    def compare(a, b):
+        for key, direction in keys:
+            value_a = _get_values(a, key)[0] if _get_values(a, key) else _MISSING
+            value_b = _get_values(b, key)[0] if _get_values(b, key) else _MISSING
+            result = _compare(value_a, value_b)
+            if result:
+                return result * (1 if direction >= 0 else -1)
+        return 0
+
+    return sorted(documents, key=functools.cmp_to_key(compare))
+
+def _seed_from_query(query: Dict) -> Dict:
+    """Build the base document for an upsert from a query's equality fields"""
+    doc = {}
+    for key, value in query.items():
+        if not key.startswith('$') and not (isinstance(value, dict) and any(k.startswith('$') for k in value)):
+            _set_path(doc, key, copy.deepcopy(value))
+    return doc
+
+class MemoryCollection(CollectionInterface[T]):
+    """In-process implementation of CollectionInterface"""
+
+    def __init__(self, name: str, lock: threading.RLock):
+        self.name = name
+        self._lock = lock
+        self._documents: Dict[Any, Dict] = {}
+        self._indexes: Dict[str, Dict] = {}
+
+    @property
+    def _text_fields(self) -> List[str]:
+        return [
+            key for index in self._indexes.values()
+            for key, direction in index['keys'] if direction == 'text'
+        ]
+
+    def _filter(self, query: Dict) -> List[Dict]:
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self._documents.get(query['_id'])
+            candidates = [doc] if doc is not None else []
+        else:
+            candidates = self._documents.values()
+        text_fields = self._text_fields
+        return [doc for doc in candidates if _matches(doc, query, text_fields)]
+
+    def _check_unique(self, doc: Dict) -> None:
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            key = tuple(_get_path(doc, field) for field, _ in index['keys'])
+            for other in self._documents.values():
+                if other['_id'] == doc['_id']:
+                    continue
+                if tuple(_get_path(other, field) for field, _ in index['keys']) == key:
+                    raise DuplicateKeyError(f'E11000 duplicate key error index: {name}')
+
+    def find_one(self, query: Dict) -> Optional[T]:
+        with self._lock:
+            found = self._filter(query)
+            return copy.deepcopy(found[0]) if found else None
+
+    def find_many(self, query: Dict, sort: Optional[List] = None,
+                 skip: int = 0, limit: int = 0, fields: Optional[Sequence[str]] = None) -> List[T]:
+        with self._lock:
+            documents = self._filter(query)
+            if sort:
+                documents = _sort_documents(documents, sort)
+            documents = documents[skip:skip + limit] if limit else documents[skip:]
+            if fields is not None:
+                documents = [{field: doc[field] for field in ('_id', *fields) if field in doc} for doc in documents]
+            return copy.deepcopy(documents)
+
+    def insert_one(self, document: Dict) -> str:
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        with self._lock:
+            if document['_id'] in self._documents:
+                raise DuplicateKeyError('E11000 duplicate key error index: _id_')
+            self._check_unique(document)
+            self._documents[document['_id']] = copy.deepcopy(document)
+        return str(document['_id'])
+
+    def insert_many(self, documents: List[Dict], ordered: bool = True,
+                    write_concern: Optional[Dict] = None) -> List[str]:
+        inserted_ids = []
+        errors = []
+        for i, doc in enumerate(documents):
+            try:
+                inserted_ids.append(self.insert_one(doc))
+            except DuplicateKeyError as e:
+                errors.append((i, str(e)))
+                if ordered:
+                    break
+        if errors:
+            raise BulkInsertError(inserted_ids, errors)
+        return inserted_ids
+
+    def update_one(self, query: Dict, update: Dict) -> bool:
+        with self._lock:
+            found = self._filter(query)
+            if not found:
+                return False
+            doc = found[0]
+            updated = copy.deepcopy(doc)
+            _apply_update(updated, update)
+            self._check_unique(updated)
+            changed = updated != doc
+            self._documents[doc['_id']] = updated
+            return changed
+
+    def find_one_and_update(self, query: Dict, update: Dict,
+                            sort: Optional[List] = None) -> Optional[T]:
+        with self._lock:
+            found = self._filter(query)
+            if not found:
+                return None
+            doc = _sort_documents(found, sort)[0] if sort else found[0]
+            updated = copy.deepcopy(doc)
+            _apply_update(updated, update)
+            self._check_unique(updated)
+            self._documents[doc['_id']] = updated
+            return copy.deepcopy(updated)
+
+    def update_many(self, query: Dict, update: Dict) -> int:
+        with self._lock:
+            modified = 0
+            for doc in self._filter(query):
+                updated = copy.deepcopy(doc)
+                _apply_update(updated, update)
+                if updated != doc:
+                    self._documents[doc['_id']] = updated
+                    modified += 1
+            return modified
+
+    def bulk_update(self, updates: List[tuple[Dict, Dict]], upsert: bool = False) -> int:
+        written = 0
+        with self._lock:
+            for query, update in updates:
+                found = self._filter(query)
+                if found:
+                    doc = found[0]
+                    updated = copy.deepcopy(doc)
+                    _apply_update(updated, update)
+                elif upsert:
+                    doc = None
+                    updated = _seed_from_query(query)
+                    _apply_update(updated, update, inserting=True)
+                    updated.setdefault('_id', ObjectId())
+                else:
+                    continue
+                self._check_unique(updated)
+                if updated != doc:
+                    self._documents[updated['_id']] = updated
+                    written += 1
+        return written
+
+    def delete_one(self, query: Dict) -> bool:
+        with self._lock:
+            found = self._filter(query)
+            if not found:
+                return False
+            del self._documents[found[0]['_id']]
+            return True
+
+    def delete_many(self, query: Dict) -> int:
+        with self._lock:
+            found = self._filter(query)
+            for doc in found:
+                del self._documents[doc['_id']]
+            return len(found)
+
+    def count_documents(self, query: Dict, limit: int = 0) -> int:
+        with self._lock:
+            count = len(self._filter(query))
+        return min(count, limit) if limit else count
+
+    def watch(self, pipeline: Optional[List[Dict]] = None, max_await_ms: int = 1000) -> Iterator[Optional[Dict]]:
+        raise NotImplementedError('Change streams are not supported by the memory backend')
+
+    def create_index(self, keys: List[tuple], unique: bool = False) -> str:
+        name = '_'.join(f'{key}_{direction}' for key, direction in keys)
+        with self._lock:
+            self._indexes[name] = {'keys': list(keys), 'unique': unique}
+        return name
+
+    def drop_index(self, index_name: str) -> None:
+        with self._lock:
+            self._indexes.pop(index_name, None)
+
+class MemoryFileStorage(FileStorageInterface):
+    """In-process implementation of FileStorageInterface"""
+
+    def __init__(self):
+        self._files: Dict[ObjectId, Dict] = {}
+        self._chunks: Dict[ObjectId, Dict[int, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def store_file(self, file_data: bytes, filename: str, content_type: str) -> str:
+        file_id = ObjectId()
+        with self._lock:
+            self._files[file_id] = {
+                'data': bytes(file_data),
+                'filename': filename,
+                'content_type': content_type,
+                'upload_date': datetime.now(UTC)
+            }
+        return str(file_id)
+
+    def get_file(self, file_id: str) -> tuple[bytes, str, str]:
+        stored = self._files.get(ObjectId(file_id))
+        if stored is None:
+            raise FileNotFoundError(f"File {file_id} not found")
+        return stored['data'], stored['filename'], stored['content_type']
+
+    def open_file(self, file_id: str) -> tuple[BinaryIO, int, str, str]:
+        data, filename, content_type = self.get_file(file_id)
+        return io.BytesIO(data), len(data), filename, content_type
+
+    def delete_file(self, file_id: str) -> bool:
+        with self._lock:
+            return self._files.pop(ObjectId(file_id), None) is not None
+
+    def write_chunk(self, file_id: str, n: int, data: bytes) -> None:
+        with self._lock:
+            self._chunks.setdefault(ObjectId(file_id), {})[n] = bytes(data)
+
+    def finalize_file(self, file_id: str, length: int, chunk_size: int,
+                      filename: str, content_type: str) -> None:
+        obj_id = ObjectId(file_id)
+        with self._lock:
+            chunks = self._chunks.pop(obj_id, {})
+            data = b''.join(chunks[n] for n in sorted(chunks))
+            if len(data) != length:
+                self._chunks[obj_id] = chunks
+                raise ValueError(f'File {file_id} has {len(data)} bytes, expected {length}')
+            self._files[obj_id] = {
+                'data': data,
+                'filename': filename,
+                'content_type': content_type,
+                'upload_date': datetime.now(UTC)
+            }
+
+    def delete_chunks(self, file_id: str) -> int:
+        with self._lock:
+            return len(self._chunks.pop(ObjectId(file_id), {}))
+
+    def list_files(self, after: Optional[str] = None, uploaded_before: Optional[datetime] = None,
+                   limit: int = 1000, before: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            files = sorted(
+                (file_id, stored) for file_id, stored in self._files.items()
+                if (after is None or file_id > ObjectId(after))
+                and (before is None or file_id < ObjectId(before))
+                and (uploaded_before is None or stored['upload_date'] < uploaded_before)
+            )
+        return [{'_id': str(file_id), 'length': len(stored['data']), 'upload_date': stored['upload_date']}
+                for file_id, stored in files[:limit]]
+
+    def existing_files(self, file_ids: List[str]) -> Set[str]:
+        with self._lock:
+            return {file_id for file_id in file_ids if ObjectId(file_id) in self._files}
+
+    def missing_chunks(self, file_ids: List[str]) -> Dict[str, int]:
+        # Finalized files are kept whole
+        return {}
+
+class MemoryDatabase(DatabaseInterface):
+    """In-process implementation of DatabaseInterface.
+
+    Data lives for as long as the instance, so a fresh database is created
+    per factory. Intended for tests, benchmarks and small single-process
+    deployments.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._collections: Dict[str, MemoryCollection] = {}
+        self.file_storage = MemoryFileStorage()
+
+    def connect(self) -> None:
+        pass
+
+    def disconnect(self) -> None:
+        pass
+
+    def get_collection(self, name: str) -> CollectionInterface:
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(name, self._lock)
+            return self._collections[name]
+
+    def run_command(self, command: Dict) -> Dict:
+        name = next(iter(command))
+        if name == 'create':
+            self.get_collection(command['create'])
+            return {'ok': 1.0}
+        if name == 'ping':
+            return {'ok': 1.0}
+        raise NotImplementedError(f'Command {name} is not supported by the memory backend')
+
+class MemoryFactory(DatabaseFactory):
+    """Factory for the in-process database"""
+    in_process = True
+
+    def __init__(self, **kwargs):
+        self._db_instance = MemoryDatabase()
+
+    def create_database(self) -> DatabaseInterface:
+        return self._db_instance
+
+    def create_file_storage(self) -> FileStorageInterface:
+        return self._db_instance.file_storage
@@ -1,13 +1,23 @@
-from typing import Any, Dict, List, Optional, TypeVar, Generic
-from pymongo import MongoClient
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Set, TypeVar, Generic
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 from pymongo.collection import Collection
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.write_concern import WriteConcern
 from pymongo.database import Database
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from gridfs import GridFS
+from bson.binary import Binary
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from bson.objectid import ObjectId
+from datetime import datetime, UTC
+from functools import lru_cache
 import io
 
+from ..metrics import GRIDFS_BYTES_READ, GRIDFS_BYTES_WRITTEN
+from .factory import current_read_preference
 from .interface import (
+    BulkInsertError,
     DatabaseInterface,
     CollectionInterface,
     FileStorageInterface,
@@ -16,18 +26,48 @@ from .interface import (
 
 T = TypeVar('T')
 
+# Projected reads return documents left encoded until first accessed
+RAW_DOCUMENTS = CodecOptions(document_class=RawBSONDocument)
+
+# Error code of $changeStream on a server that is not a replica set member
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+READ_PREFERENCE_MODES = {
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+@lru_cache(maxsize=None)
+def make_read_preference(mode: str, max_staleness: Optional[int] = None):
+    """Build a pymongo read preference from its mode name and max staleness in seconds"""
+    if mode == 'primary':
+        return Primary()
+    if mode not in READ_PREFERENCE_MODES:
+        raise ValueError(f'Unknown read preference: {mode}')
+    return READ_PREFERENCE_MODES[mode](max_staleness=-1 if max_staleness is None else max_staleness)
+
 class MongoDBCollection(CollectionInterface[T]):
     """MongoDB implementation of CollectionInterface"""
     
-    def __init__(self, collection: Collection):
+    def __init__(self, collection: Collection, raw_reads: bool = False):
         self.collection = collection
+        self.raw_reads = raw_reads
     
     def find_one(self, query: Dict) -> Optional[T]:
         return self.collection.find_one(query)
     
     def find_many(self, query: Dict, sort: Optional[List] = None,
-                 skip: int = 0, limit: int = 0) -> List[T]:
-        cursor = self.collection.find(query)
+                 skip: int = 0, limit: int = 0, fields: Optional[Sequence[str]] = None) -> List[T]:
+        if fields is None:
+            cursor = self.collection.find(query)
+        else:
+            collection = self.collection
+            if self.raw_reads:
+                # Skip decoding in the driver: readers decode just what they use
+                collection = collection.with_options(codec_options=RAW_DOCUMENTS)
+            cursor = collection.find(query, {field: 1 for field in fields})
         if sort:
             cursor = cursor.sort(sort)
         if skip:
@@ -42,24 +82,58 @@ class MongoDBCollection(CollectionInterface[T]):
         result = self.collection.insert_one(document)
         return str(result.inserted_id)
     
-    def insert_many(self, documents: List[Dict]) -> List[str]:
+    def insert_many(self, documents: List[Dict], ordered: bool = True,
+                    write_concern: Optional[Dict] = None) -> List[str]:
         for doc in documents:
             if '_id' not in doc:
                 doc['_id'] = ObjectId()
-        result = self.collection.insert_many(documents)
+        collection = self.collection
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=WriteConcern(**write_concern))
+        try:
+            result = collection.insert_many(documents, ordered=ordered)
+        except BulkWriteError as e:
+            errors = [(error['index'], error['errmsg']) for error in e.details['writeErrors']]
+            failed = {index for index, _ in errors}
+            # Ordered inserts skip everything after the first failure
+            last = min(failed) if ordered else len(documents)
+            raise BulkInsertError(
+                [str(doc['_id']) for i, doc in enumerate(documents[:last]) if i not in failed],
+                errors
+            )
         return [str(id) for id in result.inserted_ids]
     
+    @staticmethod
+    def _update_document(update: Dict) -> Dict:
+        """Treat a plain document as the fields to $set"""
+        if any(key.startswith('$') for key in update):
+            return update
+        return {'$set': update}
+    
     def update_one(self, query: Dict, update: Dict) -> bool:
-        if '$set' in update:
-            result = self.collection.update_one(query, update)
-        else:
-            result = self.collection.update_one(query, {'$set': update})
+        result = self.collection.update_one(query, self._update_document(update))
         return result.modified_count > 0
     
+    def find_one_and_update(self, query: Dict, update: Dict,
+                            sort: Optional[List] = None) -> Optional[T]:
+        return self.collection.find_one_and_update(
+            query, self._update_document(update), sort=sort,
+            return_document=ReturnDocument.AFTER
+        )
+    
     def update_many(self, query: Dict, update: Dict) -> int:
-        result = self.collection.update_many(query, {'$set': update})
+        result = self.collection.update_many(query, self._update_document(update))
         return result.modified_count
     
+    def bulk_update(self, updates: List[tuple[Dict, Dict]], upsert: bool = False) -> int:
+        if not updates:
+            return 0
+        result = self.collection.bulk_write(
+            [UpdateOne(query, self._update_document(update), upsert=upsert) for query, update in updates],
+            ordered=False
+        )
+        return result.modified_count + result.upserted_count
+    
     def delete_one(self, query: Dict) -> bool:
         result = self.collection.delete_one(query)
         return result.deleted_count > 0
@@ -68,21 +142,50 @@ class MongoDBCollection(CollectionInterface[T]):
         result = self.collection.delete_many(query)
         return result.deleted_count
     
-    def count_documents(self, query: Dict) -> int:
+    def count_documents(self, query: Dict, limit: int = 0) -> int:
+        if limit:
+            return self.collection.count_documents(query, limit=limit)
         return self.collection.count_documents(query)
     
+    def watch(self, pipeline: Optional[List[Dict]] = None, max_await_ms: int = 1000) -> Iterator[Optional[Dict]]:
+        try:
+            stream = self.collection.watch(pipeline or [], max_await_time_ms=max_await_ms)
+        except OperationFailure as e:
+            # Standalone servers have no oplog to follow
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                raise NotImplementedError(str(e)) from e
+            raise
+        with stream:
+            while stream.alive:
+                yield stream.try_next()
+    
     def create_index(self, keys: List[tuple], unique: bool = False) -> str:
         return self.collection.create_index(keys, unique=unique)
     
     def drop_index(self, index_name: str) -> None:
         self.collection.drop_index(index_name)
 
+class _MeteredReader:
+    """Wrap a GridFS stream to count the bytes read from it"""
+    
+    def __init__(self, grid_out):
+        self._grid_out = grid_out
+    
+    def read(self, size: int = -1) -> bytes:
+        data = self._grid_out.read(size)
+        GRIDFS_BYTES_READ.inc(len(data))
+        return data
+    
+    def close(self) -> None:
+        self._grid_out.close()
+
 class MongoDBFileStorage(FileStorageInterface):
     """MongoDB GridFS implementation of FileStorageInterface"""
     
     def __init__(self, database: Database):
         self.database = database
         self._fs = None
+        self._chunk_index_ready = False
     
     @property
     def fs(self) -> GridFS:
@@ -97,6 +200,7 @@ class MongoDBFileStorage(FileStorageInterface):
             filename=filename,
             content_type=content_type
         )
+        GRIDFS_BYTES_WRITTEN.inc(len(file_data))
         return str(file_id)
     
     def get_file(self, file_id: str) -> tuple[bytes, str, str]:
@@ -105,32 +209,112 @@ class MongoDBFileStorage(FileStorageInterface):
             raise FileNotFoundError(f"File {file_id} not found")
         
         grid_out = self.fs.get(obj_id)
+        data = grid_out.read()
+        GRIDFS_BYTES_READ.inc(len(data))
         return (
-            grid_out.read(),
+            data,
             grid_out.filename,
             grid_out.content_type
         )
     
+    def open_file(self, file_id: str) -> tuple[BinaryIO, int, str, str]:
+        obj_id = ObjectId(file_id)
+        if not self.fs.exists(obj_id):
+            raise FileNotFoundError(f"File {file_id} not found")
+        
+        # Chunks are fetched from the server as the stream is read
+        grid_out = self.fs.get(obj_id)
+        return _MeteredReader(grid_out), grid_out.length, grid_out.filename, grid_out.content_type
+    
     def delete_file(self, file_id: str) -> bool:
         obj_id = ObjectId(file_id)
         if not self.fs.exists(obj_id):
             return False
         self.fs.delete(obj_id)
         return True
+    
+    def write_chunk(self, file_id: str, n: int, data: bytes) -> None:
+        chunks = self.database['fs.chunks']
+        if not self._chunk_index_ready:
+            # The index GridFS itself relies on, so rewrites replace a chunk
+            try:
+                chunks.create_index([('files_id', 1), ('n', 1)], unique=True)
+            except OperationFailure:
+                pass  # Already created by GridFS
+            self._chunk_index_ready = True
+        obj_id = ObjectId(file_id)
+        chunks.replace_one(
+            {'files_id': obj_id, 'n': n},
+            {'files_id': obj_id, 'n': n, 'data': Binary(data)},
+            upsert=True
+        )
+        GRIDFS_BYTES_WRITTEN.inc(len(data))
+    
+    def finalize_file(self, file_id: str, length: int, chunk_size: int,
+                      filename: str, content_type: str) -> None:
+        # Chunks are already in place, only the files document is missing
+        self.database['fs.files'].insert_one({
+            '_id': ObjectId(file_id),
+            'length': length,
+            'chunkSize': chunk_size,
+            'uploadDate': datetime.now(UTC),
+            'filename': filename,
+            'contentType': content_type
+        })
+    
+    def delete_chunks(self, file_id: str) -> int:
+        result = self.database['fs.chunks'].delete_many({'files_id': ObjectId(file_id)})
+        return result.deleted_count
+    
+    def list_files(self, after: Optional[str] = None, uploaded_before: Optional[datetime] = None,
+                   limit: int = 1000, before: Optional[str] = None) -> List[Dict]:
+        query: Dict[str, Any] = {}
+        if after is not None:
+            query.setdefault('_id', {})['$gt'] = ObjectId(after)
+        if before is not None:
+            query.setdefault('_id', {})['$lt'] = ObjectId(before)
+        if uploaded_before is not None:
+            query['uploadDate'] = {'$lt': uploaded_before}
+        cursor = self.database['fs.files'].find(query, {'length': 1, 'uploadDate': 1}).sort('_id', 1).limit(limit)
+        return [{'_id': str(doc['_id']), 'length': doc['length'], 'upload_date': doc['uploadDate']}
+                for doc in cursor]
+    
+    def existing_files(self, file_ids: List[str]) -> Set[str]:
+        cursor = self.database['fs.files'].find({'_id': {'$in': [ObjectId(file_id) for file_id in file_ids]}}, {'_id': 1})
+        return {str(doc['_id']) for doc in cursor}
+    
+    def missing_chunks(self, file_ids: List[str]) -> Dict[str, int]:
+        obj_ids = [ObjectId(file_id) for file_id in file_ids]
+        files = self.database['fs.files'].find({'_id': {'$in': obj_ids}}, {'length': 1, 'chunkSize': 1})
+        # Chunks are counted per file in one aggregation, using the GridFS chunk index
+        counts = {doc['_id']: doc['count'] for doc in self.database['fs.chunks'].aggregate([
+            {'$match': {'files_id': {'$in': obj_ids}}},
+            {'$group': {'_id': '$files_id', 'count': {'$sum': 1}}}
+        ])}
+        missing = {}
+        for doc in files:
+            expected = -(-doc['length'] // doc['chunkSize'])
+            if counts.get(doc['_id'], 0) < expected:
+                missing[str(doc['_id'])] = expected - counts.get(doc['_id'], 0)
+        return missing
 
 class MongoDB(DatabaseInterface):
     """MongoDB implementation of DatabaseInterface"""
     
-    def __init__(self, uri: str, database_name: str):
+    def __init__(self, uri: str, database_name: str, event_listeners: Sequence = (), raw_reads: bool = False):
         self.uri = uri
         self.database_name = database_name
+        self.event_listeners = list(event_listeners)
+        self.raw_reads = raw_reads
         self.client: Optional[MongoClient] = None
         self._db: Optional[Database] = None
         self._file_storage: Optional[MongoDBFileStorage] = None
+        # File storage reading through each read preference in use
+        self._routed_file_storage: Dict[tuple, MongoDBFileStorage] = {}
     
     def connect(self) -> None:
         if not self.client:
-            self.client = MongoClient(self.uri)
+            self.client = MongoClient(self.uri, event_listeners=self.event_listeners)
             self._db = self.client[self.database_name]
             self._file_storage = MongoDBFileStorage(self._db)
     
@@ -140,25 +324,52 @@ class MongoDB(DatabaseInterface):
             self.client = None
             self._db = None
             self._file_storage = None
+            self._routed_file_storage = {}
     
     def get_collection(self, name: str) -> CollectionInterface:
         if self._db is None:
             raise RuntimeError("Database not connected")
-        return MongoDBCollection(self._db[name])
+        preference = current_read_preference()
+        if preference is None:
+            return MongoDBCollection(self._db[name], self.raw_reads)
+        return MongoDBCollection(self._db.get_collection(
+            name, read_preference=make_read_preference(*preference)
+        ), self.raw_reads)
+    
+    def file_storage(self) -> 'MongoDBFileStorage':
+        """File storage reading with the current read preference"""
+        if self._db is None:
+            raise RuntimeError("Database not connected")
+        preference = current_read_preference()
+        if preference is None:
+            return self._file_storage
+        storage = self._routed_file_storage.get(preference)
+        if storage is None:
+            storage = self._routed_file_storage.setdefault(preference, MongoDBFileStorage(
+                self._db.with_options(read_preference=make_read_preference(*preference))
+            ))
+        return storage
+    
+    def run_command(self, command: Dict) -> Dict:
+        if self._db is None:
+            raise RuntimeError("Database not connected")
+        return self._db.command(command)
 
 class MongoDBFactory(DatabaseFactory):
     """Factory for creating MongoDB instances"""
     
-    def __init__(self, uri: str, database_name: str):
+    def __init__(self, uri: str, database_name: str, event_listeners: Sequence = (), raw_reads: bool = False):
         self.uri = uri
         self.database_name = database_name
+        self.event_listeners = list(event_listeners)
+        self.raw_reads = raw_reads
         self._db_instance: Optional[MongoDB] = None
     
     def create_database(self) -> DatabaseInterface:
         if not self._db_instance or self._db_instance._db is None:
             if self._db_instance:
                 self._db_instance.disconnect()
-            self._db_instance = MongoDB(self.uri, self.database_name)
+            self._db_instance = MongoDB(self.uri, self.database_name, self.event_listeners, self.raw_reads)
             self._db_instance.connect()
         return self._db_instance
     
@@ -166,4 +377,4 @@ class MongoDBFactory(DatabaseFactory):
         db = self.create_database()
         if not isinstance(db, MongoDB) or db._db is None:
             raise RuntimeError("Database not properly initialized")
-        return db._file_storage
\ No newline at end of file
+        return db.file_storage()
\ No newline at end of file
@@ -0,0 +1,181 @@
+"""Databases partitioned by tenant.
+
+Users, the job queue, the tenant_partitions table and the logs of cache
+invalidations and entry events live in a directory database. Each user's indexes,
+entries, upload sessions, term statistics and files live in one
+partition, picked by consistent hashing of the user ID unless
+tenant_partitions pins the user elsewhere. Collections are resolved
+against the tenant of the current context: requests set it to the
+authenticated user and jobs to the user they were queued for. Code
+running without a tenant reaches the first partition; sweeps over every
+partition use each_partition().
+"""
+import bisect
+import hashlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+from .interface import CollectionInterface, DatabaseFactory, DatabaseInterface, FileStorageInterface
+
+# Collections kept in the directory database rather than in partitions
+DIRECTORY_COLLECTIONS = frozenset({'users', 'jobs', 'tenant_partitions', 'slow_queries', 'invalidations',
+                                   'entry_events'})
+TENANT_PARTITIONS_COLLECTION = 'tenant_partitions'
+
+# User whose partition the current context uses
+_tenant: ContextVar[Optional[Any]] = ContextVar('tenant', default=None)
+# Partition of _tenant, resolved once per context
+_resolved: ContextVar[Optional[Tuple[Any, str]]] = ContextVar('tenant_partition', default=None)
+# Partition forced by partition_context, ahead of the tenant's
+_partition: ContextVar[Optional[str]] = ContextVar('partition', default=None)
+
+def set_tenant(user_id: Optional[Any], partition: Optional[str] = None) -> None:
+    """Use the partition of a user in the current context, or the default one with None.
+
+    A partition already looked up for the user saves current_partition the lookup.
+    """
+    _tenant.set(user_id)
+    _resolved.set((user_id, partition) if user_id is not None and partition is not None else None)
+
+def current_tenant() -> Optional[Any]:
+    """User whose partition the current context uses"""
+    return _tenant.get()
+
+@contextmanager
+def tenant_context(user_id: Optional[Any]) -> Iterator[None]:
+    """Use the partition of a user within the block"""
+    tenant, resolved = _tenant.set(user_id), _resolved.set(None)
+    try:
+        yield
+    finally:
+        _resolved.reset(resolved)
+        _tenant.reset(tenant)
+
+@contextmanager
+def partition_context(name: Optional[str]) -> Iterator[None]:
+    """Use a partition by name within the block, whoever the tenant is"""
+    token = _partition.set(name)
+    try:
+        yield
+    finally:
+        _partition.reset(token)
+
+class HashRing:
+    """Consistent hash ring: adding a partition moves only the keys it takes over"""
+
+    def __init__(self, names: List[str], replicas: int = 64):
+        points = sorted(
+            (self._hash(f'{name}#{i}'), name) for name in names for i in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def lookup(self, key: str) -> str:
+        """Partition owning a key"""
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._names[i]
+
+class PartitionedDatabase(DatabaseInterface):
+    """Routes collections to the directory or to the current tenant's partition"""
+
+    def __init__(self, directory: DatabaseFactory, partitions: Dict[str, DatabaseFactory]):
+        self.directory_factory = directory
+        self.partition_factories = partitions
+        self.partition_names = list(partitions)
+        self.ring = HashRing(self.partition_names)
+
+    @property
+    def directory(self) -> DatabaseInterface:
+        return self.directory_factory.create_database()
+
+    def connect(self) -> None:
+        self.directory.connect()
+        for factory in self.partition_factories.values():
+            factory.create_database().connect()
+
+    def disconnect(self) -> None:
+        self.directory.disconnect()
+        for factory in self.partition_factories.values():
+            factory.create_database().disconnect()
+
+    def locate(self, user_id: Any) -> str:
+        """Partition holding a user's data"""
+        return self.placement(user_id)[0]
+
+    def placement(self, user_id: Any) -> Tuple[str, Optional[Dict]]:
+        """Partition of a user and their tenant_partitions entry, if pinned"""
+        pinned = self.directory.get_collection(TENANT_PARTITIONS_COLLECTION).find_one({'_id': user_id})
+        if pinned:
+            return pinned['partition'], pinned
+        return self.ring.lookup(str(user_id)), None
+
+    def is_moving(self, user_id: Any) -> bool:
+        """Whether a user's data is being moved to another partition"""
+        _, pinned = self.placement(user_id)
+        return bool(pinned) and pinned.get('state') == 'moving'
+
+    def current_partition(self) -> str:
+        """Name of the partition the current context uses"""
+        name = _partition.get()
+        if name is not None:
+            return name
+        tenant = _tenant.get()
+        if tenant is None:
+            return self.partition_names[0]
+        resolved = _resolved.get()
+        if resolved is None or resolved[0] != tenant:
+            resolved = (tenant, self.locate(tenant))
+            _resolved.set(resolved)
+        return resolved[1]
+
+    def known_partition(self) -> Optional[str]:
+        """Partition the current context uses, or None if finding it would take a lookup"""
+        name = _partition.get()
+        if name is not None:
+            return name
+        tenant = _tenant.get()
+        if tenant is None:
+            return self.partition_names[0]
+        resolved = _resolved.get()
+        return resolved[1] if resolved is not None and resolved[0] == tenant else None
+
+    def partition(self, name: Optional[str] = None) -> DatabaseInterface:
+        """A partition's database, by default the current context's"""
+        return self.partition_factories[name or self.current_partition()].create_database()
+
+    def get_collection(self, name: str) -> CollectionInterface:
+        if name in DIRECTORY_COLLECTIONS:
+            return self.directory.get_collection(name)
+        return self.partition().get_collection(name)
+
+    def run_command(self, command: Dict) -> Dict:
+        if _tenant.get() is None and _partition.get() is None:
+            return self.directory.run_command(command)
+        return self.partition().run_command(command)
+
+class PartitionedFactory(DatabaseFactory):
+    """Factory for a directory database and partitions of one backend.
+
+    partitions maps partition names to URIs; the directory uses uri.
+    """
+
+    def __init__(self, backend: Type[DatabaseFactory], uri: str, database_name: str,
+                 partitions: Dict[str, str], **kwargs):
+        self.in_process = backend.in_process
+        self.directory_factory = backend(uri=uri, database_name=database_name, **kwargs)
+        self.partition_factories = {
+            name: backend(uri=partition_uri, database_name=database_name, **kwargs)
+            for name, partition_uri in partitions.items()
+        }
+        self._db_instance = PartitionedDatabase(self.directory_factory, self.partition_factories)
+
+    def create_database(self) -> DatabaseInterface:
+        return self._db_instance
+
+    def create_file_storage(self) -> FileStorageInterface:
+        return self.partition_factories[self._db_instance.current_partition()].create_file_storage()
@@ -6,10 +6,36 @@ class AuthenticationError(Exception):
     """Raised when authentication fails"""
     pass
 
+class PermissionDeniedError(Exception):
+    """Raised when an authenticated user may not perform an action"""
+    pass
+
 class ResourceNotFoundError(Exception):
     """Raised when a requested resource is not found"""
     pass
 
+class QuotaExceededError(Exception):
+    """Raised when a write would take a user over their storage quota"""
+    pass
+
+class LengthRequiredError(Exception):
+    """Raised when an upload whose size must be known up front has no Content-Length"""
+    pass
+
+class RateLimitExceededError(Exception):
+    """Raised when a client has used up its request budget"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ServiceUnavailableError(Exception):
+    """Raised when the app cannot serve requests yet"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
 from flask import jsonify
 from flask_jwt_extended.exceptions import JWTExtendedException
 from werkzeug.exceptions import NotFound
@@ -27,10 +53,39 @@ def register_error_handlers(app):
         """Handle authentication errors"""
         return jsonify({'error': str(error)}), 401
     
+    @app.errorhandler(PermissionDeniedError)
+    def handle_permission_denied_error(error):
+        """Handle permission errors"""
+        return jsonify({'error': str(error)}), 403
+    
     @app.errorhandler(ResourceNotFoundError)
     def handle_not_found_error(error):
         """Handle not found errors"""
         return jsonify({'error': str(error)}), 404
+    
+    @app.errorhandler(QuotaExceededError)
+    def handle_quota_exceeded_error(error):
+        """Handle writes over quota"""
+        return jsonify({'error': str(error)}), 413
+    
+    @app.errorhandler(LengthRequiredError)
+    def handle_length_required_error(error):
+        """Handle uploads sent without a Content-Length"""
+        return jsonify({'error': str(error)}), 411
+    
+    @app.errorhandler(RateLimitExceededError)
+    def handle_rate_limit_error(error):
+        """Handle rate limit errors"""
+        response = jsonify({'error': str(error)})
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+        
+    @app.errorhandler(ServiceUnavailableError)
+    def handle_service_unavailable_error(error):
+        """Handle requests made before the app is ready"""
+        response = jsonify({'error': str(error)})
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
         
     @app.errorhandler(JWTExtendedException)
     def handle_jwt_error(error):
@@ -0,0 +1,226 @@
+"""Live feeds of entry changes, streamed as Server-Sent Events.
+
+Entry writes append created and deleted events to the capped entry_events
+log. One hub per process follows the log, from the first stream it
+serves on, and fans each event out to the streams subscribed to its
+index or user. Every stream has a bounded queue; a stream that falls
+behind is closed rather than buffered, and its client reconnects with
+Last-Event-ID and catches up from the log. Streams send a comment every
+SSE_HEARTBEAT_SECONDS to keep proxies from timing them out, and close
+after SSE_MAX_SECONDS, which frees their worker thread; clients
+reconnect and resume the same way.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import Response, current_app, has_app_context, request, stream_with_context
+
+from .capped_log import CappedLog
+from .errors import ServiceUnavailableError
+
+logger = logging.getLogger(__name__)
+
+ENTRY_EVENTS_COLLECTION = 'entry_events'
+
+# Milliseconds clients wait before reconnecting a closed stream
+RECONNECT_MS = 1000
+
+def _entry_payload(entry: Dict) -> Dict[str, Any]:
+    return {
+        'id': str(entry['_id']),
+        'index_id': str(entry['index_id']),
+        'type': entry['type'],
+        'content': entry.get('content'),
+        'file_id': str(entry['file_id']) if entry.get('file_id') else None,
+        'metadata': entry.get('metadata'),
+        'created_at': entry['created_at'].isoformat()
+    }
+
+def format_event(event: Dict) -> str:
+    """An event in the text/event-stream format"""
+    return f"id: {event['_id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+class Subscriber:
+    """A stream's subscription to the events of an index, or of all a user's indexes"""
+
+    def __init__(self, user_id: ObjectId, index_id: Optional[ObjectId], max_queue: int):
+        self.user_id = user_id
+        self.index_id = index_id
+        self.queue: queue.Queue = queue.Queue(max_queue)
+        self.closed = False
+
+    def matches(self, event: Dict) -> bool:
+        if self.index_id is not None:
+            return event['index_id'] == self.index_id
+        return event['user_id'] == self.user_id
+
+    def offer(self, event: Optional[Dict]) -> None:
+        """Queue an event without blocking the hub, closing the stream when it is full"""
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.close()
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            # Wake the stream up
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+class EntryFeed(CappedLog):
+    """Fans entry events out to the streams of this process"""
+
+    def __init__(self, mode: Optional[str] = 'auto', poll_interval: float = 0.5,
+                 log_size: int = 64 * 1024 * 1024, max_queue: int = 256, max_streams: int = 2):
+        super().__init__(ENTRY_EVENTS_COLLECTION, mode, poll_interval, log_size)
+        self.max_queue = max_queue
+        self.max_streams = max_streams
+        self.subscribers: List[Subscriber] = []
+        self._subscribers_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app) -> 'EntryFeed':
+        return cls(
+            mode=app.config['ENTRY_FEED_MODE'],
+            poll_interval=app.config['ENTRY_FEED_POLL_INTERVAL'],
+            log_size=app.config['ENTRY_FEED_LOG_SIZE'],
+            max_queue=app.config['SSE_QUEUE_SIZE'],
+            max_streams=app.config['SSE_MAX_STREAMS']
+        )
+
+    def subscribe(self, user_id: ObjectId, index_id: Optional[ObjectId] = None) -> Subscriber:
+        # Starting in a forked worker closes the streams copied from the parent
+        self.start()
+        with self._subscribers_lock:
+            if len(self.subscribers) >= self.max_streams:
+                raise ServiceUnavailableError('Too many open event streams', retry_after=RECONNECT_MS // 1000)
+            subscriber = Subscriber(user_id, index_id, self.max_queue)
+            self.subscribers = self.subscribers + [subscriber]
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._subscribers_lock:
+            self.subscribers = [other for other in self.subscribers if other is not subscriber]
+
+    def deliver(self, event: Dict) -> None:
+        """Hand an event to the matching streams of this process"""
+        for subscriber in self.subscribers:
+            if subscriber.matches(event):
+                subscriber.offer(event)
+
+    def handle(self, event: Dict, source: str) -> bool:
+        # This process's own events were delivered when they were published
+        if event.get('origin') == self.origin:
+            return False
+        self.deliver(event)
+        return True
+
+    def reset(self) -> None:
+        # Events may have been missed: streams reconnect and catch up from the log
+        for subscriber in self.subscribers:
+            subscriber.close()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        super().stop(timeout)
+        self.reset()
+
+    def publish(self, event_type: str, entries: Iterable[Dict]) -> None:
+        """Tell the streams of every process about created or deleted entries"""
+        events = [{
+            'type': event_type,
+            'user_id': entry['user_id'],
+            'index_id': entry['index_id'],
+            'data': _entry_payload(entry) if event_type == 'created'
+            else {'id': str(entry['_id']), 'index_id': str(entry['index_id'])}
+        } for entry in entries]
+        if not events:
+            return
+        try:
+            self.append(events)
+        except Exception:
+            logger.exception('Failed to publish %d entry events', len(events))
+            return
+        for event in events:
+            self.deliver(event)
+
+    def replay(self, subscriber: Subscriber, after: ObjectId, limit: int) -> Optional[List[Dict]]:
+        """Logged events for a subscriber after an event ID, None when the log no longer reaches back to it"""
+        log = self.collection()
+        oldest = log.find_many({}, sort=[('_id', 1)], limit=1)
+        if oldest and oldest[0]['_id'] > after:
+            return None
+        query: Dict[str, Any] = {'_id': {'$gt': after}}
+        if subscriber.index_id is not None:
+            query['index_id'] = subscriber.index_id
+        else:
+            query['user_id'] = subscriber.user_id
+        events = log.find_many(query, sort=[('_id', 1)], limit=limit + 1)
+        return events if len(events) <= limit else None
+
+    def stream(self, subscriber: Subscriber, last_event_id: Optional[str], heartbeat: float,
+               max_seconds: float, replay_limit: int) -> Iterator[str]:
+        """Events for a subscriber as text/event-stream, resuming after last_event_id"""
+        try:
+            yield f'retry: {RECONNECT_MS}\n\n'
+            sent = set()
+            if last_event_id:
+                try:
+                    after = ObjectId(last_event_id)
+                except (InvalidId, TypeError):
+                    after = None
+                events = self.replay(subscriber, after, replay_limit) if after else []
+                if events is None:
+                    # Too far behind to resume: the client reloads instead
+                    yield 'event: reset\ndata: {}\n\n'
+                    events = []
+                for event in events:
+                    sent.add(event['_id'])
+                    yield format_event(event)
+            deadline = time.monotonic() + max_seconds
+            while not subscriber.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = subscriber.queue.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if event is None or event['_id'] in sent:
+                    continue
+                yield format_event(event)
+        finally:
+            self.unsubscribe(subscriber)
+
+def publish_entries(event_type: str, entries: Iterable[Dict]) -> None:
+    """Tell live feeds that entries were created or deleted"""
+    if has_app_context() and 'entry_feed' in current_app.extensions:
+        current_app.extensions['entry_feed'].publish(event_type, entries)
+
+def event_stream(user_id: ObjectId, index_id: Optional[ObjectId] = None) -> Response:
+    """Streaming response of the live feed of an index, or of all a user's indexes"""
+    feed = current_app.extensions['entry_feed']
+    config = current_app.config
+    subscriber = feed.subscribe(user_id, index_id)
+    events = feed.stream(subscriber, request.headers.get('Last-Event-ID'), config['SSE_HEARTBEAT_SECONDS'],
+                         config['SSE_MAX_SECONDS'], config['SSE_REPLAY_LIMIT'])
+    response = Response(stream_with_context(events), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Keep nginx from buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+    # A stream closed before it started never reaches its own cleanup
+    response.call_on_close(lambda: feed.unsubscribe(subscriber))
+    return response
+
+def init_feed(app) -> None:
+    """Register the live entry feed with the Flask app"""
+    app.extensions['entry_feed'] = EntryFeed.from_config(app)
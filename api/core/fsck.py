@@ -0,0 +1,260 @@
+"""Online consistency checks of entries, indexes and files.
+
+A scan streams over GridFS files, then entries, in _id order and batch by
+batch, so its memory stays bounded whatever the size of the data, and
+looks up what each batch refers to with one query per kind. It reports:
+
+- corrupt_files: GridFS files lacking some of their chunks
+- dangling_entries: entries whose index no longer exists
+- missing_files: file entries whose file is gone
+- missing_renditions: renditions whose file is gone
+
+With repair, corrupt files are deleted, which makes their entries missing
+files; entries of deleted indexes and entries whose file is gone are
+deleted, giving their usage back; and missing renditions are dropped
+from their entry, to be generated again when next requested. Orphaned
+files are left to the garbage collector. Scans are paced to a number of
+documents per second so they can run against a live deployment, and can
+be split by _id range over several processes.
+"""
+import logging
+import multiprocessing
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from .database import each_partition, get_file_storage, partition_context
+from .feed import publish_entries
+from .garbage import IOBudget
+from .index_stats import forget_entry
+from .invalidation import entry_tag, invalidate
+from .jobs import enqueue, job_handler
+from .keywords import forget_keywords
+from .models import Entry, Index
+from .quota import release_entry
+from .renditions import delete_renditions
+
+logger = logging.getLogger(__name__)
+
+PROBLEMS = ('corrupt_files', 'dangling_entries', 'missing_files', 'missing_renditions')
+
+# App forked scan processes run in, set by the parent before forking
+_fork_app = None
+
+def new_report() -> Dict[str, Any]:
+    return {
+        'files_scanned': 0,
+        'entries_scanned': 0,
+        **{problem: 0 for problem in PROBLEMS},
+        'repaired': 0,
+        'examples': {problem: [] for problem in PROBLEMS}
+    }
+
+def merge_reports(reports: Iterable[Dict[str, Any]], examples: int = 10) -> Dict[str, Any]:
+    """Sum the reports of scans over parts of the data"""
+    merged = new_report()
+    for report in reports:
+        for key, value in report.items():
+            if key == 'examples':
+                for problem, found in value.items():
+                    merged['examples'][problem] = (merged['examples'][problem] + found)[:examples]
+            else:
+                merged[key] += value
+    return merged
+
+def _just_before(object_id: ObjectId) -> ObjectId:
+    return ObjectId((int.from_bytes(object_id.binary, 'big') - 1).to_bytes(12, 'big'))
+
+def id_ranges(lowest: Optional[ObjectId], parts: int,
+              until: Optional[datetime] = None) -> List[Tuple[Optional[ObjectId], Optional[ObjectId]]]:
+    """Split the _id values from lowest on into ranges of equal creation time.
+
+    Ranges are (after, before) bounds, both exclusive and None when open,
+    so that together they cover every _id, including those created later.
+    """
+    if lowest is None or parts <= 1:
+        return [(None, None)]
+    start = lowest.generation_time.timestamp()
+    step = max((until or datetime.now(UTC)).timestamp() - start, 0) / parts
+    ranges = []
+    after = None
+    for part in range(1, parts):
+        bound = ObjectId.from_datetime(datetime.fromtimestamp(start + step * part, UTC))
+        ranges.append((after, bound))
+        after = _just_before(bound)
+    ranges.append((after, None))
+    return ranges
+
+class ConsistencyScan:
+    """Checks, and optionally repairs, the files and entries of the current partition"""
+
+    def __init__(self, repair: bool = False, batch_size: int = 500, rate: Optional[float] = None,
+                 examples: int = 10):
+        self.repair = repair
+        self.batch_size = batch_size
+        self.pace = IOBudget(rate)
+        self.examples = examples
+        self.report = new_report()
+
+    def found(self, problem: str, example: str) -> None:
+        self.report[problem] += 1
+        if len(self.report['examples'][problem]) < self.examples:
+            self.report['examples'][problem].append(example)
+
+    def scan_files(self, after: Optional[ObjectId] = None, before: Optional[ObjectId] = None) -> None:
+        """Check that GridFS files have all their chunks"""
+        storage = get_file_storage()
+        after = str(after) if after else None
+        while True:
+            files = storage.list_files(after=after, before=str(before) if before else None, limit=self.batch_size)
+            if not files:
+                break
+            after = files[-1]['_id']
+            self.report['files_scanned'] += len(files)
+            self.pace.spend(len(files))
+
+            for file_id, missing in storage.missing_chunks([stored['_id'] for stored in files]).items():
+                self.found('corrupt_files', file_id)
+                logger.warning('File %s lacks %d chunks', file_id, missing)
+                if self.repair and storage.delete_file(file_id):
+                    self.report['repaired'] += 1
+
+    def scan_entries(self, after: Optional[ObjectId] = None, before: Optional[ObjectId] = None) -> None:
+        """Check that entries have their index, file and renditions"""
+        storage = get_file_storage()
+        while True:
+            bounds = {}
+            if after is not None:
+                bounds['$gt'] = after
+            if before is not None:
+                bounds['$lt'] = before
+            batch = Entry.get_collection().find_many({'_id': bounds} if bounds else {},
+                                                     sort=[('_id', 1)], limit=self.batch_size)
+            if not batch:
+                break
+            after = batch[-1]['_id']
+            self.report['entries_scanned'] += len(batch)
+            self.pace.spend(len(batch))
+
+            index_ids = list({entry['index_id'] for entry in batch})
+            indexes = {index['_id'] for index in Index.get_collection().find_many({'_id': {'$in': index_ids}})}
+            file_ids = [str(entry['file_id']) for entry in batch if entry.get('file_id')]
+            file_ids += [str(rendition['file_id']) for entry in batch
+                         for rendition in (entry.get('renditions') or {}).values() if rendition]
+            stored = storage.existing_files(file_ids) if file_ids else set()
+
+            for entry in batch:
+                if entry['index_id'] not in indexes:
+                    self.found('dangling_entries', str(entry['_id']))
+                    if self.repair and Entry.get_collection().delete_one({'_id': entry['_id']}):
+                        # The index's statistics and term counts went with it
+                        release_entry(entry)
+                        self.report['repaired'] += 1
+                    continue
+                if entry['type'] == 'file' and str(entry.get('file_id')) not in stored:
+                    self.found('missing_files', str(entry['_id']))
+                    if self.repair:
+                        self._delete_entry(entry)
+                    continue
+                for name, rendition in (entry.get('renditions') or {}).items():
+                    if rendition and str(rendition['file_id']) not in stored:
+                        self.found('missing_renditions', f"{entry['_id']}/{name}")
+                        if self.repair and Entry.get_collection().update_one(
+                                {'_id': entry['_id']}, {'$unset': {f'renditions.{name}': ''}}):
+                            invalidate(entry_tag(entry['_id']))
+                            self.report['repaired'] += 1
+
+    def _delete_entry(self, entry: Dict) -> None:
+        delete_renditions(entry)
+        forget_keywords(entry)
+        # Whoever deletes the entry first gives its usage back
+        if Entry.get_collection().delete_one({'_id': entry['_id']}):
+            release_entry(entry)
+            forget_entry(entry)
+            invalidate(entry_tag(entry['_id']))
+            publish_entries('deleted', [entry])
+            self.report['repaired'] += 1
+
+def _scan_range(kind: str, after: Optional[ObjectId], before: Optional[ObjectId], options: Dict,
+                partition: Optional[str]) -> Dict[str, Any]:
+    """Scan part of a partition in a forked process"""
+    with _fork_app.app_context(), partition_context(partition):
+        scan = ConsistencyScan(**options)
+        if kind == 'files':
+            scan.scan_files(after, before)
+        else:
+            scan.scan_entries(after, before)
+        return scan.report
+
+def _lowest_ids() -> Dict[str, Optional[ObjectId]]:
+    files = get_file_storage().list_files(limit=1)
+    entries = Entry.get_collection().find_many({}, sort=[('_id', 1)], limit=1)
+    return {
+        'files': ObjectId(files[0]['_id']) if files else None,
+        'entries': entries[0]['_id'] if entries else None
+    }
+
+def check_consistency(config, repair: bool = False, processes: Optional[int] = None, rate: Optional[float] = None,
+                      batch_size: Optional[int] = None, examples: Optional[int] = None,
+                      partition: Optional[str] = None) -> Dict[str, Any]:
+    """Check the files, then the entries, of the current partition.
+
+    Files are checked first, so that entries of corrupt files a repair
+    deleted are repaired in the same run.
+    """
+    global _fork_app
+    options = {
+        'repair': repair,
+        'batch_size': batch_size or config['FSCK_BATCH_SIZE'],
+        'rate': config['FSCK_RATE'] if rate is None else rate,
+        'examples': config['FSCK_EXAMPLES'] if examples is None else examples
+    }
+    processes = processes or config['FSCK_PROCESSES']
+    if processes > 1 and config['DATABASE_BACKEND'] == 'memory':
+        logger.warning('The in-process database is checked in a single process')
+        processes = 1
+    if processes <= 1:
+        scan = ConsistencyScan(**options)
+        scan.scan_files()
+        scan.scan_entries()
+        return scan.report
+
+    lowest = _lowest_ids()
+    _fork_app = current_app._get_current_object()
+    reports = []
+    # Forked processes open their own connections on first use
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        for kind in ('files', 'entries'):
+            reports += pool.starmap(_scan_range, [
+                (kind, after, before, options, partition) for after, before in id_ranges(lowest[kind], processes)
+            ])
+    return merge_reports(reports, options['examples'])
+
+def problems_found(report: Dict[str, Any]) -> int:
+    return sum(report[problem] for problem in PROBLEMS)
+
+def schedule_consistency_check(repair: bool = False) -> int:
+    """Queue a check of each partition"""
+    queued = 0
+    for partition in each_partition():
+        enqueue('storage.fsck', {'partition': partition, 'repair': repair}, priority=-20)
+        queued += 1
+    return queued
+
+@job_handler('storage.fsck')
+def check_consistency_job(payload: Dict) -> None:
+    """Job: check, and optionally repair, the consistency of a partition"""
+    partition = payload.get('partition')
+    # Job workers run threads, which forking would copy mid-flight, so
+    # splitting over processes is left to the command line
+    with partition_context(partition):
+        report = check_consistency(current_app.config, repair=payload.get('repair', False), processes=1,
+                                   partition=partition)
+    if problems_found(report):
+        logger.warning('Consistency check of %s: %s, %d repaired', partition or 'the database',
+                       ', '.join(f'{report[problem]} {problem}' for problem in PROBLEMS), report['repaired'])
+    else:
+        logger.info('Consistency check of %s found no problems in %d files and %d entries',
+                    partition or 'the database', report['files_scanned'], report['entries_scanned'])
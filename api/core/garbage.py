@@ -0,0 +1,169 @@
+"""Collection of orphaned entries and GridFS files.
+
+Deleting an index leaves its entries behind, and a failed or interrupted
+write can leave a stored file that no entry points to. The collector
+first deletes entries whose index no longer exists, then scans GridFS in
+_id order, batch by batch, and deletes the files that no entry (or
+rendition, or open upload session) references, looking references up
+with one $in query per batch. Files and entries younger than the grace
+period are left alone, as their entry or index may still be on its way.
+Deletions are paced to an I/O budget in bytes per second.
+"""
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, UTC
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from .database import each_partition, get_file_storage, partition_context
+from .jobs import enqueue, job_handler
+from .models import Entry, Index, TermStats, UploadSession
+from .quota import file_size, release
+
+logger = logging.getLogger(__name__)
+
+class IOBudget:
+    """Paces work to at most a number of bytes, or documents, per second (None for no limit)"""
+
+    def __init__(self, rate: Optional[float]):
+        self.rate = rate
+        self.spent = 0
+        self.started = time.monotonic()
+
+    def spend(self, amount: int) -> None:
+        if not self.rate:
+            return
+        self.spent += amount
+        ahead = self.spent / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+def _aware(value: datetime) -> datetime:
+    # BSON dates are UTC but come back naive
+    return value if value.tzinfo else value.replace(tzinfo=UTC)
+
+def _entry_file_ids(entry: Dict) -> Iterable[str]:
+    if entry.get('file_id'):
+        yield str(entry['file_id'])
+    for rendition in (entry.get('renditions') or {}).values():
+        if rendition and rendition.get('file_id'):
+            yield str(rendition['file_id'])
+
+def collect_dangling_entries(cutoff: datetime, batch_size: int = 500, dry_run: bool = False) -> Dict[str, int]:
+    """Delete entries created before cutoff whose index no longer exists.
+
+    Their usage is released; their files are left to collect_orphan_files.
+    """
+    counts = {'entries_scanned': 0, 'dangling_entries': 0}
+    existing: Set[ObjectId] = set()
+    missing: Set[ObjectId] = set()
+    after = None
+    while True:
+        query: Dict[str, Any] = {} if after is None else {'_id': {'$gt': after}}
+        batch = Entry.get_collection().find_many(query, sort=[('_id', 1)], limit=batch_size)
+        if not batch:
+            break
+        after = batch[-1]['_id']
+        counts['entries_scanned'] += len(batch)
+
+        unknown = {entry['index_id'] for entry in batch} - existing - missing
+        if unknown:
+            found = {index['_id'] for index in Index.get_collection().find_many({'_id': {'$in': list(unknown)}})}
+            existing |= found
+            missing |= unknown - found
+        dangling = [entry for entry in batch
+                    if entry['index_id'] in missing and _aware(entry['created_at']) < cutoff]
+        counts['dangling_entries'] += len(dangling)
+        if not dangling or dry_run:
+            continue
+
+        Entry.get_collection().delete_many({'_id': {'$in': [entry['_id'] for entry in dangling]}})
+        released: Dict[ObjectId, Dict[str, int]] = defaultdict(lambda: {'bytes': 0, 'files': 0, 'entries': 0})
+        for entry in dangling:
+            usage = released[entry['user_id']]
+            usage['entries'] += 1
+            if entry['type'] == 'file':
+                usage['files'] += 1
+                usage['bytes'] += file_size(entry)
+        for user_id, usage in released.items():
+            release(user_id, **usage)
+
+    if missing and not dry_run:
+        TermStats.get_collection().delete_many({'index_id': {'$in': list(missing)}})
+    return counts
+
+def _referenced_file_ids(file_ids: List[str], rendition_names: Iterable[str]) -> Set[str]:
+    """Those of the file IDs an entry, rendition or open upload session refers to"""
+    # Older entries keep their file ID as a string
+    values = [ObjectId(file_id) for file_id in file_ids] + list(file_ids)
+    fields = ['file_id'] + [f'renditions.{name}.file_id' for name in rendition_names]
+    referenced = set()
+    for entry in Entry.get_collection().find_many({'$or': [{field: {'$in': values}} for field in fields]}):
+        referenced.update(_entry_file_ids(entry))
+    for session in UploadSession.get_collection().find_many({
+            'file_id': {'$in': values}, 'status': {'$in': ['open', 'committing']}}):
+        referenced.add(str(session['file_id']))
+    return referenced
+
+def collect_orphan_files(cutoff: datetime, batch_size: int = 500, budget: Optional[IOBudget] = None,
+                         rendition_names: Iterable[str] = (), dry_run: bool = False) -> Dict[str, int]:
+    """Delete files uploaded before cutoff that nothing refers to"""
+    budget = budget or IOBudget(None)
+    rendition_names = list(rendition_names)
+    storage = get_file_storage()
+    counts = {'files_scanned': 0, 'orphan_files': 0, 'files_deleted': 0, 'bytes_reclaimed': 0}
+    after = None
+    while True:
+        files = storage.list_files(after=after, uploaded_before=cutoff, limit=batch_size)
+        if not files:
+            break
+        after = files[-1]['_id']
+        counts['files_scanned'] += len(files)
+
+        referenced = _referenced_file_ids([stored['_id'] for stored in files], rendition_names)
+        for stored in files:
+            if stored['_id'] in referenced:
+                continue
+            counts['orphan_files'] += 1
+            if dry_run:
+                counts['bytes_reclaimed'] += stored['length']
+                continue
+            budget.spend(stored['length'])
+            if storage.delete_file(stored['_id']):
+                counts['files_deleted'] += 1
+                counts['bytes_reclaimed'] += stored['length']
+    return counts
+
+def collect_garbage(config, grace_seconds: Optional[float] = None, batch_size: Optional[int] = None,
+                    io_budget: Optional[float] = None, dry_run: bool = False) -> Dict[str, int]:
+    """Collect dangling entries, then orphaned files, of the current partition"""
+    grace = config['GC_GRACE_SECONDS'] if grace_seconds is None else grace_seconds
+    batch_size = batch_size or config['GC_BATCH_SIZE']
+    cutoff = datetime.now(UTC) - timedelta(seconds=grace)
+    counts = collect_dangling_entries(cutoff, batch_size, dry_run)
+    counts.update(collect_orphan_files(
+        cutoff, batch_size,
+        budget=IOBudget(config['GC_IO_BUDGET'] if io_budget is None else io_budget),
+        rendition_names=config['RENDITION_SIZES'],
+        dry_run=dry_run
+    ))
+    return counts
+
+def schedule_garbage_collection() -> int:
+    """Queue a collection of each partition"""
+    queued = 0
+    for partition in each_partition():
+        enqueue('storage.collect_garbage', {'partition': partition}, priority=-20)
+        queued += 1
+    return queued
+
+@job_handler('storage.collect_garbage')
+def collect_garbage_job(payload: Dict) -> None:
+    """Job: collect the dangling entries and orphaned files of a partition"""
+    with partition_context(payload.get('partition')):
+        counts = collect_garbage(current_app.config)
+    logger.info('Collected %d entries and %d files (%d bytes) in %s', counts['dangling_entries'],
+                counts['files_deleted'], counts['bytes_reclaimed'], payload.get('partition') or 'the database')
@@ -0,0 +1,37 @@
+from flask import current_app, jsonify, request
+
+from .errors import ServiceUnavailableError
+
+# Endpoints served while the database bootstrap is still running
+UNGATED_ENDPOINTS = {'health_live', 'health_ready', 'metrics', 'static'}
+
+def _bootstrap():
+    return current_app.extensions.get('database_bootstrap')
+
+def live():
+    """Liveness probe: the process is up"""
+    return jsonify({'status': 'ok'}), 200
+
+def ready():
+    """Readiness probe: the database bootstrap has finished"""
+    bootstrap = _bootstrap()
+    if bootstrap is None or bootstrap.is_ready():
+        return jsonify({'status': 'ready'}), 200
+    body = {'status': 'starting'}
+    if bootstrap.error:
+        body['error'] = bootstrap.error
+    return jsonify(body), 503
+
+def _check_ready() -> None:
+    """Turn away requests until the database bootstrap has finished"""
+    if request.endpoint in UNGATED_ENDPOINTS:
+        return
+    bootstrap = _bootstrap()
+    if bootstrap is not None and not bootstrap.is_ready():
+        raise ServiceUnavailableError('Service is starting')
+
+def init_health(app) -> None:
+    """Register health probes and the readiness gate with the Flask app"""
+    app.add_url_rule('/health/live', 'health_live', live)
+    app.add_url_rule('/health/ready', 'health_ready', ready)
+    app.before_request(_check_ready)
@@ -0,0 +1,106 @@
+"""Per-index statistics kept on the index document.
+
+Every index carries stats: entry counts in total and by type, file bytes,
+and when its newest entry was created. They change with one $inc per
+write, so listings return them without touching the entries collection.
+The same writes increment the index version, which keys cached counts.
+rebuild_stats recomputes them from the entries when they have drifted,
+and gives them to indexes created before stats were kept on their first
+write.
+"""
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, Optional, Union
+
+from bson.objectid import ObjectId
+
+from .models import Entry, Index
+from .quota import file_size
+
+ENTRY_TYPES = ('text', 'file')
+
+def empty_stats() -> Dict[str, Any]:
+    """Statistics of an index without entries"""
+    return {'entries': 0, 'text': 0, 'file': 0, 'bytes': 0, 'last_entry_at': None}
+
+def index_stats(index: Union[Dict, Index]) -> Dict[str, Any]:
+    """Statistics of an index document or model, as returned by the API"""
+    stored = index.stats if isinstance(index, Index) else index.get('stats')
+    stats = dict(empty_stats(), **(stored or {}))
+    last_entry_at = stats['last_entry_at']
+    if last_entry_at is not None:
+        # BSON dates are UTC but come back naive
+        stats['last_entry_at'] = (last_entry_at if last_entry_at.tzinfo
+                                  else last_entry_at.replace(tzinfo=UTC)).isoformat()
+    return stats
+
+def _entry_stats(entries: Iterable[Dict]) -> Dict[str, Any]:
+    stats = empty_stats()
+    for entry in entries:
+        stats['entries'] += 1
+        if entry['type'] in ENTRY_TYPES:
+            stats[entry['type']] += 1
+        if entry['type'] == 'file':
+            stats['bytes'] += file_size(entry)
+        if stats['last_entry_at'] is None or entry['created_at'] > stats['last_entry_at']:
+            stats['last_entry_at'] = entry['created_at']
+    return stats
+
+def record_entries(index_id: ObjectId, entries: Iterable[Dict]) -> None:
+    """Count new entries of an index"""
+    stats = _entry_stats(entries)
+    if not stats['entries']:
+        return
+    update: Dict[str, Any] = {'$inc': {
+        f'stats.{field}': stats[field] for field in ('entries', *ENTRY_TYPES, 'bytes') if stats[field]
+    }}
+    update['$inc']['version'] = 1
+    update['$max'] = {'stats.last_entry_at': stats['last_entry_at']}
+    _update_stats(index_id, update)
+
+def forget_entry(entry: Dict) -> None:
+    """Take a deleted entry out of its index's statistics"""
+    stats = _entry_stats([entry])
+    _update_stats(entry['index_id'], {'$inc': {
+        **{f'stats.{field}': -stats[field] for field in ('entries', *ENTRY_TYPES, 'bytes') if stats[field]},
+        'version': 1
+    }})
+    # The newest entry is gone, so look up the one before it
+    index = Index.get_collection().find_one({'_id': entry['index_id']})
+    last_entry_at = ((index or {}).get('stats') or {}).get('last_entry_at')
+    if last_entry_at is not None and last_entry_at <= entry['created_at']:
+        Index.get_collection().update_one(
+            {'_id': entry['index_id']},
+            {'$set': {'stats.last_entry_at': _last_entry_at(entry['index_id'])}}
+        )
+
+def _update_stats(index_id: ObjectId, update: Dict) -> None:
+    """Apply an update to an index's statistics, or count them if it has none yet"""
+    indexes = Index.get_collection()
+    # An $inc would start partial stats on an index created before they were kept
+    if indexes.update_one({'_id': index_id, 'stats': {'$exists': True}}, update):
+        return
+    if indexes.update_one({'_id': index_id, 'stats': {'$exists': False}}, {'$inc': {'version': 1}}):
+        # The write is already in the entries, so counting them takes it in
+        rebuild_stats(index_id)
+
+def _last_entry_at(index_id: ObjectId) -> Optional[datetime]:
+    newest = Entry.find_by_index(index_id, limit=1)
+    return newest[0]['created_at'] if newest else None
+
+def rebuild_stats(index_id: ObjectId, batch_size: int = 1000) -> Dict[str, Any]:
+    """Recompute an index's statistics from its entries"""
+    stats = empty_stats()
+    after = None
+    while True:
+        batch = Entry.find_after(index_id, after=after, limit=batch_size)
+        batch_stats = _entry_stats(batch)
+        for field in ('entries', *ENTRY_TYPES, 'bytes'):
+            stats[field] += batch_stats[field]
+        if batch_stats['last_entry_at'] is not None and (
+                stats['last_entry_at'] is None or batch_stats['last_entry_at'] > stats['last_entry_at']):
+            stats['last_entry_at'] = batch_stats['last_entry_at']
+        if len(batch) < batch_size:
+            break
+        after = batch[-1]['_id']
+    Index.get_collection().update_one({'_id': index_id}, {'$set': {'stats': stats}})
+    return stats
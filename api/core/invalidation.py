@@ -0,0 +1,190 @@
+"""Invalidation of per-process caches across workers and nodes.
+
+Caches a process keeps (entry documents, index owners) go stale when
+another process changes what they hold. Writers publish the tags of what
+they changed (user:<id>, index:<id>, entry:<id>) to a capped
+invalidations collection, and a listener thread in each process drops
+its cached values carrying those tags. The listener follows a change
+stream where the deployment offers one (replica sets) and otherwise
+polls the collection every INVALIDATION_POLL_INTERVAL seconds. Cached
+values also expire after CACHE_TTL seconds, which bounds how stale they
+get should the listener fall behind or lose its connection.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set
+
+from flask import current_app, has_app_context
+
+from .capped_log import CappedLog
+from .metrics import CACHE_INVALIDATIONS, CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+INVALIDATIONS_COLLECTION = 'invalidations'
+
+_MISSING = object()
+
+def user_tag(user_id: Any) -> str:
+    return f'user:{user_id}'
+
+def index_tag(index_id: Any) -> str:
+    return f'index:{index_id}'
+
+def entry_tag(entry_id: Any) -> str:
+    return f'entry:{entry_id}'
+
+class LocalCache:
+    """Least recently used values with tags, each kept for at most ttl seconds.
+
+    Cached values are shared between threads, so callers must not modify them.
+    """
+
+    def __init__(self, name: str, size: int = 10000, ttl: float = 30.0):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        # key -> (value, expiry, tags)
+        self._values: OrderedDict = OrderedDict()
+        self._keys_by_tag: Dict[str, Set[Hashable]] = {}
+        # Bumped by every invalidation, so a value loaded before one is not stored after it
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is None or cached[1] <= time.monotonic():
+                if cached is not None:
+                    self._drop(key)
+                CACHE_LOOKUPS.inc(1, self.name, 'miss')
+                return default
+            self._values.move_to_end(key)
+            CACHE_LOOKUPS.inc(1, self.name, 'hit')
+            return cached[0]
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str], generation: Optional[int] = None) -> None:
+        """Cache a value, unless an invalidation happened since generation"""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._values:
+                self._drop(key)
+            tags = tuple(tags)
+            self._values[key] = (value, time.monotonic() + self.ttl, tags)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._values) > self.size:
+                self._drop(next(iter(self._values)))
+
+    def fetch(self, key: Hashable, load: Callable[[], Any], tags: Callable[[Any], Iterable[str]]) -> Any:
+        """Cached value of a key, loading and caching it when missing; None is not cached"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self._generation
+        value = load()
+        if value is not None:
+            self.set(key, value, tags(value), generation)
+        return value
+
+    def invalidate(self, tags: Iterable[str]) -> int:
+        """Drop the values carrying any of the tags, returning how many were dropped"""
+        dropped = 0
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._drop(key)
+                    dropped += 1
+        return dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._values.clear()
+            self._keys_by_tag.clear()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _drop(self, key: Hashable) -> None:
+        _, _, tags = self._values.pop(key)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+class InvalidationBus(CappedLog):
+    """Publishes invalidation events and applies those of other processes to local caches"""
+
+    def __init__(self, mode: Optional[str] = 'auto', poll_interval: float = 1.0,
+                 log_size: int = 16 * 1024 * 1024):
+        super().__init__(INVALIDATIONS_COLLECTION, mode, poll_interval, log_size)
+        self.caches: List[LocalCache] = []
+
+    @classmethod
+    def from_config(cls, app) -> 'InvalidationBus':
+        return cls(
+            mode=app.config['INVALIDATION_MODE'],
+            poll_interval=app.config['INVALIDATION_POLL_INTERVAL'],
+            log_size=app.config['INVALIDATION_LOG_SIZE']
+        )
+
+    def register(self, cache: LocalCache) -> LocalCache:
+        self.caches.append(cache)
+        return cache
+
+    def apply(self, tags: Iterable[str]) -> None:
+        tags = list(tags)
+        for cache in self.caches:
+            cache.invalidate(tags)
+
+    def reset(self) -> None:
+        # Events may have been missed, so nothing cached can be trusted
+        for cache in self.caches:
+            cache.clear()
+
+    def handle(self, event: Dict, source: str) -> bool:
+        if event.get('origin') == self.origin:
+            return False
+        self.apply(event['tags'])
+        CACHE_INVALIDATIONS.inc(1, source)
+        return True
+
+    def publish(self, *tags: str) -> None:
+        """Invalidate tags in this process and tell the others"""
+        self.apply(tags)
+        try:
+            self.append([{'tags': list(tags)}])
+        except Exception:
+            # Other processes catch up when their cached values expire
+            logger.exception('Failed to publish invalidation of %s', ', '.join(tags))
+
+def invalidate(*tags: str) -> None:
+    """Drop cached values carrying any of the tags, in every process"""
+    if has_app_context() and 'invalidation' in current_app.extensions:
+        current_app.extensions['invalidation'].publish(*tags)
+
+def local_cache(name: str) -> LocalCache:
+    """One of the app's per-process caches"""
+    return current_app.extensions['caches'][name]
+
+def init_invalidation(app) -> None:
+    """Register the per-process caches and their invalidation bus with the Flask app.
+
+    The listener thread is started by the first request a process serves,
+    so workers forked from a preloaded app get their own.
+    """
+    bus = InvalidationBus.from_config(app)
+    app.extensions['invalidation'] = bus
+    app.extensions['caches'] = {
+        name: bus.register(LocalCache(name, app.config['CACHE_SIZE'], app.config['CACHE_TTL']))
+        for name in ('entries', 'index_owners', 'tenant_partitions')
+    }
+    if bus.mode is not None:
+        app.before_request(bus.start)
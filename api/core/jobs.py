@@ -0,0 +1,266 @@
+"""Durable background jobs kept in the jobs collection.
+
+A job is claimed atomically by one worker, which holds a lease on it and
+renews the lease while the handler runs. A worker that dies loses its
+lease, and the job is claimed again once the lease expires, so handlers
+must be safe to run more than once. Failed jobs are retried with
+exponential backoff until max_attempts, then kept with status 'failed'.
+Finished jobs are deleted.
+
+Workers run from the CLI (flask admin jobs-worker) or as threads inside
+the web process (JOBS_WORKERS).
+"""
+import importlib
+import logging
+import os
+import random
+import socket
+import threading
+from datetime import datetime, timedelta, UTC
+from typing import Any, Callable, Dict, List, Optional
+
+from .database import PartitionedDatabase, current_tenant, get_database, tenant_context
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Job kinds and the functions that run them, taking the job's payload
+HANDLERS: Dict[str, Callable[[Dict], None]] = {}
+
+# Modules registering handlers, imported when a worker is set up
+HANDLER_MODULES = ('api.core.renditions', 'api.core.keywords', 'api.core.quota', 'api.core.garbage',
+                   'api.core.fsck')
+
+def job_handler(kind: str):
+    """Register the function that runs jobs of a kind"""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+def enqueue(kind: str, payload: Optional[Dict] = None, priority: int = 0,
+            delay: float = 0, max_attempts: int = 5, tenant: Any = None) -> Dict:
+    """Queue a job. Higher priorities are claimed first.
+    
+    The job runs against the partition of tenant, by default the current one.
+    """
+    return Job.create(
+        kind=kind,
+        payload=payload or {},
+        priority=priority,
+        run_at=datetime.now(UTC) + timedelta(seconds=delay),
+        max_attempts=max_attempts,
+        tenant=tenant if tenant is not None else current_tenant()
+    )
+
+def claim(worker_id: str, lease_seconds: float, kinds: Optional[List[str]] = None) -> Optional[Dict]:
+    """Claim the most urgent due job, or one whose lease has expired"""
+    now = datetime.now(UTC)
+    query = {'$or': [
+        {'status': 'queued', 'run_at': {'$lte': now}},
+        {'status': 'running', 'lease_until': {'$lt': now}}
+    ]}
+    if kinds:
+        query['kind'] = {'$in': list(kinds)}
+    return Job.get_collection().find_one_and_update(
+        query,
+        {
+            '$set': {
+                'status': 'running',
+                'worker': worker_id,
+                'lease_until': now + timedelta(seconds=lease_seconds)
+            },
+            '$inc': {'attempts': 1}
+        },
+        sort=[('priority', -1), ('run_at', 1)]
+    )
+
+def renew(job: Dict, worker_id: str, lease_seconds: float) -> bool:
+    """Extend a job's lease, returning False if the worker no longer holds it"""
+    return Job.get_collection().update_one(
+        {'_id': job['_id'], 'status': 'running', 'worker': worker_id},
+        {'$set': {'lease_until': datetime.now(UTC) + timedelta(seconds=lease_seconds)}}
+    )
+
+def complete(job: Dict, worker_id: str) -> bool:
+    """Remove a finished job"""
+    return Job.get_collection().delete_one(
+        {'_id': job['_id'], 'status': 'running', 'worker': worker_id}
+    )
+
+def backoff(attempts: int, base: float, maximum: float) -> float:
+    """Seconds before retry number attempts, doubling each time with jitter"""
+    delay = min(base * 2 ** (attempts - 1), maximum)
+    return delay * random.uniform(0.5, 1.0)
+
+def fail(job: Dict, worker_id: str, error: str, retry_in: float) -> bool:
+    """Record a failed attempt, retrying later unless attempts are used up"""
+    update: Dict[str, Any] = {'last_error': error}
+    if job['attempts'] >= job['max_attempts']:
+        update.update(status='failed', failed_at=datetime.now(UTC))
+    else:
+        update.update(status='queued', run_at=datetime.now(UTC) + timedelta(seconds=retry_in))
+    return Job.get_collection().update_one(
+        {'_id': job['_id'], 'status': 'running', 'worker': worker_id},
+        {'$set': update, '$unset': {'worker': '', 'lease_until': ''}}
+    )
+
+def retry_failed(kind: Optional[str] = None) -> int:
+    """Queue failed jobs again with a fresh set of attempts"""
+    query = {'status': 'failed'}
+    if kind:
+        query['kind'] = kind
+    return Job.get_collection().update_many(query, {
+        '$set': {'status': 'queued', 'attempts': 0, 'run_at': datetime.now(UTC)},
+        '$unset': {'failed_at': ''}
+    })
+
+def job_counts() -> Dict[str, Dict[str, int]]:
+    """Number of jobs by kind and status"""
+    counts: Dict[str, Dict[str, int]] = {}
+    for kind in set(HANDLERS) | {job['kind'] for job in Job.get_collection().find_many({})}:
+        counts[kind] = {
+            status: Job.get_collection().count_documents({'kind': kind, 'status': status})
+            for status in ('queued', 'running', 'failed')
+        }
+    return counts
+
+class JobWorker:
+    """Claims and runs jobs, on the calling thread or on background threads.
+
+    The app is pushed as the application context of every handler call.
+    """
+
+    def __init__(self, app, kinds: Optional[List[str]] = None, threads: int = 1,
+                 lease_seconds: float = 60, poll_interval: float = 1.0,
+                 backoff_base: float = 5, backoff_max: float = 3600):
+        self.app = app
+        self.kinds = kinds
+        self.threads = threads
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, app, **options) -> 'JobWorker':
+        config = app.config
+        settings = {
+            'threads': config.get('JOBS_WORKERS', 1),
+            'lease_seconds': config.get('JOBS_LEASE_SECONDS', 60),
+            'poll_interval': config.get('JOBS_POLL_INTERVAL', 1.0),
+            'backoff_base': config.get('JOBS_BACKOFF_BASE', 5),
+            'backoff_max': config.get('JOBS_BACKOFF_MAX', 3600)
+        }
+        settings.update(options)
+        return cls(app, **settings)
+
+    def worker_id(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+    def run_once(self) -> bool:
+        """Claim and run one job, returning False when none was due"""
+        worker_id = self.worker_id()
+        job = claim(worker_id, self.lease_seconds, self.kinds)
+        if job is None:
+            return False
+        self._execute(job, worker_id)
+        return True
+
+    def drain(self, limit: int = 1000) -> int:
+        """Run due jobs on the calling thread until none are left"""
+        ran = 0
+        while ran < limit and self.run_once():
+            ran += 1
+        return ran
+
+    def _execute(self, job: Dict, worker_id: str) -> None:
+        # A job whose worker keeps dying is given up once its attempts are used
+        if job['attempts'] > job['max_attempts']:
+            fail(job, worker_id, job.get('last_error') or 'Lease expired', 0)
+            return
+        handler = HANDLERS.get(job['kind'])
+        # Keep the lease while the handler runs
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, worker_id, done),
+                                     name='jobs-heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job kind {job['kind']}")
+            with self.app.app_context(), tenant_context(job.get('tenant')):
+                db = get_database()
+                if job.get('tenant') is not None and isinstance(db, PartitionedDatabase) \
+                        and db.is_moving(job['tenant']):
+                    raise RuntimeError('Tenant is being moved to another partition')
+                handler(job['payload'])
+        except Exception as e:
+            logger.exception('Job %s (%s) failed on attempt %d', job['_id'], job['kind'], job['attempts'])
+            fail(job, worker_id, f'{type(e).__name__}: {e}',
+                 backoff(job['attempts'], self.backoff_base, self.backoff_max))
+        else:
+            complete(job, worker_id)
+        finally:
+            done.set()
+            heartbeat.join()
+
+    def _heartbeat(self, job: Dict, worker_id: str, done: threading.Event) -> None:
+        while not done.wait(self.lease_seconds / 3):
+            if not renew(job, worker_id, self.lease_seconds):
+                logger.warning('Lost the lease on job %s (%s)', job['_id'], job['kind'])
+                return
+
+    def run(self) -> None:
+        """Run jobs until stopped, polling when the queue is empty"""
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                logger.exception('Failed to claim a job')
+            self._stop.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """Run jobs on background threads of this process"""
+        if self._pid == os.getpid() and self._threads:
+            return
+        with self._lock:
+            # Threads do not survive a fork, so a forked worker starts its own
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self.run, name=f'jobs-{i}', daemon=True)
+                for i in range(self.threads)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the worker is asked to stop"""
+        return self._stop.wait(timeout)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the background threads once their current jobs finish"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+def init_jobs(app) -> None:
+    """Register the job worker with the Flask app.
+
+    With JOBS_WORKERS set, worker threads are started by the first request
+    a process serves, so workers forked from a preloaded app get their own.
+    """
+    for module in HANDLER_MODULES:
+        importlib.import_module(module)
+    worker = JobWorker.from_config(app)
+    app.extensions['jobs'] = worker
+    if worker.threads > 0:
+        app.before_request(worker.start)
@@ -0,0 +1,202 @@
+"""Keywords extracted from the text of entries after they are written.
+
+Text entries and text-bearing files (plain text, markdown and, when pypdf
+is installed, the text layer of PDFs) are tokenized, stopwords are dropped
+and the remaining terms are ranked by TF-IDF. Document frequencies are kept
+per index in the term_stats collection. The best terms are merged into the
+entry's keywords, so keyword search can use the (user_id, keywords) index.
+
+Only the KEYWORD_MAX_TERMS most frequent terms of an entry are counted in
+the index statistics. They are recorded on the entry as terms, so the
+counts can be taken back when the entry is deleted.
+"""
+import io
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from .database import get_file_storage
+from .invalidation import entry_tag, invalidate
+from .jobs import enqueue, job_handler
+from .models import Entry, Index, TermStats
+
+_TOKEN = re.compile(r'[^\W\d_]{3,40}', re.UNICODE)
+
+STOPWORDS = frozenset('''
+about above after again against all also and any are aren because been before being
+below between both but can cannot could did didn does doesn doing don down during each
+few for from further had hadn has hasn have haven having her here hers herself him
+himself his how however into isn its itself just let more most much must mustn myself
+nor not now off once only other ought our ours ourselves out over own same shall shan
+she should shouldn some such than that the their theirs them themselves then there
+these they this those through too under until upon very was wasn were weren what when
+where which while who whom why will with won would wouldn you your yours yourself
+yourselves yes yet
+'''.split())
+
+# Content types read as text, besides text/*
+TEXT_TYPES = {'application/json', 'application/xml', 'application/x-markdown'}
+TEXT_EXTENSIONS = ('.txt', '.md', '.markdown', '.rst', '.csv')
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words of a text, without stopwords"""
+    return [word for word in _TOKEN.findall(text.lower()) if word not in STOPWORDS]
+
+def _load_pypdf():
+    """Import pypdf on first use, returning None when it is not installed"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    return PdfReader
+
+def is_text_file(content_type: str, filename: str) -> bool:
+    """Check whether a file's text can be extracted"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type.startswith('text/') or content_type in TEXT_TYPES:
+        return True
+    if content_type == 'application/pdf':
+        return _load_pypdf() is not None
+    return (filename or '').lower().endswith(TEXT_EXTENSIONS)
+
+def entry_text(entry: Dict, max_bytes: int, max_pdf_bytes: int) -> Optional[str]:
+    """Text to extract keywords from, or None for entries without text"""
+    if entry['type'] == 'text':
+        return entry.get('content') or ''
+    metadata = entry.get('metadata') or {}
+    content_type = metadata.get('content_type') or ''
+    if entry['type'] != 'file' or not is_text_file(content_type, metadata.get('filename')):
+        return None
+
+    stream, length, _, _ = get_file_storage().open_file(str(entry['file_id']))
+    try:
+        if content_type.startswith('application/pdf'):
+            if length > max_pdf_bytes:
+                return None
+            reader = _load_pypdf()(io.BytesIO(stream.read()))
+            text, size = [], 0
+            for page in reader.pages:
+                page_text = page.extract_text() or ''
+                text.append(page_text)
+                size += len(page_text)
+                if size >= max_bytes:
+                    break
+            return '\n'.join(text)[:max_bytes]
+        # Long files are judged by their beginning
+        return stream.read(max_bytes).decode('utf-8', errors='ignore')
+    finally:
+        stream.close()
+
+def rank_terms(counts: Counter, document_frequencies: Dict[str, int], documents: int,
+               limit: int) -> List[str]:
+    """The limit best terms by TF-IDF, with smoothed inverse document frequency"""
+    total = sum(counts.values())
+    scores = {
+        term: count / total * (math.log((1 + documents) / (1 + document_frequencies.get(term, 0))) + 1)
+        for term, count in counts.items()
+    }
+    return sorted(scores, key=lambda term: (-scores[term], term))[:limit]
+
+def _document_frequencies(index_id: ObjectId, terms: List[str]) -> Dict[str, int]:
+    stats = TermStats.get_collection().find_many({'index_id': index_id, 'term': {'$in': terms}})
+    return {stat['term']: stat['df'] for stat in stats}
+
+def _count_terms(index_id: ObjectId, terms: List[str], delta: int) -> None:
+    """Add delta to the document frequency of terms and to the index's document count"""
+    TermStats.get_collection().bulk_update(
+        [({'index_id': index_id, 'term': term}, {'$inc': {'df': delta}}) for term in terms],
+        upsert=True
+    )
+    Index.get_collection().update_one({'_id': index_id}, {'$inc': {'analyzed_entries': delta}})
+
+def extract_keywords(entry_id: ObjectId, config) -> List[str]:
+    """Extract the keywords of an entry and merge them into its keywords"""
+    entry = Entry.get_collection().find_one({'_id': entry_id})
+    if entry is None or ('terms' in entry and 'extracted_keywords' in entry):
+        return []
+    text = entry_text(entry, config['KEYWORD_MAX_TEXT_BYTES'], config['KEYWORD_MAX_PDF_BYTES'])
+    if text is None:
+        return []
+
+    counts = Counter(tokenize(text))
+    if 'terms' in entry:
+        # Counted by an attempt that failed before storing the keywords
+        terms = entry['terms']
+    else:
+        terms = [term for term, _ in counts.most_common(config['KEYWORD_MAX_TERMS'])]
+        # Claim the entry so a retried job does not count its terms twice
+        if not Entry.get_collection().update_one({'_id': entry_id, 'terms': {'$exists': False}},
+                                                 {'$set': {'terms': terms}}):
+            return []
+        if terms:
+            try:
+                _count_terms(entry['index_id'], terms, 1)
+            except Exception:
+                # Give the claim back so the retry counts them
+                Entry.get_collection().update_one({'_id': entry_id}, {'$unset': {'terms': ''}})
+                raise
+    if not terms:
+        Entry.get_collection().update_one({'_id': entry_id}, {'$set': {'extracted_keywords': []}})
+        return []
+
+    index = Index.get_collection().find_one({'_id': entry['index_id']}) or {}
+    keywords = rank_terms(
+        Counter({term: counts[term] for term in terms}),
+        _document_frequencies(entry['index_id'], terms),
+        index.get('analyzed_entries', 1),
+        config['KEYWORD_LIMIT']
+    )
+    Entry.get_collection().update_one({'_id': entry_id}, {
+        '$addToSet': {'keywords': {'$each': keywords}},
+        '$set': {'extracted_keywords': keywords}
+    })
+    # Search results changed, so counts cached for the index are stale
+    Index.get_collection().update_one({'_id': entry['index_id']}, {'$inc': {'version': 1}})
+    invalidate(entry_tag(entry_id))
+    return keywords
+
+def schedule_keywords(app, entry: Dict) -> None:
+    """Queue keyword extraction for a newly created entry"""
+    if app.config.get('KEYWORDS_ENABLED'):
+        enqueue('keywords.extract', {'entry_id': entry['_id']})
+
+def schedule_keyword_backfill(index_id: Optional[ObjectId] = None, batch_size: int = 1000) -> int:
+    """Queue keyword extraction for the entries of the current partition not fully analyzed"""
+    query: Dict = {'extracted_keywords': {'$exists': False}, 'type': {'$in': ['text', 'file']}}
+    if index_id is not None:
+        query['index_id'] = index_id
+    queued = 0
+    after = None
+    while True:
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        batch = Entry.get_collection().find_many(query, sort=[('_id', 1)], limit=batch_size,
+                                                 fields=['user_id'])
+        if not batch:
+            return queued
+        after = batch[-1]['_id']
+        for entry in batch:
+            # Background work, behind extraction of new entries
+            enqueue('keywords.extract', {'entry_id': entry['_id']}, priority=-10, tenant=entry['user_id'])
+        queued += len(batch)
+
+def forget_keywords(entry: Dict) -> None:
+    """Queue removal of a deleted entry from its index's term statistics"""
+    if entry.get('terms'):
+        enqueue('keywords.forget', {'index_id': entry['index_id'], 'terms': entry['terms']})
+
+@job_handler('keywords.extract')
+def extract_keywords_job(payload: Dict) -> None:
+    """Job: extract the keywords of an entry"""
+    extract_keywords(ObjectId(payload['entry_id']), current_app.config)
+
+@job_handler('keywords.forget')
+def forget_keywords_job(payload: Dict) -> None:
+    """Job: take a deleted entry's terms out of the index statistics"""
+    index_id = ObjectId(payload['index_id'])
+    _count_terms(index_id, payload['terms'], -1)
+    TermStats.get_collection().delete_many({'index_id': index_id, 'df': {'$lte': 0}})
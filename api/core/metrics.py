@@ -0,0 +1,217 @@
+import bisect
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from flask import Response, g, request
+from pymongo import monitoring
+
+# Every metric registers itself here for exposition
+REGISTRY: List['Metric'] = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    # Metrics are kept per process, so each worker's series are told apart by pid
+    pairs = [f'pid="{os.getpid()}"']
+    pairs += [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}'
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base class for labelled metrics.
+
+    Each metric keeps one dict of label values to state, updated under a
+    short per-metric lock so collection is cheap enough to leave on.
+    """
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            items = [(labels, self._snapshot(value)) for labels, value in self._values.items()]
+        for labels, value in sorted(items):
+            lines.extend(self._render_sample(labels, value))
+        return lines
+
+    def _snapshot(self, value):
+        return value
+
+    def _render_sample(self, labels, value) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}']
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """Value that goes up and down"""
+    type_name = 'gauge'
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels: str) -> None:
+        self.inc(-amount, *labels)
+
+class Histogram(Metric):
+    """Distribution of observations in fixed buckets"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), then the sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def _snapshot(self, value):
+        return list(value)
+
+    def _render_sample(self, labels, value) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value[:-1]):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _format_value(bound)
+            bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+            lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(value[-1])}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+def render_metrics() -> str:
+    """Render all registered metrics in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# HTTP metrics
+REQUESTS = Counter('http_requests_total', 'HTTP requests handled',
+                   ('blueprint', 'route', 'method', 'status'))
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request latency',
+                             ('blueprint', 'route', 'method'))
+REQUEST_SIZE = Histogram('http_request_size_bytes', 'HTTP request body size',
+                         ('blueprint', 'route'), buckets=SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes', 'HTTP response body size',
+                          ('blueprint', 'route'), buckets=SIZE_BUCKETS)
+IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being handled', ('blueprint', 'route'))
+
+# Database metrics
+MONGO_COMMAND_DURATION = Histogram('mongodb_command_duration_seconds', 'MongoDB command latency',
+                                   ('collection', 'command'))
+MONGO_COMMAND_FAILURES = Counter('mongodb_command_failures_total', 'Failed MongoDB commands',
+                                 ('collection', 'command'))
+GRIDFS_BYTES_WRITTEN = Counter('gridfs_bytes_written_total', 'Bytes written to GridFS')
+GRIDFS_BYTES_READ = Counter('gridfs_bytes_read_total', 'Bytes read from GridFS')
+COALESCED_BATCH_SIZE = Histogram('coalesced_insert_batch_size', 'Documents per coalesced insert_many',
+                                 ('collection',), buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# Cache metrics
+CACHE_LOOKUPS = Counter('local_cache_lookups_total', 'Lookups in per-process caches', ('cache', 'result'))
+CACHE_INVALIDATIONS = Counter('cache_invalidation_events_total',
+                              'Invalidation events applied from other processes', ('source',))
+
+def command_collection(event) -> Optional[str]:
+    """Collection a MongoDB command runs against, if any"""
+    if event.command_name == 'getMore':
+        return event.command.get('collection')
+    target = event.command.get(event.command_name)
+    return target if isinstance(target, str) else None
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Record per-collection MongoDB command latencies"""
+
+    def __init__(self):
+        # Collection of each command in flight, keyed by connection and request
+        self._pending: Dict[tuple, str] = {}
+
+    def started(self, event):
+        collection = command_collection(event)
+        if collection:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection:
+            MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection:
+            MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, collection, event.command_name)
+            MONGO_COMMAND_FAILURES.inc(1, collection, event.command_name)
+
+def _route_labels() -> Tuple[str, str]:
+    """Label the request by blueprint and URL rule (never the raw path)"""
+    rule = request.url_rule.rule if request.url_rule else '<unmatched>'
+    return request.blueprint or '', rule
+
+def _start_request() -> None:
+    g.metrics_started = time.perf_counter()
+    g.metrics_labels = _route_labels()
+    IN_FLIGHT.inc(1, *g.metrics_labels)
+
+def _record_response(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        blueprint, route = g.metrics_labels
+        REQUEST_DURATION.observe(time.perf_counter() - started, blueprint, route, request.method)
+        REQUESTS.inc(1, blueprint, route, request.method, str(response.status_code))
+        REQUEST_SIZE.observe(request.content_length or 0, blueprint, route)
+        if response.content_length is not None:
+            RESPONSE_SIZE.observe(response.content_length, blueprint, route)
+    return response
+
+def _finish_request(exc=None) -> None:
+    labels = g.pop('metrics_labels', None)
+    if labels is not None:
+        IN_FLIGHT.dec(1, *labels)
+
+def metrics():
+    """Expose metrics in the Prometheus text format"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def init_metrics(app) -> None:
+    """Register request metrics and the /metrics endpoint with the Flask app.
+
+    Must run before other before_request hooks, which may reject the
+    request before it is counted.
+    """
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    app.before_request(_start_request)
+    app.after_request(_record_response)
+    app.teardown_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
@@ -1,14 +1,34 @@
 from datetime import datetime, UTC
-from typing import List, Optional, Dict, Any
+from typing import List, Mapping, Optional, Dict, Any, Sequence
 from pymongo import ASCENDING, DESCENDING
+from bson import decode
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
 
 from .database import CollectionInterface, get_database
 
 class BaseModel:
-    """Base model with common functionality"""
+    """Base model with common functionality.
+    
+    User, Index and Entry keep their fields in __slots__, so the many
+    instances of a listing stay small, and from_document builds them from
+    stored documents. id holds the document's _id.
+    """
+    __slots__ = ()
     collection_name: str = None
     
+    @classmethod
+    def from_document(cls, document: Mapping) -> 'BaseModel':
+        """Model of a stored document, holding the fields the model has"""
+        model = cls.__new__(cls)
+        for field in cls.__slots__:
+            value = document.get('_id' if field == 'id' else field)
+            if isinstance(value, RawBSONDocument):
+                # Raw documents decode their fields on first access, nested documents stay raw
+                value = decode(value.raw)
+            setattr(model, field, value)
+        return model
+    
     @classmethod
     def get_collection(cls) -> CollectionInterface:
         if not cls.collection_name:
@@ -25,9 +45,12 @@ class BaseModel:
 
 class User(BaseModel):
     """User model"""
+    __slots__ = ('id', 'username', 'password_hash', 'usage', 'created_at')
     collection_name = 'users'
     
     def __init__(self, username: str, password_hash: str):
+        self.id = None
+        self.usage = {'bytes': 0, 'files': 0, 'entries': 0}
         self.username = username.lower()  # Store usernames in lowercase
         self.password_hash = password_hash
         self.created_at = datetime.now(UTC)
@@ -37,6 +60,7 @@ class User(BaseModel):
         return {
             'username': self.username,
             'password_hash': self.password_hash,
+            'usage': dict(self.usage),
             'created_at': self.created_at
         }
     
@@ -58,9 +82,14 @@ class User(BaseModel):
 
 class Index(BaseModel):
     """Index model"""
+    __slots__ = ('id', 'user_id', 'name', 'description', 'stats', 'created_at')
     collection_name = 'indexes'
+    # Fields index listings return
+    API_FIELDS = ('name', 'description', 'stats')
     
     def __init__(self, user_id: ObjectId, name: str, description: str = ''):
+        self.id = None
+        self.stats = {'entries': 0, 'text': 0, 'file': 0, 'bytes': 0}
         self.user_id = user_id
         self.name = name.strip()
         self.description = description.strip()
@@ -72,17 +101,20 @@ class Index(BaseModel):
             'user_id': self.user_id,
             'name': self.name,
             'description': self.description,
+            'stats': dict(self.stats),
             'created_at': self.created_at
         }
     
     @classmethod
-    def find_by_user(cls, user_id: ObjectId, skip: int = 0, limit: int = 0) -> List[Dict]:
+    def find_by_user(cls, user_id: ObjectId, skip: int = 0, limit: int = 0,
+                     fields: Optional[Sequence[str]] = None) -> List[Dict]:
         """Find all indexes for a user"""
         return cls.get_collection().find_many(
             {'user_id': user_id},
             sort=[('created_at', DESCENDING)],
             skip=skip,
-            limit=limit
+            limit=limit,
+            fields=fields
         )
     
     @classmethod
@@ -96,11 +128,15 @@ class Index(BaseModel):
 
 class Entry(BaseModel):
     """Entry model"""
+    __slots__ = ('id', 'index_id', 'user_id', 'type', 'content', 'file_id', 'metadata', 'keywords', 'created_at')
     collection_name = 'entries'
+    # Fields to_json reads
+    API_FIELDS = ('type', 'content', 'file_id', 'metadata', 'keywords', 'created_at')
     
     def __init__(self, index_id: ObjectId, user_id: ObjectId, type: str, 
                  content: Optional[str] = None, file_id: Optional[ObjectId] = None,
                  metadata: Optional[Dict] = None, keywords: Optional[List[str]] = None):
+        self.id = None
         self.index_id = index_id
         self.user_id = user_id
         self.type = type
@@ -126,16 +162,39 @@ class Entry(BaseModel):
             entry_dict['file_id'] = self.file_id
         return entry_dict
     
+    def to_json(self) -> Dict[str, Any]:
+        """Entry fields returned by the API"""
+        return {
+            'id': str(self.id),
+            'type': self.type,
+            'content': self.content,
+            'file_id': str(self.file_id) if self.file_id else None,
+            'metadata': self.metadata,
+            'keywords': self.keywords or [],
+            'created_at': self.created_at.isoformat()
+        }
+    
     @classmethod
-    def find_by_index(cls, index_id: ObjectId, skip: int = 0, limit: int = 0) -> List[Dict]:
+    def find_by_index(cls, index_id: ObjectId, skip: int = 0, limit: int = 0,
+                      fields: Optional[Sequence[str]] = None) -> List[Dict]:
         """Find all entries in an index"""
         return cls.get_collection().find_many(
             {'index_id': index_id},
             sort=[('created_at', DESCENDING)],
             skip=skip,
-            limit=limit
+            limit=limit,
+            fields=fields
         )
     
+    @classmethod
+    def find_after(cls, index_id: ObjectId, after: Optional[ObjectId] = None,
+                   limit: int = 0) -> List[Dict]:
+        """Find entries in an index in _id order, starting after an entry ID"""
+        query = {'index_id': index_id}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        return cls.get_collection().find_many(query, sort=[('_id', ASCENDING)], limit=limit)
+
     @classmethod
     def search(cls, index_id: ObjectId, query: str, skip: int = 0, limit: int = 0) -> List[Dict]:
         """Search entries in an index"""
@@ -174,4 +233,97 @@ class Entry(BaseModel):
         data = entry.to_dict()
         data['_id'] = ObjectId()
         cls.get_collection().insert_one(data)
-        return data
\ No newline at end of file
+        return data
+
+class UploadSession(BaseModel):
+    """Upload session model: a file uploaded in numbered chunks"""
+    collection_name = 'upload_sessions'
+    
+    def __init__(self, index_id: ObjectId, user_id: ObjectId, filename: str, content_type: str,
+                 size: int, chunk_size: int, expires_at: datetime,
+                 keywords: Optional[List[str]] = None):
+        self.index_id = index_id
+        self.user_id = user_id
+        self.file_id = ObjectId()
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_count = -(-size // chunk_size)
+        self.keywords = keywords or []
+        self.created_at = datetime.now(UTC)
+        self.expires_at = expires_at
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert upload session to dictionary for storage"""
+        return {
+            'index_id': self.index_id,
+            'user_id': self.user_id,
+            'file_id': self.file_id,
+            'filename': self.filename,
+            'content_type': self.content_type,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunk_count': self.chunk_count,
+            'received': [],
+            'keywords': self.keywords,
+            'status': 'open',
+            'created_at': self.created_at,
+            'expires_at': self.expires_at
+        }
+    
+    @classmethod
+    def create(cls, **kwargs) -> Dict:
+        """Create a new upload session"""
+        data = cls(**kwargs).to_dict()
+        data['_id'] = ObjectId()
+        cls.get_collection().insert_one(data)
+        return data
+    
+    @classmethod
+    def find_for_user(cls, session_id: ObjectId, user_id: ObjectId) -> Optional[Dict]:
+        """Find an upload session owned by a user"""
+        return cls.get_collection().find_one({'_id': session_id, 'user_id': user_id})
+
+class TermStats(BaseModel):
+    """Term statistics model: how many entries of an index contain a term.
+    
+    Documents are {index_id, term, df}, maintained by keyword extraction.
+    """
+    collection_name = 'term_stats'
+
+class Job(BaseModel):
+    """Job model: a unit of background work"""
+    collection_name = 'jobs'
+    
+    def __init__(self, kind: str, payload: Dict, priority: int, run_at: datetime,
+                 max_attempts: int, tenant: Optional[ObjectId] = None):
+        self.kind = kind
+        self.payload = payload
+        self.priority = priority
+        self.run_at = run_at
+        self.max_attempts = max_attempts
+        self.tenant = tenant
+        self.created_at = datetime.now(UTC)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert job to dictionary for storage"""
+        return {
+            'kind': self.kind,
+            'payload': self.payload,
+            'priority': self.priority,
+            'status': 'queued',
+            'attempts': 0,
+            'max_attempts': self.max_attempts,
+            'run_at': self.run_at,
+            'tenant': self.tenant,
+            'created_at': self.created_at
+        }
+    
+    @classmethod
+    def create(cls, **kwargs) -> Dict:
+        """Create a new job"""
+        data = cls(**kwargs).to_dict()
+        data['_id'] = ObjectId()
+        cls.get_collection().insert_one(data)
+        return data
@@ -0,0 +1,85 @@
+"""Total counts and pagination headers for list endpoints.
+
+Totals come from materialized counters where one exists. Otherwise the
+matching documents are counted, at most COUNT_LIMIT of them, so a broad
+filter over a large index costs a bounded amount; past the limit the
+total is reported as a lower bound. Counts of filtered entry queries are
+cached per process, keyed by the index version, which every entry write
+increments, so a cached count is never stale.
+"""
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from urllib.parse import urlencode
+
+from flask import request
+
+from .database import CollectionInterface
+
+class CountCache:
+    """Least recently used counts"""
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self._counts: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Tuple[int, bool]]:
+        with self._lock:
+            if key not in self._counts:
+                return None
+            self._counts.move_to_end(key)
+            return self._counts[key]
+
+    def set(self, key: Hashable, value: Tuple[int, bool]) -> None:
+        with self._lock:
+            self._counts[key] = value
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.size:
+                self._counts.popitem(last=False)
+
+def bounded_count(collection: CollectionInterface, query: Dict, limit: int) -> Tuple[int, bool]:
+    """Count matching documents up to limit, returning the count and whether it is exact"""
+    count = collection.count_documents(query, limit=limit + 1)
+    if count > limit:
+        return limit, False
+    return count, True
+
+def cached_count(cache: CountCache, collection: CollectionInterface, query: Dict,
+                 index: Dict, limit: int) -> Tuple[int, bool]:
+    """Bounded count of a filter over an index's entries, cached for the index version"""
+    key = (str(index['_id']), index.get('version', 0), json.dumps(query, sort_keys=True, default=str))
+    counted = cache.get(key)
+    if counted is None:
+        counted = bounded_count(collection, query, limit)
+        cache.set(key, counted)
+    return counted
+
+def pagination_headers(page: int, per_page: int, total: int, exact: bool = True) -> Dict[str, str]:
+    """X-Total-Count and Link headers for a page of results.
+
+    A lower-bound total is flagged with X-Total-Count-Exact: false, and the
+    Link header then has no last page.
+    """
+    headers = {'X-Total-Count': str(total), 'X-Total-Count-Exact': 'true' if exact else 'false'}
+    last = max(1, -(-total // per_page)) if per_page > 0 else 1
+    pages = {'first': 1}
+    if page > 1:
+        pages['prev'] = min(page - 1, last)
+    if page < last or not exact:
+        pages['next'] = page + 1
+    if exact:
+        pages['last'] = last
+    headers['Link'] = ', '.join(f'<{_page_url(number, per_page)}>; rel="{rel}"'
+                                for rel, number in pages.items())
+    return headers
+
+def _page_url(page: int, per_page: int) -> str:
+    args: Dict[str, Any] = request.args.to_dict()
+    args.update(page=page, per_page=per_page)
+    return f'{request.base_url}?{urlencode(args)}'
+
+def init_pagination(app) -> None:
+    """Register the count cache with the Flask app"""
+    app.extensions['count_cache'] = CountCache(app.config.get('COUNT_CACHE_SIZE', 1024))
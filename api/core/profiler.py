@@ -0,0 +1,233 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+from typing import Dict, Optional
+
+from bson.objectid import ObjectId
+from flask import current_app, g, request
+from flask_jwt_extended import get_jwt_identity
+from pymongo import monitoring
+
+from .metrics import command_collection
+from .ratelimit import MemoryBucketStore
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+
+# Per-thread state of the request being profiled
+_active = threading.local()
+
+def sign_profile_token(secret: str, ttl: int = 300) -> str:
+    """Create a profiling token valid for ttl seconds"""
+    expires = str(int(time.time()) + ttl)
+    signature = hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return f'{expires}.{signature}'
+
+def verify_profile_token(secret: Optional[str], token: str) -> bool:
+    """Check a profiling token's signature and expiry"""
+    if not secret or '.' not in token:
+        return False
+    expires, signature = token.split('.', 1)
+    expected = hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return (hmac.compare_digest(signature, expected)
+            and expires.isdigit() and int(expires) >= time.time())
+
+class ProfilingCommandListener(monitoring.CommandListener):
+    """Break down database time of the profiled request on this thread"""
+
+    def __init__(self):
+        self._pending: Dict[tuple, str] = {}
+
+    def started(self, event):
+        if getattr(_active, 'db_timings', None) is not None:
+            collection = command_collection(event)
+            if collection:
+                self._pending[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        timings = getattr(_active, 'db_timings', None)
+        if collection and timings is not None:
+            timing = timings.setdefault(f'{collection}.{event.command_name}', [0, 0.0])
+            timing[0] += 1
+            timing[1] += event.duration_micros / 1000
+
+class RequestProfiler:
+    """Decides which requests to profile and stores their profiles.
+
+    A request is profiled when it carries a valid signed X-Profile header
+    or is picked by PROFILER_SAMPLE_RATE. Either way at most
+    PROFILER_MAX_PER_MINUTE profiles are taken per process, and profiles
+    are written by a background thread.
+    """
+
+    def __init__(self, directory: str, sample_rate: float = 0.0, max_per_minute: int = 10,
+                 max_files: int = 500, secret: Optional[str] = None):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_per_minute = max_per_minute
+        self.max_files = max_files
+        self.secret = secret
+        self._budget = MemoryBucketStore(1)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> 'RequestProfiler':
+        return cls(
+            directory=config['PROFILER_DIR'],
+            sample_rate=config.get('PROFILER_SAMPLE_RATE', 0.0),
+            max_per_minute=config.get('PROFILER_MAX_PER_MINUTE', 10),
+            max_files=config.get('PROFILER_MAX_FILES', 500),
+            secret=config.get('PROFILER_SECRET')
+        )
+
+    def should_profile(self) -> bool:
+        """Check whether to profile the current request"""
+        token = request.headers.get(PROFILE_HEADER)
+        if token:
+            wanted = verify_profile_token(self.secret, token)
+        else:
+            wanted = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not wanted:
+            return False
+        allowed, _ = self._budget.consume(
+            'profiles', 1, self.max_per_minute, self.max_per_minute / 60.0, time.monotonic()
+        )
+        return allowed
+
+    def start(self) -> None:
+        """Start profiling the current request"""
+        import cProfile
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return  # Another profiler is active on this thread
+        _active.db_timings = {}
+        g.profile = (profile, time.perf_counter())
+
+    def finish(self, response) -> None:
+        """Stop profiling and hand the profile to the writer thread"""
+        profile, started = g.pop('profile')
+        profile.disable()
+        db_timings = getattr(_active, 'db_timings', None) or {}
+        _active.db_timings = None
+        try:
+            user_id = get_jwt_identity()
+        except Exception:
+            user_id = None
+        meta = {
+            'id': str(ObjectId()),
+            'created_at': datetime.now(UTC).isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'user_id': user_id,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            'db': {
+                'commands': sum(count for count, _ in db_timings.values()),
+                'total_ms': round(sum(ms for _, ms in db_timings.values()), 3),
+                'by_command': {
+                    name: {'count': count, 'total_ms': round(ms, 3)}
+                    for name, (count, ms) in sorted(db_timings.items(), key=lambda i: -i[1][1])
+                }
+            }
+        }
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profiler')
+        self._executor.submit(self._write, profile, meta)
+
+    def _write(self, profile, meta: Dict) -> None:
+        import pstats
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{meta['created_at'][:19].replace(':', '')}-{meta['endpoint'] or 'unmatched'}-{meta['id']}"
+            path = os.path.join(self.directory, name)
+            profile.dump_stats(f'{path}.prof')
+
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(25)
+            meta['top_functions'] = summary.getvalue()
+            with open(f'{path}.json', 'w') as f:
+                json.dump(meta, f, indent=2)
+            self._prune()
+        except Exception:
+            logger.exception('Failed to write request profile')
+
+    def _prune(self) -> None:
+        """Remove the oldest profiles beyond max_files"""
+        names = sorted(n[:-5] for n in os.listdir(self.directory) if n.endswith('.json'))
+        for name in names[:max(0, len(names) - self.max_files)]:
+            for suffix in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self, limit: int = 50):
+        """Metadata of the most recent profiles"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((n for n in os.listdir(self.directory) if n.endswith('.json')), reverse=True)
+        profiles = []
+        for name in names[:limit]:
+            with open(os.path.join(self.directory, name)) as f:
+                meta = json.load(f)
+            meta.pop('top_functions', None)
+            meta['file'] = name[:-5] + '.prof'
+            profiles.append(meta)
+        return profiles
+
+    def flush(self) -> None:
+        """Wait for queued profiles to be written"""
+        with self._lock:
+            executor = self._executor
+        if executor is not None:
+            executor.submit(lambda: None).result()
+
+def _start_profile() -> None:
+    profiler = current_app.extensions['profiler']
+    if profiler.should_profile():
+        profiler.start()
+
+def _finish_profile(response):
+    if 'profile' in g:
+        current_app.extensions['profiler'].finish(response)
+    return response
+
+def _abort_profile(exc=None) -> None:
+    """Stop a profile left running by a request that never got a response"""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile[0].disable()
+        _active.db_timings = None
+
+def init_profiler(app) -> None:
+    """Register the opt-in request profiler with the Flask app"""
+    if not app.config.get('PROFILER_ENABLED'):
+        return
+    app.extensions['profiler'] = RequestProfiler.from_config(app.config)
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_abort_profile)
@@ -0,0 +1,148 @@
+"""Per-user storage usage and quotas.
+
+Each user document carries usage counters: usage.bytes (file bytes),
+usage.files and usage.entries. Writes reserve their usage before they
+store anything, with one conditional $inc that fails when the result
+would go over quota, and deletions give it back. Counters that drift, for
+instance after a crash between a reservation and its settlement, are
+repaired by the usage.reconcile job.
+"""
+from typing import Dict, Optional
+
+from bson.objectid import ObjectId
+
+from .database import get_file_storage
+from .errors import QuotaExceededError
+from .jobs import enqueue, job_handler
+from .models import Entry, UploadSession, User
+
+USAGE_FIELDS = ('bytes', 'files', 'entries')
+
+def quota_limits(config) -> Dict[str, Optional[int]]:
+    """Quota of each usage counter, None when unlimited"""
+    return {field: config.get(f'QUOTA_{field.upper()}') for field in USAGE_FIELDS}
+
+def user_usage(user: Dict) -> Dict[str, int]:
+    """Usage counters of a user document"""
+    usage = user.get('usage') or {}
+    return {field: usage.get(field, 0) for field in USAGE_FIELDS}
+
+def _increment(user_id: ObjectId, amounts: Dict[str, int], limits: Optional[Dict] = None) -> bool:
+    """Add amounts to a user's usage, unless a positive amount would exceed its limit"""
+    amounts = {field: amount for field, amount in amounts.items() if amount}
+    if not amounts:
+        return True
+    query: Dict = {'_id': user_id}
+    for field, amount in amounts.items():
+        limit = (limits or {}).get(field)
+        if limit is not None and amount > 0:
+            # Matches users without the counter too
+            query[f'usage.{field}'] = {'$not': {'$gt': limit - amount}}
+    return User.get_collection().update_one(
+        query, {'$inc': {f'usage.{field}': amount for field, amount in amounts.items()}}
+    )
+
+def release(user_id: ObjectId, bytes: int = 0, files: int = 0, entries: int = 0) -> None:
+    """Give back usage, when entries or files are deleted"""
+    _increment(user_id, {'bytes': -bytes, 'files': -files, 'entries': -entries})
+
+class Reservation:
+    """Usage reserved ahead of a write, settled once its real size is known"""
+
+    def __init__(self, user_id: ObjectId, limits: Dict[str, Optional[int]]):
+        self.user_id = user_id
+        self.limits = limits
+        self.amounts = {field: 0 for field in USAGE_FIELDS}
+
+    def settle(self, enforce: bool = True, **amounts: int) -> None:
+        """Make the reserved amounts match the given ones, raising if that exceeds quota.
+        
+        Without enforce the amounts are recorded even over quota, for writes
+        that have already happened.
+        """
+        delta = {field: amount - self.amounts[field] for field, amount in amounts.items()}
+        if not _increment(self.user_id, delta, self.limits if enforce else None):
+            raise QuotaExceededError(f'Storage quota exceeded: {_exceeded(self.limits, delta)}')
+        self.amounts.update(amounts)
+
+    def cancel(self) -> None:
+        """Give back everything reserved"""
+        release(self.user_id, **self.amounts)
+        self.amounts = {field: 0 for field in USAGE_FIELDS}
+
+def _exceeded(limits: Dict[str, Optional[int]], delta: Dict[str, int]) -> str:
+    return ', '.join(field for field, amount in delta.items()
+                     if amount > 0 and limits.get(field) is not None)
+
+def reserve(user_id: ObjectId, config, bytes: int = 0, files: int = 0, entries: int = 0) -> Reservation:
+    """Reserve usage for a write, raising QuotaExceededError when it does not fit"""
+    reservation = Reservation(user_id, quota_limits(config))
+    reservation.settle(bytes=bytes, files=files, entries=entries)
+    return reservation
+
+def file_size(entry: Dict) -> int:
+    """Bytes of a file entry's file"""
+    size = (entry.get('metadata') or {}).get('size')
+    if size is None:
+        try:
+            stream, size, _, _ = get_file_storage().open_file(str(entry['file_id']))
+            stream.close()
+        except FileNotFoundError:
+            return 0
+    return size
+
+def release_entry(entry: Dict) -> None:
+    """Give back the usage of a deleted entry"""
+    if entry['type'] == 'file':
+        release(entry['user_id'], bytes=file_size(entry), files=1, entries=1)
+    else:
+        release(entry['user_id'], entries=1)
+
+def measure_usage(user_id: ObjectId, batch_size: int = 1000) -> Dict[str, int]:
+    """Compute a user's usage from their entries and open upload sessions"""
+    usage = {field: 0 for field in USAGE_FIELDS}
+    # Upload sessions hold a reservation for the entry they will create
+    for session in UploadSession.get_collection().find_many({'user_id': user_id}):
+        usage['bytes'] += session['size']
+        usage['files'] += 1
+        usage['entries'] += 1
+    after = None
+    while True:
+        query: Dict = {'user_id': user_id}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+        batch = Entry.get_collection().find_many(query, sort=[('_id', 1)], limit=batch_size)
+        for entry in batch:
+            usage['entries'] += 1
+            if entry['type'] == 'file':
+                usage['files'] += 1
+                usage['bytes'] += file_size(entry)
+        if len(batch) < batch_size:
+            return usage
+        after = batch[-1]['_id']
+
+def reconcile_usage(user_id: ObjectId) -> Dict[str, int]:
+    """Reset a user's counters to their measured usage.
+
+    Writes that land while entries are being measured can leave a small
+    error, which the next reconciliation corrects.
+    """
+    usage = measure_usage(user_id)
+    User.get_collection().update_one({'_id': user_id}, {'$set': {'usage': usage}})
+    return usage
+
+def schedule_reconcile(user_id: Optional[ObjectId] = None) -> int:
+    """Queue reconciliation of one user, or of every user"""
+    if user_id is not None:
+        enqueue('usage.reconcile', {'user_id': user_id}, priority=-10, tenant=user_id)
+        return 1
+    queued = 0
+    for user in User.get_collection().find_many({}):
+        enqueue('usage.reconcile', {'user_id': user['_id']}, priority=-10, tenant=user['_id'])
+        queued += 1
+    return queued
+
+@job_handler('usage.reconcile')
+def reconcile_usage_job(payload: Dict) -> None:
+    """Job: repair a user's usage counters"""
+    reconcile_usage(ObjectId(payload['user_id']))
@@ -0,0 +1,188 @@
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from flask import current_app, g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+from .errors import RateLimitExceededError
+
+# Route classes with their own bucket per user
+READ = 'read'
+WRITE = 'write'
+UPLOAD = 'upload'
+SEARCH = 'search'
+
+# Endpoints with a raw request body charged to the upload bucket by size
+UPLOAD_ENDPOINTS = {'indexes.entries.put_upload_chunk', 'indexes.import_new_index', 'indexes.import_into_index'}
+
+class BucketStore(ABC):
+    """Base interface for token bucket state"""
+
+    @abstractmethod
+    def consume(self, key: str, cost: float, capacity: float, rate: float,
+                now: float) -> Tuple[bool, float]:
+        """Refill the bucket, take cost tokens if available and return (allowed, tokens left)"""
+        pass
+
+def _refill(tokens: float, last: float, capacity: float, rate: float, now: float) -> float:
+    """Return the token count after refilling since last"""
+    return min(capacity, tokens + max(0.0, now - last) * rate)
+
+class MemoryBucketStore(BucketStore):
+    """Per-process bucket store, used when workers must not share limits.
+
+    When full, the least recently used bucket is dropped, which at worst
+    hands an idle key a fresh bucket.
+    """
+
+    def __init__(self, max_buckets: int = 65536):
+        self.max_buckets = max_buckets
+        # key -> (tokens, last refill), least recently used first
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost, capacity, rate, now):
+        with self._lock:
+            if key in self._buckets:
+                tokens, last = self._buckets[key]
+                tokens = _refill(tokens, last, capacity, rate, now)
+                self._buckets.move_to_end(key)
+            else:
+                while len(self._buckets) >= self.max_buckets:
+                    self._buckets.popitem(last=False)
+                tokens = capacity
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+        return allowed, tokens
+
+class SharedMemoryBucketStore(BucketStore):
+    """Bucket store in an anonymous shared mapping.
+
+    The mapping is created when the app is built, so workers forked from a
+    preloaded master all see the same buckets. Keys are hashed into fixed
+    groups of slots; when a group is full the least recently used slot is
+    recycled, which at worst hands that key a fresh bucket.
+    """
+
+    SLOT = struct.Struct('<Qdd')  # key hash, tokens, last refill
+    GROUP_SIZE = 8
+    LOCK_STRIPES = 64
+
+    def __init__(self, slots: int = 65536):
+        self.groups = max(1, slots // self.GROUP_SIZE)
+        self._map = mmap.mmap(-1, self.groups * self.GROUP_SIZE * self.SLOT.size)
+        self._locks = [multiprocessing.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def consume(self, key, cost, capacity, rate, now):
+        key_hash = zlib.crc32(key.encode()) | (zlib.adler32(key.encode()) << 32) or 1
+        group = key_hash % self.groups
+        base = group * self.GROUP_SIZE * self.SLOT.size
+        with self._locks[group % self.LOCK_STRIPES]:
+            slot_offset = None
+            oldest_offset, oldest_last = base, math.inf
+            for i in range(self.GROUP_SIZE):
+                offset = base + i * self.SLOT.size
+                slot_hash, tokens, last = self.SLOT.unpack_from(self._map, offset)
+                if slot_hash == key_hash:
+                    slot_offset = offset
+                    tokens = _refill(tokens, last, capacity, rate, now)
+                    break
+                if slot_hash == 0:
+                    oldest_offset, oldest_last = offset, -math.inf
+                elif last < oldest_last:
+                    oldest_offset, oldest_last = offset, last
+            if slot_offset is None:
+                slot_offset = oldest_offset
+                tokens = capacity
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.SLOT.pack_into(self._map, slot_offset, key_hash, tokens, now)
+        return allowed, tokens
+
+class RateLimiter:
+    """Per-user, per-route-class token bucket limiter"""
+
+    def __init__(self, store: BucketStore):
+        self.store = store
+
+    def hit(self, identity: str, route_class: str, cost: float,
+            capacity: float, rate: float) -> Tuple[bool, float]:
+        """Take cost tokens from the identity's bucket for a route class"""
+        return self.store.consume(
+            f'{route_class}:{identity}', cost, capacity, rate, time.monotonic()
+        )
+
+def classify_request() -> Tuple[str, float]:
+    """Return the route class of the current request and its cost in tokens"""
+    if request.endpoint and request.endpoint.endswith('.search_entries'):
+        return SEARCH, 1
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return READ, 1
+    if request.mimetype == 'multipart/form-data' or request.endpoint in UPLOAD_ENDPOINTS:
+        return UPLOAD, max(1, request.content_length or 0)
+    return WRITE, 1
+
+def request_identity() -> str:
+    """Identify the caller by user ID, falling back to the client address"""
+    try:
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+    except Exception:
+        user_id = None
+    if user_id:
+        return f'user:{user_id}'
+    return f'addr:{request.remote_addr}'
+
+def _check_rate_limit() -> None:
+    """Charge the current request against the caller's bucket"""
+    if request.endpoint is None or request.endpoint in current_app.config['RATELIMIT_EXEMPT']:
+        return
+    route_class, cost = classify_request()
+    capacity, rate = current_app.config['RATELIMIT_LIMITS'][route_class]
+    # An upload larger than the bucket takes all of it, rather than never fitting
+    cost = min(cost, capacity)
+    limiter = current_app.extensions['ratelimit']
+    allowed, tokens = limiter.hit(request_identity(), route_class, cost, capacity, rate)
+    g.ratelimit = (capacity, tokens, rate)
+    if not allowed:
+        raise RateLimitExceededError(
+            f'Rate limit exceeded for {route_class} requests',
+            retry_after=max(1, math.ceil((cost - tokens) / rate))
+        )
+
+def _add_rate_limit_headers(response):
+    """Report the state of the bucket charged for this request"""
+    state: Optional[tuple] = g.pop('ratelimit', None)
+    if state is not None:
+        capacity, tokens, rate = state
+        response.headers['RateLimit-Limit'] = str(int(capacity))
+        response.headers['RateLimit-Remaining'] = str(max(0, int(tokens)))
+        response.headers['RateLimit-Reset'] = str(math.ceil((capacity - tokens) / rate))
+    return response
+
+def init_rate_limiting(app) -> None:
+    """Register rate limiting with the Flask app"""
+    if not app.config.get('RATELIMIT_ENABLED'):
+        return
+
+    if app.config['RATELIMIT_STORAGE'] == 'shared':
+        store = SharedMemoryBucketStore(app.config['RATELIMIT_SLOTS'])
+    elif app.config['RATELIMIT_STORAGE'] == 'memory':
+        store = MemoryBucketStore(app.config['RATELIMIT_SLOTS'])
+    else:
+        raise ValueError(f"Unknown RATELIMIT_STORAGE: {app.config['RATELIMIT_STORAGE']}")
+
+    app.extensions['ratelimit'] = RateLimiter(store)
+    app.before_request(_check_rate_limit)
+    app.after_request(_add_rate_limit_headers)
@@ -0,0 +1,95 @@
+"""Routing of read-only requests to replica set secondaries.
+
+READ_PREFERENCES maps an operation class (read, search, download) to a
+read preference mode; classes not listed read from the primary, as do
+all writes. Secondaries lag the primary, so a caller that has just
+written is pinned to the primary for READ_PRIMARY_PIN_SECONDS and reads
+its own writes. Pins live in a shared mapping, like the rate limit
+buckets, so they hold across workers forked from the app.
+"""
+import mmap
+import multiprocessing
+import struct
+import time
+import zlib
+from typing import Optional
+
+from flask import current_app, request
+
+from .database import set_read_preference
+from .ratelimit import request_identity
+
+# Operation classes with their own read preference
+READ = 'read'
+SEARCH = 'search'
+DOWNLOAD = 'download'
+
+# Endpoints streaming file contents
+DOWNLOAD_ENDPOINTS = {'indexes.entries.get_entry', 'indexes.export'}
+
+class PrimaryPins:
+    """Times until which callers read from the primary, in an anonymous shared mapping.
+
+    Callers are hashed to slots. Callers sharing a slot share its pin, which
+    at worst sends a few extra reads to the primary.
+    """
+
+    SLOT = struct.Struct('<d')
+    LOCK_STRIPES = 64
+
+    def __init__(self, slots: int = 65536):
+        self.slots = slots
+        self._map = mmap.mmap(-1, slots * self.SLOT.size)
+        self._locks = [multiprocessing.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    def pin(self, key: str, until: float) -> None:
+        slot = zlib.crc32(key.encode()) % self.slots
+        with self._locks[slot % self.LOCK_STRIPES]:
+            if self.SLOT.unpack_from(self._map, slot * self.SLOT.size)[0] < until:
+                self.SLOT.pack_into(self._map, slot * self.SLOT.size, until)
+
+    def is_pinned(self, key: str, now: float) -> bool:
+        slot = zlib.crc32(key.encode()) % self.slots
+        with self._locks[slot % self.LOCK_STRIPES]:
+            return self.SLOT.unpack_from(self._map, slot * self.SLOT.size)[0] > now
+
+def classify_read() -> Optional[str]:
+    """Operation class of the current request, None when it may write"""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if request.endpoint and request.endpoint.endswith('.search_entries'):
+        return SEARCH
+    if request.endpoint in DOWNLOAD_ENDPOINTS:
+        return DOWNLOAD
+    return READ
+
+def _route_reads() -> None:
+    """Pick the read preference of the current request"""
+    if not current_app.config['READ_PREFERENCES']:
+        return
+    operation = classify_read()
+    mode = current_app.config['READ_PREFERENCES'].get(operation) if operation else None
+    if mode and mode != 'primary':
+        pins = current_app.extensions['primary_pins']
+        if pins.is_pinned(request_identity(), time.time()):
+            mode = None
+    set_read_preference(mode, current_app.config['READ_MAX_STALENESS_SECONDS'])
+
+def _pin_writers(response):
+    """Keep a caller whose write succeeded on the primary for a while"""
+    if (current_app.config['READ_PREFERENCES'] and request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and response.status_code < 400):
+        current_app.extensions['primary_pins'].pin(
+            request_identity(), time.time() + current_app.config['READ_PRIMARY_PIN_SECONDS']
+        )
+    return response
+
+def _reset_reads(exc=None) -> None:
+    set_read_preference(None)
+
+def init_read_preferences(app) -> None:
+    """Register read routing with the Flask app"""
+    app.extensions['primary_pins'] = PrimaryPins(app.config['READ_PRIMARY_PIN_SLOTS'])
+    app.before_request(_route_reads)
+    app.after_request(_pin_writers)
+    app.teardown_request(_reset_reads)
@@ -0,0 +1,204 @@
+"""Downscaled renditions of image entries, such as gallery thumbnails.
+
+Renditions are stored as files next to the original and recorded on the
+entry under renditions.<name>. They are generated by a background job
+queued after upload, or on demand when one is requested before it exists.
+Whoever generates them first claims the entry with a lease in
+rendering_until, so other processes wait for them rather than decode the
+image again. Pillow is optional: without it no renditions are generated.
+"""
+import io
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Optional
+
+from bson.objectid import ObjectId
+from flask import current_app
+
+from .database import get_file_storage
+from .invalidation import entry_tag, invalidate
+from .jobs import enqueue, job_handler
+from .models import Entry
+
+# Thumbnails are user-visible soon after upload, so they go ahead of bulk work
+RENDITION_PRIORITY = 10
+
+class KeyedLock:
+    """One lock per key, dropped when no thread holds or waits for it"""
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str) -> None:
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            entry = self._locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+def _load_pil():
+    """Import Pillow on first use, returning None when it is not installed"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    return Image, ImageOps
+
+def is_image(entry: Dict) -> bool:
+    """Check whether an entry is a file entry holding an image"""
+    content_type = (entry.get('metadata') or {}).get('content_type') or ''
+    return entry.get('type') == 'file' and content_type.startswith('image/')
+
+class RenditionGenerator:
+    """Generates the renditions of image entries.
+
+    sizes maps rendition names to the longest side in pixels. Work on one
+    entry is serialized by a per-entry lock within a process, and by a
+    lease of lease seconds on the entry across processes, so an on-demand
+    request that races the background job waits for it instead of decoding
+    twice. A lease left by a process that died expires.
+    """
+
+    # Seconds between looks at an entry another process is rendering
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, sizes: Dict[str, int], quality: int = 85, lease: float = 30.0):
+        self.sizes = sizes
+        self.quality = quality
+        self.lease = lease
+        self._entry_locks = KeyedLock()
+
+    @classmethod
+    def from_config(cls, config) -> 'RenditionGenerator':
+        return cls(
+            sizes=config['RENDITION_SIZES'],
+            quality=config.get('RENDITION_QUALITY', 85),
+            lease=config.get('RENDITION_LEASE_SECONDS', 30.0)
+        )
+
+    @property
+    def available(self) -> bool:
+        return _load_pil() is not None
+
+    def generate(self, entry_id: ObjectId) -> Dict[str, Dict]:
+        """Generate the missing renditions of an entry and return all of them"""
+        key = str(entry_id)
+        self._entry_locks.acquire(key)
+        try:
+            while True:
+                entry = Entry.get_collection().find_one({'_id': entry_id})
+                if entry is None or not is_image(entry):
+                    return {}
+                renditions = dict(entry.get('renditions') or {})
+                missing = {name: size for name, size in self.sizes.items() if name not in renditions}
+                if not missing or not self.available:
+                    return renditions
+                claim = self._claim(entry_id)
+                if claim is not None:
+                    break
+                # Another process is rendering this entry, so wait for its renditions
+                time.sleep(self.POLL_INTERVAL)
+            try:
+                renditions.update(self._render(entry, missing))
+            finally:
+                Entry.get_collection().update_one({'_id': entry_id, 'rendering_until': claim},
+                                                  {'$unset': {'rendering_until': ''}})
+            return renditions
+        finally:
+            self._entry_locks.release(key)
+
+    def _claim(self, entry_id: ObjectId) -> Optional[datetime]:
+        """Lease an entry for rendering, returning the lease's end or None if someone else holds it"""
+        now = datetime.now(UTC)
+        until = now + timedelta(seconds=self.lease)
+        # Stored dates have millisecond precision, so release matches what was stored
+        until = until.replace(microsecond=until.microsecond // 1000 * 1000)
+        if Entry.get_collection().update_one(
+            {'_id': entry_id, '$or': [{'rendering_until': {'$exists': False}}, {'rendering_until': {'$lt': now}}]},
+            {'$set': {'rendering_until': until}}
+        ):
+            return until
+        return None
+
+    def _render(self, entry: Dict, sizes: Dict[str, int]) -> Dict[str, Dict]:
+        pil = _load_pil()
+        if pil is None:
+            return {}
+        Image, ImageOps = pil
+        storage = get_file_storage()
+        data, filename, _ = storage.get_file(str(entry['file_id']))
+
+        image = Image.open(io.BytesIO(data))
+        # Let JPEG decode at a reduced scale when only small sizes are needed
+        largest = max(sizes.values())
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image_format, content_type, extension = (
+            ('PNG', 'image/png', 'png') if has_alpha else ('JPEG', 'image/jpeg', 'jpg')
+        )
+
+        created = {}
+        # Shrink step by step from the largest size, each from the previous result
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            image.thumbnail((size, size))
+            output = io.BytesIO()
+            image.save(output, image_format, quality=self.quality, optimize=True)
+            rendition = {
+                'file_id': ObjectId(storage.store_file(
+                    output.getvalue(),
+                    filename=f'{filename.rsplit(".", 1)[0]}-{name}.{extension}',
+                    content_type=content_type
+                )),
+                'width': image.width,
+                'height': image.height,
+                'content_type': content_type,
+                'length': output.tell()
+            }
+            # Another process may have stored this rendition first
+            if Entry.get_collection().update_one(
+                {'_id': entry['_id'], f'renditions.{name}': {'$exists': False}},
+                {'$set': {f'renditions.{name}': rendition}}
+            ):
+                created[name] = rendition
+                invalidate(entry_tag(entry['_id']))
+            else:
+                storage.delete_file(str(rendition['file_id']))
+                stored = Entry.get_collection().find_one({'_id': entry['_id']})
+                created[name] = ((stored or {}).get('renditions') or {}).get(name)
+        return created
+
+def delete_renditions(entry: Dict) -> None:
+    """Delete the rendition files of an entry"""
+    storage = get_file_storage()
+    for rendition in (entry.get('renditions') or {}).values():
+        if rendition:
+            storage.delete_file(str(rendition['file_id']))
+
+def schedule_renditions(app, entry: Dict) -> None:
+    """Queue rendition generation for a newly created entry"""
+    generator = app.extensions.get('renditions')
+    if generator is not None and generator.available and is_image(entry):
+        enqueue('renditions', {'entry_id': entry['_id']}, priority=RENDITION_PRIORITY)
+
+@job_handler('renditions')
+def generate_renditions(payload: Dict) -> None:
+    """Job: generate the renditions of an entry"""
+    generator = current_app.extensions.get('renditions')
+    if generator is not None:
+        generator.generate(ObjectId(payload['entry_id']))
+
+def init_renditions(app) -> None:
+    """Register the rendition generator with the Flask app"""
+    if app.config.get('RENDITIONS_ENABLED'):
+        app.extensions['renditions'] = RenditionGenerator.from_config(app.config)
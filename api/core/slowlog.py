@@ -0,0 +1,314 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from datetime import datetime, UTC
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+from .metrics import command_collection
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERIES_COLLECTION = 'slow_queries'
+
+# Command fields that make up the query shape
+SHAPE_FIELDS = {
+    'find': ('filter', 'sort', 'projection'),
+    'aggregate': ('pipeline',),
+    'count': ('query',),
+    'distinct': ('key', 'query'),
+    'findAndModify': ('query', 'sort', 'update'),
+    'update': ('updates',),
+    'delete': ('deletes',)
+}
+# Fields kept verbatim because they describe structure rather than values
+VERBATIM_FIELDS = {'sort', 'projection', 'key'}
+# Session and routing fields stripped before re-running a command as explain
+NON_EXPLAIN_FIELDS = {'lsid', 'txnNumber', 'autocommit', 'startTransaction', 'readConcern', 'writeConcern'}
+
+def query_shape(value: Any) -> Any:
+    """Replace literal values in a query with '?' keeping its structure"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = query_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return '?'
+
+def command_shape(command_name: str, command: Dict) -> str:
+    """Normalized shape of a command as a stable string"""
+    shape = {}
+    for field in SHAPE_FIELDS.get(command_name, ()):
+        if field not in command:
+            continue
+        if field in VERBATIM_FIELDS:
+            shape[field] = command[field]
+        elif field in ('updates', 'deletes'):
+            shape[field] = query_shape([{k: v for k, v in op.items() if k in ('q', 'u')}
+                                        for op in command[field]])
+        else:
+            shape[field] = query_shape(command[field])
+    return json.dumps(shape, sort_keys=True, default=str)
+
+def docs_returned(reply: Dict) -> Optional[int]:
+    """Number of documents in a command reply, if it has any"""
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        batch = cursor.get('firstBatch', cursor.get('nextBatch'))
+        if batch is not None:
+            return len(batch)
+    n = reply.get('n')
+    return n if isinstance(n, int) else None
+
+def plan_summary(plan: Dict) -> str:
+    """Summarize a winning plan as its chain of stages"""
+    if 'queryPlan' in plan:
+        plan = plan['queryPlan']
+    stage = plan.get('stage', '?')
+    if plan.get('indexName'):
+        stage += f"({plan['indexName']})"
+    if 'inputStage' in plan:
+        return f"{stage} > {plan_summary(plan['inputStage'])}"
+    if plan.get('inputStages'):
+        return f"{stage} > [{' | '.join(plan_summary(p) for p in plan['inputStages'])}]"
+    return stage
+
+def summarize_explain(reply: Dict) -> Dict[str, Any]:
+    """Pick the interesting parts of an executionStats explain reply"""
+    stats = reply.get('executionStats', {})
+    return {
+        'docs_examined': stats.get('totalDocsExamined'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'docs_returned': stats.get('nReturned'),
+        'execution_ms': stats.get('executionTimeMillis'),
+        'plan': plan_summary(reply.get('queryPlanner', {}).get('winningPlan', {}))
+    }
+
+def command_partition(collection: str) -> Tuple[bool, Optional[str]]:
+    """Whether a command can be explained, and the partition it ran in.
+
+    Directory collections and unpartitioned databases give None, which
+    explain runs against like any command without a tenant. Commands whose
+    partition is not known without a lookup are not explained.
+    """
+    from .database import PartitionedDatabase, get_database
+    from .database.partitioned import DIRECTORY_COLLECTIONS
+    db = get_database()
+    if not isinstance(db, PartitionedDatabase) or collection in DIRECTORY_COLLECTIONS:
+        return True, None
+    partition = db.known_partition()
+    return partition is not None, partition
+
+class SlowQueryLog:
+    """Records slow commands off the request path.
+
+    Records are queued and written by a background thread, either to a
+    capped collection or to a rotating JSON lines file. A sample of them is
+    re-run as explain('executionStats') before being written.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 10 * 1024 * 1024,
+                 backups: int = 5, collection_size: int = 16 * 1024 * 1024,
+                 explain_sample_rate: float = 0.0, database_name: Optional[str] = None,
+                 queue_size: int = 1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.collection_size = collection_size
+        self.explain_sample_rate = explain_sample_rate
+        self.database_name = database_name
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._file_logger: Optional[logging.Logger] = None
+        self._collection_ready = False
+
+    @classmethod
+    def from_config(cls, config) -> 'SlowQueryLog':
+        return cls(
+            path=config.get('SLOW_QUERY_LOG_FILE'),
+            max_bytes=config.get('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024),
+            backups=config.get('SLOW_QUERY_LOG_BACKUPS', 5),
+            collection_size=config.get('SLOW_QUERY_COLLECTION_SIZE', 16 * 1024 * 1024),
+            explain_sample_rate=config.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.0),
+            database_name=config.get('MONGO_DB_NAME')
+        )
+
+    def record(self, database: str, collection: str, command_name: str, command: Dict,
+               duration_ms: float, reply: Optional[Dict] = None, error: Optional[str] = None) -> None:
+        """Queue a slow command to be written"""
+        entry = {
+            'ts': datetime.now(UTC),
+            'database': database,
+            'collection': collection,
+            'command': command_name,
+            'shape': command_shape(command_name, command),
+            'duration_ms': round(duration_ms, 3),
+            'docs_returned': docs_returned(reply) if reply else None
+        }
+        if error:
+            entry['error'] = error
+        # Explain runs against the app database, so only sample its commands
+        explain = (command_name in SHAPE_FIELDS and not error
+                   and database in (self.database_name, None)
+                   and random.random() < self.explain_sample_rate)
+        partition = None
+        if explain:
+            # The worker thread has no tenant, so note where the command ran
+            explain, partition = command_partition(collection)
+        try:
+            self._queue.put_nowait((entry, command if explain else None, partition))
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._ensure_worker()
+
+    def flush(self) -> None:
+        """Wait until queued records are written"""
+        self._queue.join()
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='slow-query-log', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            entry, command, partition = self._queue.get()
+            try:
+                if command is not None:
+                    entry['explain'] = self._explain(command, partition)
+                self._write(entry)
+            except Exception:
+                logger.exception('Failed to record slow query')
+            finally:
+                self._queue.task_done()
+
+    def _explain(self, command: Dict, partition: Optional[str] = None) -> Dict[str, Any]:
+        from .database import get_database, partition_context
+        explained = {k: v for k, v in command.items()
+                     if not k.startswith('$') and k not in NON_EXPLAIN_FIELDS}
+        with partition_context(partition):
+            reply = get_database().run_command({'explain': explained, 'verbosity': 'executionStats'})
+        return summarize_explain(reply)
+
+    def _write(self, entry: Dict) -> None:
+        if self.path:
+            self._get_file_logger().info(json.dumps(entry, default=str))
+            return
+
+        from .database import get_database
+        db = get_database()
+        if not self._collection_ready:
+            try:
+                db.run_command({'create': SLOW_QUERIES_COLLECTION, 'capped': True,
+                                'size': self.collection_size})
+            except Exception:
+                pass  # Already exists
+            self._collection_ready = True
+        db.get_collection(SLOW_QUERIES_COLLECTION).insert_one(entry)
+
+    def _get_file_logger(self) -> logging.Logger:
+        if self._file_logger is None:
+            file_logger = logging.getLogger(f'{__name__}.file.{id(self)}')
+            file_logger.propagate = False
+            file_logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(
+                self.path, maxBytes=self.max_bytes, backupCount=self.backups
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            file_logger.addHandler(handler)
+            self._file_logger = file_logger
+        return self._file_logger
+
+    def entries(self) -> List[Dict]:
+        """Read back the recorded slow commands"""
+        if not self.path:
+            from .database import get_database
+            return get_database().get_collection(SLOW_QUERIES_COLLECTION).find_many({})
+
+        entries = []
+        paths = [f'{self.path}.{i}' for i in range(self.backups, 0, -1)] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return entries
+
+    def top_shapes(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Group recorded commands by query shape, slowest total time first"""
+        groups: Dict[tuple, Dict[str, Any]] = {}
+        for entry in self.entries():
+            key = (entry['collection'], entry['command'], entry['shape'])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    'collection': entry['collection'],
+                    'command': entry['command'],
+                    'shape': json.loads(entry['shape']),
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'docs_returned': 0,
+                    'explain': None
+                }
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            group['max_ms'] = max(group['max_ms'], entry['duration_ms'])
+            group['docs_returned'] += entry.get('docs_returned') or 0
+            if entry.get('explain'):
+                group['explain'] = entry['explain']
+
+        shapes = sorted(groups.values(), key=lambda g: g['total_ms'], reverse=True)[:limit]
+        for group in shapes:
+            group['total_ms'] = round(group['total_ms'], 3)
+            group['mean_ms'] = round(group['total_ms'] / group['count'], 3)
+        return shapes
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Send commands slower than the threshold to a SlowQueryLog"""
+
+    def __init__(self, log: SlowQueryLog, threshold_ms: float):
+        self.log = log
+        self.threshold_ms = threshold_ms
+        # Commands in flight, keyed by connection and request
+        self._pending: Dict[tuple, tuple] = {}
+
+    def started(self, event):
+        collection = command_collection(event)
+        if collection and collection != SLOW_QUERIES_COLLECTION:
+            self._pending[(event.connection_id, event.request_id)] = (
+                event.database_name, collection, event.command
+            )
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending and event.duration_micros >= self.threshold_ms * 1000:
+            database, collection, command = pending
+            self.log.record(database, collection, event.command_name, command,
+                            event.duration_micros / 1000, reply=event.reply)
+
+    def failed(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending and event.duration_micros >= self.threshold_ms * 1000:
+            database, collection, command = pending
+            self.log.record(database, collection, event.command_name, command,
+                            event.duration_micros / 1000, error=str(event.failure))
@@ -0,0 +1,248 @@
+"""Tenants of a partitioned database, and moving them between partitions.
+
+Requests run against the partition of the authenticated user. A tenant
+is moved online: its data is copied to the new partition while it keeps
+working, then its writes are held back with 503 for a few seconds while
+what changed meanwhile is copied, and finally tenant_partitions is
+switched to the new partition and the old copy is deleted. Open
+resumable uploads are discarded by a move.
+"""
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from flask import request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+from .database import (
+    PartitionedDatabase,
+    get_database,
+    get_file_storage,
+    partition_context,
+    set_tenant
+)
+from .database.partitioned import TENANT_PARTITIONS_COLLECTION
+from .errors import ServiceUnavailableError, ValidationError
+from .invalidation import invalidate, local_cache, user_tag
+from .uploads import abort_session
+
+logger = logging.getLogger(__name__)
+
+# Seconds clients are asked to wait while their tenant is being moved
+MOVE_RETRY_AFTER = 5
+
+def partitioned_database() -> Optional[PartitionedDatabase]:
+    """The database if it is partitioned"""
+    db = get_database()
+    return db if isinstance(db, PartitionedDatabase) else None
+
+def _cached_placement(db: PartitionedDatabase, user_id: Any) -> Tuple[str, Optional[Dict]]:
+    """Partition of a user and their tenant_partitions entry, cached under the user's tag"""
+    return local_cache('tenant_partitions').fetch(user_id, lambda: db.placement(user_id),
+                                                   lambda placement: [user_tag(user_id)])
+
+def check_writable(user_id: Any) -> None:
+    """Refuse writes of a tenant that is being moved"""
+    db = partitioned_database()
+    if db is None or user_id is None:
+        return
+    _, pinned = _cached_placement(db, user_id)
+    if pinned and pinned.get('state') == 'moving':
+        raise ServiceUnavailableError('Account is being moved, try again shortly',
+                                      retry_after=MOVE_RETRY_AFTER)
+
+def _enter_tenant() -> None:
+    """Use the authenticated user's partition for the request"""
+    try:
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+    except Exception:
+        user_id = None
+    tenant = ObjectId(user_id) if user_id and ObjectId.is_valid(user_id) else None
+    db = partitioned_database()
+    partition = _cached_placement(db, tenant)[0] if db is not None and tenant is not None else None
+    set_tenant(tenant, partition)
+    if tenant is not None and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        check_writable(tenant)
+
+def _leave_tenant(exc=None) -> None:
+    set_tenant(None)
+
+def _tenant_collections(user_id: ObjectId) -> List[tuple]:
+    """(collection, query) of each collection holding a tenant's documents"""
+    return [
+        # Term statistics are keyed by index, so they go ahead of the indexes
+        ('term_stats', lambda: {'index_id': {'$in': [
+            index['_id'] for index in get_database().get_collection('indexes').find_many({'user_id': user_id})
+        ]}}),
+        ('indexes', {'user_id': user_id}),
+        ('entries', {'user_id': user_id}),
+        ('upload_sessions', {'user_id': user_id})
+    ]
+
+def _entry_files(entries: Iterable[Dict]) -> List[str]:
+    file_ids = []
+    for entry in entries:
+        if entry.get('file_id'):
+            file_ids.append(str(entry['file_id']))
+        for rendition in (entry.get('renditions') or {}).values():
+            if rendition and rendition.get('file_id'):
+                file_ids.append(str(rendition['file_id']))
+    return file_ids
+
+def _copy_file(file_id: str, source: str, target: str, chunk_size: int) -> bool:
+    """Copy a file between partitions under the same ID, unless the target has it"""
+    with partition_context(target):
+        try:
+            get_file_storage().open_file(file_id)[0].close()
+            return False
+        except FileNotFoundError:
+            pass
+    with partition_context(source):
+        try:
+            stream, length, filename, content_type = get_file_storage().open_file(file_id)
+        except FileNotFoundError:
+            return False
+    try:
+        with partition_context(target):
+            storage = get_file_storage()
+            n = 0
+            while True:
+                data = stream.read(chunk_size)
+                if not data:
+                    break
+                storage.write_chunk(file_id, n, data)
+                n += 1
+            storage.finalize_file(file_id, length, chunk_size, filename, content_type)
+    finally:
+        stream.close()
+    return True
+
+def _copy_tenant(user_id: ObjectId, source: str, target: str, batch_size: int,
+                 chunk_size: int, prune: bool) -> Dict[str, int]:
+    """Copy a tenant's documents and files from one partition to another.
+
+    Documents are replaced in the target batch by batch. With prune,
+    target documents no longer in the source are deleted as well.
+    """
+    counts: Dict[str, int] = {'files': 0}
+    for name, query in _tenant_collections(user_id):
+        if callable(query):
+            with partition_context(source):
+                query = query()
+        copied = set()
+        after = None
+        while True:
+            page = dict(query)
+            if after is not None:
+                page['_id'] = {'$gt': after}
+            with partition_context(source):
+                batch = get_database().get_collection(name).find_many(page, sort=[('_id', 1)],
+                                                                      limit=batch_size)
+            if not batch:
+                break
+            ids = [document['_id'] for document in batch]
+            with partition_context(target):
+                collection = get_database().get_collection(name)
+                collection.delete_many({'_id': {'$in': ids}})
+                collection.insert_many(batch)
+            if name == 'entries':
+                for file_id in _entry_files(batch):
+                    counts['files'] += _copy_file(file_id, source, target, chunk_size)
+            copied.update(ids)
+            counts[name] = counts.get(name, 0) + len(batch)
+            after = ids[-1]
+        if prune:
+            with partition_context(target):
+                collection = get_database().get_collection(name)
+                stale = [document['_id'] for document in collection.find_many(query)
+                         if document['_id'] not in copied]
+                if stale:
+                    collection.delete_many({'_id': {'$in': stale}})
+    return counts
+
+def _delete_tenant(user_id: ObjectId, partition: str) -> None:
+    """Delete a tenant's documents and files from a partition"""
+    with partition_context(partition):
+        db = get_database()
+        storage = get_file_storage()
+        for name, query in _tenant_collections(user_id):
+            if callable(query):
+                query = query()
+            if name == 'entries':
+                after = None
+                while True:
+                    page = dict(query, **({'_id': {'$gt': after}} if after is not None else {}))
+                    batch = db.get_collection(name).find_many(page, sort=[('_id', 1)], limit=500)
+                    if not batch:
+                        break
+                    for file_id in _entry_files(batch):
+                        storage.delete_file(file_id)
+                    after = batch[-1]['_id']
+            db.get_collection(name).delete_many(query)
+
+def move_tenant(user_id: ObjectId, target: str, batch_size: int = 500, chunk_size: int = 255 * 1024,
+                settle_seconds: float = 2.0,
+                log: Optional[Callable[[str], None]] = None) -> Dict[str, int]:
+    """Move a tenant's data to another partition while it stays online"""
+    log = log or logger.info
+    db = partitioned_database()
+    if db is None:
+        raise ValidationError('The database is not partitioned')
+    if target not in db.partition_names:
+        raise ValidationError(f'Unknown partition: {target}')
+    source, pinned = db.placement(user_id)
+    if pinned and pinned.get('state') == 'moving':
+        raise ValidationError(f"Already being moved to {pinned.get('moving_to')}")
+    if source == target:
+        return {}
+    overrides = db.directory.get_collection(TENANT_PARTITIONS_COLLECTION)
+
+    log(f'Copying {user_id} from {source} to {target}')
+    copied = _copy_tenant(user_id, source, target, batch_size, chunk_size, prune=False)
+
+    log('Holding writes to copy the remaining changes')
+    moving = {'partition': source, 'moving_to': target, 'state': 'moving'}
+    if pinned:
+        # Swap the entry in place, so the tenant always has one
+        if not overrides.update_one({'_id': user_id, 'state': pinned.get('state')}, {'$set': moving}):
+            raise ValidationError('Moved by someone else meanwhile')
+    else:
+        # Fails on the duplicate _id if another move got there first
+        overrides.insert_one({'_id': user_id, **moving})
+    try:
+        # Have workers drop the cached placement, then let writes already past the check land
+        invalidate(user_tag(user_id))
+        time.sleep(settle_seconds)
+        with partition_context(source):
+            for session in get_database().get_collection('upload_sessions').find_many(
+                    {'user_id': user_id, 'status': 'open'}):
+                abort_session(session)
+        counts = _copy_tenant(user_id, source, target, batch_size, chunk_size, prune=True)
+        # Files are immutable, so most were copied in the first pass
+        counts['files'] += copied['files']
+    except BaseException:
+        if pinned:
+            restored = {key: value for key, value in pinned.items() if key != '_id'}
+            overrides.update_one({'_id': user_id}, {'$set': restored,
+                                                    '$unset': {key: '' for key in moving if key not in restored}})
+        else:
+            overrides.delete_one({'_id': user_id})
+        invalidate(user_tag(user_id))
+        raise
+    overrides.update_one({'_id': user_id}, {'$set': {'partition': target, 'state': 'active'},
+                                            '$unset': {'moving_to': ''}})
+    # Drop the placement and what workers cached while reading the old copy
+    invalidate(user_tag(user_id))
+
+    log(f'Switched to {target}, deleting the copy in {source}')
+    # Let reads still running against the old copy finish
+    time.sleep(settle_seconds)
+    _delete_tenant(user_id, source)
+    return counts
+
+def init_tenants(app) -> None:
+    """Register per-request tenants with the Flask app"""
+    app.before_request(_enter_tenant)
+    app.teardown_request(_leave_tenant)
@@ -0,0 +1,199 @@
+"""Resumable uploads: files sent in numbered chunks across many requests.
+
+Each chunk is written straight to file storage as chunk n of a file that
+has no files document yet, so committing a session only writes the files
+document and the entry. Sessions that are not committed before they expire
+are swept along with their chunks.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+from typing import Any, Dict, Optional
+
+from bson.objectid import ObjectId
+
+from .database import get_file_storage
+from .errors import ValidationError
+from .models import Entry, UploadSession
+from .quota import release, reserve
+
+logger = logging.getLogger(__name__)
+
+# When expired sessions were last swept by this process
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+def create_session(index_id: ObjectId, user_id: ObjectId, data: Dict, config) -> Dict:
+    """Validate an upload session request and create the session"""
+    filename = (data.get('filename') or '').strip()
+    if not filename:
+        raise ValidationError('Filename is required')
+    size = data.get('size')
+    if not isinstance(size, int) or size <= 0:
+        raise ValidationError('Size must be a positive number of bytes')
+    if size > config['UPLOAD_MAX_SIZE']:
+        raise ValidationError(f"Size must be at most {config['UPLOAD_MAX_SIZE']} bytes")
+    chunk_size = data.get('chunk_size', config['UPLOAD_CHUNK_SIZE'])
+    if not isinstance(chunk_size, int) or not 0 < chunk_size <= config['UPLOAD_MAX_CHUNK_SIZE']:
+        raise ValidationError(f"Chunk size must be at most {config['UPLOAD_MAX_CHUNK_SIZE']} bytes")
+
+    keywords = data.get('keywords', [])
+    if not isinstance(keywords, list):
+        keywords = [k.strip() for k in str(keywords).split(',') if k.strip()]
+
+    # The session holds the usage of its file until it is committed or discarded
+    reservation = reserve(user_id, config, bytes=size, files=1, entries=1)
+    try:
+        return UploadSession.create(
+            index_id=index_id,
+            user_id=user_id,
+            filename=filename,
+            content_type=data.get('content_type') or 'application/octet-stream',
+            size=size,
+            chunk_size=chunk_size,
+            expires_at=datetime.now(UTC) + timedelta(seconds=config['UPLOAD_SESSION_TTL']),
+            keywords=keywords
+        )
+    except Exception:
+        reservation.cancel()
+        raise
+
+def expected_chunk_size(session: Dict, n: int) -> int:
+    """Size chunk n of a session must have"""
+    if n < session['chunk_count'] - 1:
+        return session['chunk_size']
+    return session['size'] - session['chunk_size'] * (session['chunk_count'] - 1)
+
+def write_chunk(session: Dict, n: int, data: bytes, ttl: int) -> None:
+    """Store chunk n of a session and extend the session's expiry"""
+    if session['status'] != 'open':
+        raise ValidationError('Upload session is not open')
+    if not 0 <= n < session['chunk_count']:
+        raise ValidationError(f"Chunk number must be between 0 and {session['chunk_count'] - 1}")
+    if len(data) != expected_chunk_size(session, n):
+        raise ValidationError(f'Chunk {n} must be {expected_chunk_size(session, n)} bytes')
+
+    storage = get_file_storage()
+    sessions = UploadSession.get_collection()
+    file_id = str(session['file_id'])
+    storage.write_chunk(file_id, n, data)
+    if not sessions.update_one(
+        {'_id': session['_id'], 'status': 'open'},
+        {
+            '$addToSet': {'received': n},
+            '$set': {'expires_at': datetime.now(UTC) + timedelta(seconds=ttl)}
+        }
+    ):
+        # The session was aborted or expired while the chunk was written, and its
+        # chunks may already be deleted: delete this one too, unless a commit owns them
+        current = sessions.find_one({'_id': session['_id']})
+        committing = current is not None and current['status'] == 'committing'
+        if not committing and not storage.existing_files([file_id]):
+            storage.delete_chunks(file_id)
+        raise ValidationError('Upload session is not open')
+
+def session_status(session: Dict) -> Dict[str, Any]:
+    """Describe a session and which of its chunks have arrived"""
+    received = sorted(session['received'])
+    return {
+        'id': str(session['_id']),
+        'filename': session['filename'],
+        'content_type': session['content_type'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'chunk_count': session['chunk_count'],
+        'received': received,
+        'missing': session['chunk_count'] - len(received),
+        'status': session['status'],
+        'expires_at': session['expires_at'].isoformat()
+    }
+
+def commit_session(session: Dict) -> Dict:
+    """Turn a complete session into a file entry"""
+    sessions = UploadSession.get_collection()
+    # Only one commit may proceed, and chunk writes stop once it starts
+    if not sessions.update_one({'_id': session['_id'], 'status': 'open'},
+                               {'$set': {'status': 'committing'}}):
+        raise ValidationError('Upload session is not open')
+    session = sessions.find_one({'_id': session['_id']})
+    missing = session['chunk_count'] - len(set(session['received']))
+    if missing:
+        sessions.update_one({'_id': session['_id']}, {'$set': {'status': 'open'}})
+        raise ValidationError(f'{missing} chunks have not been uploaded')
+
+    storage = get_file_storage()
+    file_id = str(session['file_id'])
+    try:
+        storage.finalize_file(file_id, session['size'], session['chunk_size'],
+                              session['filename'], session['content_type'])
+        entry = Entry.create(
+            index_id=session['index_id'],
+            user_id=session['user_id'],
+            type='file',
+            file_id=session['file_id'],
+            metadata={
+                'filename': session['filename'],
+                'content_type': session['content_type'],
+                'size': session['size']
+            },
+            keywords=session['keywords']
+        )
+    except Exception:
+        storage.delete_file(file_id)
+        storage.delete_chunks(file_id)
+        if sessions.delete_one({'_id': session['_id']}):
+            _release_session(session)
+        raise
+    sessions.delete_one({'_id': session['_id']})
+    return entry
+
+def _release_session(session: Dict) -> None:
+    """Give back the usage reserved by a discarded session"""
+    release(session['user_id'], bytes=session['size'], files=1, entries=1)
+
+def abort_session(session: Dict) -> None:
+    """Discard a session and its chunks"""
+    sessions = UploadSession.get_collection()
+    # Claim the session first, so a commit or chunk write cannot race the delete
+    if not sessions.update_one({'_id': session['_id'], 'status': 'open'},
+                               {'$set': {'status': 'aborting'}}):
+        raise ValidationError('Upload session is not open')
+    get_file_storage().delete_chunks(str(session['file_id']))
+    if sessions.delete_one({'_id': session['_id']}):
+        _release_session(session)
+
+def expire_sessions(now: Optional[datetime] = None, limit: int = 100) -> int:
+    """Delete up to limit expired sessions and their chunks"""
+    now = now or datetime.now(UTC)
+    sessions = UploadSession.get_collection()
+    storage = get_file_storage()
+    expired = sessions.find_many({'expires_at': {'$lt': now}}, limit=limit)
+    for session in expired:
+        # Claim open sessions first, so a chunk written meanwhile is deleted by its writer
+        if session['status'] == 'open' and not sessions.update_one(
+                {'_id': session['_id'], 'status': 'open'}, {'$set': {'status': 'expired'}}):
+            continue
+        file_id = str(session['file_id'])
+        # A commit that died after creating its entry leaves a live file
+        committed = Entry.get_collection().find_one({'file_id': session['file_id']}) is not None
+        if not committed:
+            storage.delete_file(file_id)
+            storage.delete_chunks(file_id)
+        if sessions.delete_one({'_id': session['_id']}) and not committed:
+            _release_session(session)
+    return len(expired)
+
+def maybe_expire_sessions(interval: float) -> None:
+    """Sweep expired sessions if this process has not done so for interval seconds"""
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep < interval or not _sweep_lock.acquire(blocking=False):
+        return
+    try:
+        _last_sweep = now
+        expire_sessions()
+    except Exception:
+        logger.exception('Failed to expire upload sessions')
+    finally:
+        _sweep_lock.release()
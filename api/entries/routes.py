@@ -1,15 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
 from flask import jsonify, request, current_app, g, send_file
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from werkzeug.utils import secure_filename
 import io
-import magic
 from datetime import datetime
 
 from api.entries import bp
-from api.core.database import get_db, get_file_storage
-from api.core.errors import ValidationError, ResourceNotFoundError
-from api.core.models import Entry, Index
+from api.core.database import BulkInsertError, get_db, get_file_storage
+from api.core.errors import LengthRequiredError, QuotaExceededError, ValidationError, ResourceNotFoundError
+from api.core.feed import event_stream, publish_entries
+from api.core.index_stats import forget_entry, record_entries
+from api.core.invalidation import entry_tag, index_tag, invalidate, local_cache, user_tag
+from api.core.keywords import forget_keywords, schedule_keywords, tokenize
+from api.core.models import Entry, Index, UploadSession
+from api.core.pagination import cached_count, pagination_headers
+from api.core.quota import release_entry, reserve
+from api.core.renditions import delete_renditions, is_image, schedule_renditions
+from api.core.uploads import (
+    abort_session,
+    commit_session,
+    create_session,
+    maybe_expire_sessions,
+    session_status,
+    write_chunk
+)
 
 @bp.route('', methods=['POST'])
 @jwt_required()
@@ -19,15 +37,30 @@ def create_entry(index_id):
     
     # Get index from URL parameter
     try:
-        index = Index.get_collection().find_one({
-            '_id': ObjectId(index_id),
-            'user_id': user_id
-        })
-        if not index:
+        if not _owns_index(ObjectId(index_id), user_id):
             return jsonify({'msg': 'Index not found'}), 404
     except:
         return jsonify({'msg': 'Invalid index ID'}), 400
     
+    # Reserve an upload's size before its body is read, so uploads over
+    # quota are turned away without being streamed
+    upload_size = 0
+    if request.mimetype == 'multipart/form-data':
+        if request.content_length is None:
+            raise LengthRequiredError('File uploads need a Content-Length')
+        upload_size = request.content_length
+    reservation = reserve(user_id, current_app.config, bytes=upload_size, entries=1)
+    try:
+        response, status = _create_entry(index_id, user_id, reservation)
+    except Exception:
+        reservation.cancel()
+        raise
+    if status >= 400:
+        reservation.cancel()
+    return response, status
+
+def _create_entry(index_id, user_id, reservation):
+    """Create a text entry or file entries, settling the usage reserved for them"""
     file = None
     filename = None
     content_type = None
@@ -36,12 +69,17 @@ def create_entry(index_id):
     entry_type = None
     keywords = []
 
-    # Handle file upload
+    # Handle file upload, one entry per file part
     if request.files and 'file' in request.files:
-        file = request.files['file']
+        files = request.files.getlist('file')
+        if len(files) > 1:
+            keywords = [k.strip() for k in request.form.get('keywords', '').split(',') if k.strip()]
+            return _create_file_entries(ObjectId(index_id), user_id, files, keywords, reservation)
+        file = files[0]
         try:
             # Read file content
             file_data = file.read()
+            reservation.settle(bytes=len(file_data), files=1, entries=1)
             filename = secure_filename(file.filename)
             
             # Get content type from file object or default to octet-stream
@@ -61,8 +99,11 @@ def create_entry(index_id):
             # Add file metadata
             metadata = {
                 'filename': filename,
-                'content_type': content_type
+                'content_type': content_type,
+                'size': len(file_data)
             }
+        except QuotaExceededError:
+            raise
         except Exception as e:
             return jsonify({'msg': 'Error processing file upload'}), 400
     # Handle text entry
@@ -85,7 +126,7 @@ def create_entry(index_id):
     
     # Create entry
     try:
-        entry = Entry.create(
+        entry = _insert_entry(
             index_id=ObjectId(index_id),
             user_id=user_id,
             type=entry_type,
@@ -95,13 +136,18 @@ def create_entry(index_id):
             keywords=keywords
         )
     except Exception as e:
+        current_app.logger.exception('Failed to create an entry in index %s', index_id)
         if file_id:
             try:
                 get_file_storage().delete_file(str(file_id))
-            except:
-                pass
+            except Exception:
+                # Left for `flask admin collect-garbage`
+                current_app.logger.exception('Failed to delete file %s of an entry not created', file_id)
         return jsonify({'msg': 'Error creating entry'}), 400
     
+    record_entries(entry['index_id'], [entry])
+    publish_entries('created', [entry])
+    _schedule_ingest_jobs(entry)
     return jsonify({
         'id': str(entry['_id']),
         'type': entry['type'],
@@ -112,6 +158,119 @@ def create_entry(index_id):
         'created_at': entry['created_at'].isoformat()
     }), 201
 
+def _insert_entry(**fields):
+    """Create an entry, batched with concurrent inserts when the route coalesces writes"""
+    if not current_app.config['WRITE_COALESCING']:
+        return Entry.create(**fields)
+    from api.core.coalescer import coalesced_insert, coalescing_delay
+    max_delay = coalescing_delay()
+    if max_delay is None:
+        return Entry.create(**fields)
+    entry = Entry(**fields).to_dict()
+    entry['_id'] = ObjectId()
+    coalesced_insert(Entry.collection_name, entry, max_delay)
+    return entry
+
+def _schedule_ingest_jobs(entry):
+    """Queue the background work that follows a new entry"""
+    schedule_renditions(current_app, entry)
+    schedule_keywords(current_app, entry)
+
+def _serialize_entry(entry):
+    """Entry fields returned by the API"""
+    return Entry.from_document(entry).to_json()
+
+def _store_upload(file):
+    """Store an uploaded file part, returning its file ID, filename, content type and size"""
+    filename = secure_filename(file.filename)
+    content_type = file.mimetype or 'application/octet-stream'
+    data = file.read()
+    file_id = get_file_storage().store_file(data, filename=filename, content_type=content_type)
+    return file_id, filename, content_type, len(data)
+
+def _create_file_entries(index_id, user_id, files, keywords, reservation):
+    """Create one entry per uploaded file part.
+    
+    Files are stored concurrently on a bounded thread pool, then the
+    entries are inserted as one batch. Each part gets its own result.
+    """
+    if len(files) > current_app.config['UPLOAD_MAX_FILES']:
+        raise ValidationError(f"At most {current_app.config['UPLOAD_MAX_FILES']} files per request")
+    reservation.settle(files=len(files), entries=len(files))
+    
+    workers = min(len(files), current_app.config['UPLOAD_WORKERS'])
+    # Workers run in copies of the request's context, to store into the tenant's partition
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') as executor:
+        futures = [executor.submit(copy_context().run, _store_upload, file) for file in files]
+    
+    results = [None] * len(files)
+    stored = []
+    for i, future in enumerate(futures):
+        try:
+            file_id, filename, content_type, size = future.result()
+        except Exception:
+            results[i] = {'filename': files[i].filename, 'status': 400,
+                          'error': 'Error processing file upload'}
+            continue
+        entry = Entry(
+            index_id=index_id,
+            user_id=user_id,
+            type='file',
+            file_id=ObjectId(file_id),
+            metadata={'filename': filename, 'content_type': content_type, 'size': size},
+            keywords=keywords
+        ).to_dict()
+        entry['_id'] = ObjectId()
+        stored.append((i, entry))
+    
+    failed = {}
+    if stored:
+        try:
+            Entry.get_collection().insert_many([entry for _, entry in stored], ordered=False)
+        except BulkInsertError as e:
+            failed = dict(e.errors)
+    created_entries = []
+    for position, (i, entry) in enumerate(stored):
+        if position in failed:
+            get_file_storage().delete_file(str(entry['file_id']))
+            results[i] = {'filename': files[i].filename, 'status': 400, 'error': 'Error creating entry'}
+        else:
+            created_entries.append(entry)
+            _schedule_ingest_jobs(entry)
+            results[i] = {'filename': files[i].filename, 'status': 201, 'entry': _serialize_entry(entry)}
+    record_entries(index_id, created_entries)
+    publish_entries('created', created_entries)
+    
+    created = sum(1 for result in results if result['status'] == 201)
+    created_bytes = sum(result['entry']['metadata']['size'] for result in results
+                        if result['status'] == 201)
+    # Multipart framing made the reservation a little larger than the files
+    reservation.settle(enforce=False, bytes=created_bytes, files=created, entries=created)
+    status = 201 if created == len(files) else 207 if created else 400
+    return jsonify({
+        'created': created,
+        'failed': len(files) - created,
+        'results': results
+    }), status
+
+def _owns_index(index_id, user_id):
+    """Whether an index belongs to a user, through the process's cache of index owners"""
+    owner = local_cache('index_owners').fetch(
+        index_id,
+        lambda: (Index.get_collection().find_one({'_id': index_id}) or {}).get('user_id'),
+        lambda owner: (index_tag(index_id), user_tag(owner))
+    )
+    return owner == user_id
+
+def _find_entry(entry_id, user_id):
+    """Find an entry of a user, through the process's entry cache"""
+    entry = local_cache('entries').fetch(
+        entry_id,
+        lambda: Entry.get_collection().find_one({'_id': entry_id}),
+        lambda entry: (entry_tag(entry['_id']), index_tag(entry['index_id']), user_tag(entry['user_id']))
+    )
+    return entry if entry and entry['user_id'] == user_id else None
+
 @bp.route('', methods=['GET'])
 @jwt_required()
 def get_entries(index_id):
@@ -134,18 +293,19 @@ def get_entries(index_id):
     entries = Entry.find_by_index(
         index_id=ObjectId(index_id),
         skip=(page - 1) * per_page,
-        limit=per_page
+        limit=per_page,
+        fields=Entry.API_FIELDS
     )
     
-    return jsonify([{
-        'id': str(entry['_id']),
-        'type': entry['type'],
-        'content': entry.get('content'),
-        'file_id': str(entry['file_id']) if entry.get('file_id') else None,
-        'metadata': entry.get('metadata'),
-        'keywords': entry.get('keywords', []),
-        'created_at': entry['created_at'].isoformat()
-    } for entry in entries])
+    # The index keeps its entry count, older indexes are counted
+    if 'stats' in index:
+        total, exact = index['stats']['entries'], True
+    else:
+        total, exact = cached_count(current_app.extensions['count_cache'], Entry.get_collection(),
+                                    {'index_id': index['_id']}, index, current_app.config['COUNT_LIMIT'])
+    
+    return jsonify([Entry.from_document(entry).to_json() for entry in entries]), \
+        200, pagination_headers(page, per_page, total, exact)
 
 @bp.route('/<entry_id>', methods=['GET'])
 @jwt_required()
@@ -154,13 +314,14 @@ def get_entry(index_id, entry_id):
     user_id = ObjectId(get_jwt_identity())
     
     # Find entry
-    entry = Entry.get_collection().find_one({
-        '_id': ObjectId(entry_id),
-        'user_id': user_id
-    })
+    entry = _find_entry(ObjectId(entry_id), user_id)
     if not entry:
         raise ResourceNotFoundError('Entry not found')
     
+    rendition = request.args.get('rendition')
+    if rendition:
+        return _send_rendition(entry, rendition)
+    
     # If file entry, get file
     if entry['type'] == 'file':
         try:
@@ -184,6 +345,30 @@ def get_entry(index_id, entry_id):
         'created_at': entry['created_at'].isoformat()
     })
 
+def _send_rendition(entry, name):
+    """Send a rendition of an image entry, generating it if it is missing"""
+    generator = current_app.extensions.get('renditions')
+    if generator is None or name not in generator.sizes:
+        raise ValidationError(f'Unknown rendition: {name}')
+    if not is_image(entry):
+        raise ValidationError('Renditions are only available for image entries')
+    
+    rendition = (entry.get('renditions') or {}).get(name)
+    if rendition is None:
+        rendition = generator.generate(entry['_id']).get(name)
+    if rendition is None:
+        raise ResourceNotFoundError('Rendition not available')
+    
+    try:
+        file_data, filename, content_type = get_file_storage().get_file(str(rendition['file_id']))
+    except FileNotFoundError:
+        raise ResourceNotFoundError('Rendition not available')
+    # A rendition never changes once stored, so clients may cache it for good
+    response = send_file(io.BytesIO(file_data), mimetype=content_type, download_name=filename,
+                         etag=str(rendition['file_id']), conditional=True)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
 @bp.route('/<entry_id>', methods=['DELETE'])
 @jwt_required()
 def delete_entry(index_id, entry_id):
@@ -204,12 +389,30 @@ def delete_entry(index_id, entry_id):
             get_file_storage().delete_file(str(entry['file_id']))
         except FileNotFoundError:
             pass  # Ignore if file already deleted
+        delete_renditions(entry)
+    forget_keywords(entry)
     
     # Delete entry
-    Entry.get_collection().delete_one({'_id': ObjectId(entry_id)})
+    if Entry.get_collection().delete_one({'_id': ObjectId(entry_id)}):
+        release_entry(entry)
+        forget_entry(entry)
+        invalidate(entry_tag(entry['_id']))
+        publish_entries('deleted', [entry])
     
     return '', 204
 
+@bp.route('/events', methods=['GET'])
+@jwt_required()
+def entry_events(index_id):
+    """Stream the entries created and deleted in an index as Server-Sent Events"""
+    user_id = ObjectId(get_jwt_identity())
+    try:
+        if not _owns_index(ObjectId(index_id), user_id):
+            raise ResourceNotFoundError('Index not found')
+    except InvalidId:
+        raise ValidationError('Invalid index ID')
+    return event_stream(user_id, ObjectId(index_id))
+
 @bp.route('/search', methods=['GET'])
 @jwt_required()
 def search_entries(index_id):
@@ -239,17 +442,34 @@ def search_entries(index_id):
     except:
         return jsonify({'msg': 'Missing Authorization Header'}), 401
     
-    # Create text index if it doesn't exist
-    Entry.get_collection().create_index([('content', 'text'), ('keywords', 'text')])
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
+    count_cache = current_app.extensions['count_cache']
+    count_limit = current_app.config['COUNT_LIMIT']
     
-    # Search entries
-    entries = list(Entry.get_collection().find_many({
-        'index_id': index_id,
+    # $text matches the words of content and keywords. Exact keyword matches
+    # are added for terms it stems or drops, through the (user_id, keywords) index
+    Entry.get_collection().create_index([('content', 'text'), ('keywords', 'text')])
+    search_filter = {
         'user_id': user_id,
-        '$text': {'$search': query}
-    }))
+        'index_id': index_id,
+        '$or': [
+            {'$text': {'$search': query}},
+            {'user_id': user_id, 'keywords': {'$in': [*tokenize(query), query.strip().lower()]}}
+        ]
+    }
+    total, exact = cached_count(count_cache, Entry.get_collection(), search_filter, index, count_limit)
+    
+    entries = Entry.get_collection().find_many(
+        search_filter,
+        sort=[('created_at', -1)],
+        skip=(page - 1) * per_page,
+        limit=per_page
+    ) if total else []
     
     return jsonify({
+        'total': total,
+        'total_exact': exact,
         'entries': [{
             'id': str(entry['_id']),
             'type': entry['type'],
@@ -259,7 +479,7 @@ def search_entries(index_id):
             'keywords': entry.get('keywords', []),
             'created_at': entry['created_at'].isoformat()
         } for entry in entries]
-    })
+    }), 200, pagination_headers(page, per_page, total, exact)
     """Search entries in an index"""
     user_id = ObjectId(get_jwt_identity())
     
@@ -296,4 +516,74 @@ def search_entries(index_id):
         'metadata': entry.get('metadata'),
         'keywords': entry.get('keywords', []),
         'created_at': entry['created_at'].isoformat()
-    } for entry in entries])
\ No newline at end of file
+    } for entry in entries])
+
+def _get_upload_session(index_id, session_id):
+    """Find an upload session of the current user in an index"""
+    user_id = ObjectId(get_jwt_identity())
+    try:
+        session = UploadSession.find_for_user(ObjectId(session_id), user_id)
+    except InvalidId:
+        session = None
+    if not session or str(session['index_id']) != index_id:
+        raise ResourceNotFoundError('Upload session not found')
+    return session
+
+@bp.route('/uploads', methods=['POST'])
+@jwt_required()
+def create_upload(index_id):
+    """Start a resumable upload session"""
+    user_id = ObjectId(get_jwt_identity())
+    
+    if not _owns_index(ObjectId(index_id), user_id):
+        raise ResourceNotFoundError('Index not found')
+    
+    maybe_expire_sessions(current_app.config['UPLOAD_SWEEP_INTERVAL'])
+    session = create_session(ObjectId(index_id), user_id, request.get_json() or {}, current_app.config)
+    return jsonify(session_status(session)), 201
+
+@bp.route('/uploads/<session_id>', methods=['GET'])
+@jwt_required()
+def get_upload(index_id, session_id):
+    """Get an upload session and the chunks received so far"""
+    return jsonify(session_status(_get_upload_session(index_id, session_id)))
+
+@bp.route('/uploads/<session_id>/chunks/<int:n>', methods=['PUT'])
+@jwt_required()
+def put_upload_chunk(index_id, session_id, n):
+    """Upload chunk n of a session"""
+    session = _get_upload_session(index_id, session_id)
+    
+    # Reject oversized chunks before reading the body
+    if request.content_length is None:
+        raise LengthRequiredError('Chunks need a Content-Length')
+    if request.content_length > session['chunk_size']:
+        raise ValidationError(f"Chunk must be at most {session['chunk_size']} bytes")
+    write_chunk(session, n, request.get_data(), current_app.config['UPLOAD_SESSION_TTL'])
+    return '', 204
+
+@bp.route('/uploads/<session_id>/commit', methods=['POST'])
+@jwt_required()
+def commit_upload(index_id, session_id):
+    """Create the file entry of a completely uploaded session"""
+    entry = commit_session(_get_upload_session(index_id, session_id))
+    record_entries(entry['index_id'], [entry])
+    publish_entries('created', [entry])
+    _schedule_ingest_jobs(entry)
+    
+    return jsonify({
+        'id': str(entry['_id']),
+        'type': entry['type'],
+        'content': entry.get('content'),
+        'file_id': str(entry['file_id']) if entry.get('file_id') else None,
+        'metadata': entry.get('metadata'),
+        'keywords': entry.get('keywords', []),
+        'created_at': entry['created_at'].isoformat()
+    }), 201
+
+@bp.route('/uploads/<session_id>', methods=['DELETE'])
+@jwt_required()
+def abort_upload(index_id, session_id):
+    """Abandon an upload session"""
+    abort_session(_get_upload_session(index_id, session_id))
+    return '', 204
@@ -1,12 +1,27 @@
-from flask import jsonify, request, current_app, g
+import io
+import os
+import shutil
+import tempfile
+
+import click
+from flask import Response, jsonify, request, current_app, g, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 
 from api.indexes import bp
 from api.entries import bp as entries_bp
-from api.core.database import get_db
-from api.core.errors import ValidationError, ResourceNotFoundError
-from api.core.models import Index
+from api.core.archive import FORMATS, ArchiveError, ArchiveImporter, export_index
+from api.core.database import each_partition, get_db, tenant_context
+from api.core.errors import LengthRequiredError, QuotaExceededError, ValidationError, ResourceNotFoundError
+from api.core.feed import event_stream
+from api.core.index_stats import index_stats, rebuild_stats
+from api.core.invalidation import index_tag, invalidate
+from api.core.keywords import schedule_keyword_backfill
+from api.core.models import Index, User
+from api.core.pagination import bounded_count, pagination_headers
+from api.core.quota import reserve
+from api.core.uploads import expire_sessions
 
 # Register entries blueprint
 bp.register_blueprint(entries_bp, url_prefix='/<index_id>/entries')
@@ -44,9 +59,18 @@ def create_index():
     return jsonify({
         'id': str(index['_id']),
         'name': index['name'],
-        'description': index['description']
+        'description': index['description'],
+        'stats': index_stats(index)
     }), 201
 
+@bp.route('/import', methods=['POST'])
+@jwt_required()
+def import_new_index():
+    """Create an index from an export archive"""
+    user_id = ObjectId(get_jwt_identity())
+    result = _import_archive(user_id, name=request.args.get('name'))
+    return jsonify(result), 201
+
 @bp.route('/', methods=['GET'])
 @jwt_required()
 def get_indexes():
@@ -59,14 +83,25 @@ def get_indexes():
     indexes = Index.find_by_user(
         user_id=user_id,
         skip=(page - 1) * per_page,
-        limit=per_page
+        limit=per_page,
+        fields=Index.API_FIELDS
     )
     
+    total, exact = bounded_count(Index.get_collection(), {'user_id': user_id},
+                                 current_app.config['COUNT_LIMIT'])
+    
     return jsonify([{
-        'id': str(index['_id']),
-        'name': index['name'],
-        'description': index['description']
-    } for index in indexes])
+        'id': str(index.id),
+        'name': index.name,
+        'description': index.description,
+        'stats': index_stats(index)
+    } for index in map(Index.from_document, indexes)]), 200, pagination_headers(page, per_page, total, exact)
+
+@bp.route('/events', methods=['GET'])
+@jwt_required()
+def user_events():
+    """Stream the entries created and deleted in all the user's indexes as Server-Sent Events"""
+    return event_stream(ObjectId(get_jwt_identity()))
 
 @bp.route('/<index_id>', methods=['GET'])
 @jwt_required()
@@ -85,7 +120,8 @@ def get_index(index_id):
     return jsonify({
         'id': str(index['_id']),
         'name': index['name'],
-        'description': index['description']
+        'description': index['description'],
+        'stats': index_stats(index)
     })
 
 @bp.route('/<index_id>', methods=['PUT'])
@@ -132,7 +168,8 @@ def update_index(index_id):
     return jsonify({
         'id': str(index['_id']),
         'name': index['name'],
-        'description': index['description']
+        'description': index['description'],
+        'stats': index_stats(index)
     })
 
 @bp.route('/<index_id>', methods=['DELETE'])
@@ -148,5 +185,227 @@ def delete_index(index_id):
     })
     if not success:
         raise ResourceNotFoundError('Index not found')
+    invalidate(index_tag(index_id))
+    
+    return '', 204
+
+def _parse_after(after):
+    """Parse the entry ID an export resumes after"""
+    if not after:
+        return None
+    try:
+        return ObjectId(after)
+    except (InvalidId, TypeError):
+        raise ValidationError('Invalid entry ID in after')
+
+@bp.route('/<index_id>/export', methods=['GET'])
+@jwt_required()
+def export(index_id):
+    """Stream an index and its files as a tar or zip archive"""
+    user_id = ObjectId(get_jwt_identity())
+    
+    archive_format = request.args.get('format', 'tar')
+    if archive_format not in FORMATS:
+        raise ValidationError(f"Format must be one of: {', '.join(FORMATS)}")
+    after = _parse_after(request.args.get('after'))
+    
+    index = Index.get_collection().find_one({
+        '_id': ObjectId(index_id),
+        'user_id': user_id
+    })
+    if not index:
+        raise ResourceNotFoundError('Index not found')
+    
+    mimetype, extension = FORMATS[archive_format]
+    filename = f"{index['_id']}{'-after-' + str(after) if after else ''}.{extension}"
+    return Response(
+        stream_with_context(export_index(index, archive_format, after=after)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@bp.cli.command('export')
+@click.argument('index_id')
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help='Archive file to write (default: stdout)')
+@click.option('--format', 'archive_format', type=click.Choice(list(FORMATS)), default='tar')
+@click.option('--after', help='Resume after this entry ID')
+def export_command(index_id, output, archive_format, after):
+    """Export an index as a tar or zip archive"""
+    try:
+        after = _parse_after(after)
+    except ValidationError as e:
+        raise click.ClickException(str(e))
+    index = _find_index(index_id)
+    if not index:
+        raise click.ClickException('Index not found')
+    
+    written = 0
+    with tenant_context(index['user_id']):
+        for chunk in export_index(index, archive_format, after=after):
+            output.write(chunk)
+            written += len(chunk)
+    output.flush()
+    click.echo(f'Exported {written} bytes', err=True)
+
+def _request_archive_format():
+    """Archive format of the request body, from ?format= or the content type"""
+    archive_format = request.args.get('format')
+    if archive_format is None:
+        archive_format = 'zip' if request.mimetype == 'application/zip' else 'tar'
+    if archive_format not in FORMATS:
+        raise ValidationError(f"Format must be one of: {', '.join(FORMATS)}")
+    return archive_format
+
+def _import_archive(user_id, index_id=None, name=None):
+    """Import the archive in the request body"""
+    archive_format = _request_archive_format()
+    if request.content_length is None:
+        raise LengthRequiredError('Archive uploads need a Content-Length')
+    # An archive is at least as large as the files in it
+    reservation = reserve(user_id, current_app.config, bytes=request.content_length)
+    importer = ArchiveImporter.from_config(current_app.config, user_id, index_id=index_id, name=name,
+                                           reservation=reservation)
+    
+    # Tar archives are read straight from the request, zip needs to seek
+    body = request.stream
+    try:
+        if archive_format == 'zip':
+            body = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            shutil.copyfileobj(request.stream, body)
+            body.seek(0)
+        return importer.run(body, archive_format)
+    except ArchiveError as e:
+        raise ValidationError(str(e))
+    finally:
+        body.close()
+        _charge_import(reservation, importer.result)
+
+def _charge_import(reservation, result):
+    """Record the usage of what an import stored, even if it stopped early"""
+    reservation.settle(enforce=False, bytes=result['bytes'], files=result['files'],
+                       entries=result['entries'])
+
+@bp.route('/<index_id>/import', methods=['POST'])
+@jwt_required()
+def import_into_index(index_id):
+    """Import an export archive into an existing index"""
+    user_id = ObjectId(get_jwt_identity())
+    
+    index = Index.get_collection().find_one({
+        '_id': ObjectId(index_id),
+        'user_id': user_id
+    })
+    if not index:
+        raise ResourceNotFoundError('Index not found')
     
-    return '', 204
\ No newline at end of file
+    return jsonify(_import_archive(user_id, index_id=index['_id']))
+
+@bp.cli.command('import')
+@click.argument('archive', type=click.File('rb'))
+@click.option('--user', 'username', required=True, help='Owner of the imported index')
+@click.option('--index-id', help='Import into this index instead of creating one')
+@click.option('--name', help='Name of the created index (default: name in the archive)')
+@click.option('--format', 'archive_format', type=click.Choice(list(FORMATS)),
+              help='Archive format (default: from the file extension)')
+@click.option('--workers', type=int, help='Threads writing files')
+def import_command(archive, username, index_id, name, archive_format, workers):
+    """Import an index from an export archive"""
+    user = User.find_by_username(username)
+    if not user:
+        raise click.ClickException('User not found')
+    with tenant_context(user['_id']):
+        _import_archive_file(archive, user, index_id, name, archive_format, workers)
+
+def _file_size(archive) -> int:
+    """Size of an archive file, or 0 for a pipe"""
+    try:
+        return max(0, os.fstat(archive.fileno()).st_size)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return 0
+
+def _import_archive_file(archive, user, index_id, name, archive_format, workers):
+    """Import an archive file for a user, reporting on the console"""
+    if index_id:
+        index = Index.get_collection().find_one({'_id': ObjectId(index_id), 'user_id': user['_id']})
+        if not index:
+            raise click.ClickException('Index not found')
+        index_id = index['_id']
+    if archive_format is None:
+        archive_format = 'zip' if archive.name.endswith('.zip') else 'tar'
+    
+    options = {'workers': workers} if workers else {}
+    try:
+        # An archive is at least as large as the files in it
+        reservation = reserve(user['_id'], current_app.config, bytes=_file_size(archive))
+    except QuotaExceededError as e:
+        raise click.ClickException(str(e))
+    importer = ArchiveImporter.from_config(current_app.config, user['_id'], index_id=index_id,
+                                           name=name, reservation=reservation, **options)
+    try:
+        result = importer.run(archive, archive_format)
+    except (ArchiveError, QuotaExceededError) as e:
+        raise click.ClickException(str(e))
+    finally:
+        _charge_import(reservation, importer.result)
+    
+    click.echo(f"Imported {result['entries']} entries and {result['files']} files "
+               f"into index {result['index_id']} in {result['duration_ms'] / 1000:.1f}s")
+    for error in result['errors']:
+        click.echo(f"  {error['id']}: {error['error']}", err=True)
+    if result['failed']:
+        raise click.ClickException(f"{result['failed']} entries could not be imported")
+
+@bp.cli.command('expire-uploads')
+def expire_uploads_command():
+    """Delete expired upload sessions and their chunks"""
+    total = 0
+    for _ in each_partition():
+        while True:
+            expired = expire_sessions()
+            if not expired:
+                break
+            total += expired
+    click.echo(f'Expired {total} upload sessions')
+
+@bp.cli.command('rebuild-stats')
+@click.argument('index_id', required=False)
+def rebuild_stats_command(index_id):
+    """Recompute index statistics from their entries (default: every index)"""
+    if index_id:
+        index = _find_index(index_id)
+        if index is None:
+            raise click.ClickException('Index not found')
+        with tenant_context(index['user_id']):
+            _rebuild_stats(index)
+        return
+    for _ in each_partition():
+        for index in Index.get_collection().find_many({}):
+            _rebuild_stats(index)
+
+@bp.cli.command('extract-keywords')
+@click.argument('index_id', required=False)
+def extract_keywords_command(index_id):
+    """Queue keyword extraction for entries never analyzed (default: in every index)"""
+    if index_id:
+        index = _find_index(index_id)
+        if index is None:
+            raise click.ClickException('Index not found')
+        with tenant_context(index['user_id']):
+            queued = schedule_keyword_backfill(index['_id'])
+    else:
+        queued = sum(schedule_keyword_backfill() for _ in each_partition())
+    click.echo(f'Queued keyword extraction for {queued} entries')
+
+def _rebuild_stats(index):
+    stats = rebuild_stats(index['_id'])
+    click.echo(f"{index['_id']} {index['name']}: {stats['entries']} entries, {stats['bytes']} bytes")
+
+def _find_index(index_id):
+    """Find an index by ID in whichever partition holds it"""
+    for _ in each_partition():
+        index = Index.get_collection().find_one({'_id': ObjectId(index_id)})
+        if index:
+            return index
+    return None
+
@@ -0,0 +1,4 @@
+"""Microbenchmarks for the model and database layers.
+
+Run with ``python -m benchmarks`` (see ``python -m benchmarks --help``).
+"""
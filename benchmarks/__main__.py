@@ -0,0 +1,186 @@
+"""Run the model and database microbenchmarks and compare results"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, UTC
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# Collections written by the benchmark cases
+BENCH_COLLECTIONS = ['users', 'indexes', 'entries', 'bench_documents', 'fs.files', 'fs.chunks']
+
+def _git_commit() -> str:
+    """Short hash of the checked out commit, or 'unknown'"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run(args) -> int:
+    """Run the suite and write a JSON results file"""
+    from api import create_app
+    from api.core.database import DatabaseProvider, get_database
+    from benchmarks import cases  # noqa: F401 (registers the cases)
+    from benchmarks.harness import run_cases
+
+    app = create_app({
+        'TESTING': True,
+        'REGISTER_BLUEPRINTS': False,
+        'RATELIMIT_ENABLED': False,
+        'DATABASE_BACKEND': args.backend,
+        'DATABASE_BOOTSTRAP': 'sync',
+        'MONGO_URI': args.uri,
+        'MONGO_DB_NAME': args.db_name
+    })
+
+    with app.app_context():
+        db = get_database()
+
+        def cleanup():
+            for name in BENCH_COLLECTIONS:
+                db.get_collection(name).delete_many({})
+
+        cleanup()
+        try:
+            results = run_cases(args.filter, cleanup=cleanup, min_time=args.min_time)
+        finally:
+            cleanup()
+            DatabaseProvider.reset()
+
+    commit = _git_commit()
+    report = {
+        'commit': commit,
+        'backend': args.backend,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created_at': datetime.now(UTC).isoformat(),
+        'results': results
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}-{args.backend}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'benchmark':<60} {'ops/sec':>12} {'p50 us':>10} {'p99 us':>10} {'alloc KiB':>10}")
+    for result in results:
+        params = ','.join(f'{k}={v}' for k, v in result['params'].items())
+        print(f"{result['name'] + '[' + params + ']':<60} {result['ops_per_sec']:>12.1f} "
+              f"{result['p50_us']:>10.1f} {result['p99_us']:>10.1f} "
+              f"{result['alloc_peak_bytes'] / 1024:>10.1f}")
+    print(f'\nResults written to {output}')
+    return 0
+
+def compare(args) -> int:
+    """Compare two results files and flag regressions"""
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    def key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
+
+    base_results = {key(r): r for r in base['results']}
+    regressions = 0
+    print(f"{base['commit']} -> {head['commit']}")
+    print(f"{'benchmark':<60} {'ops/sec':>10} {'p99':>10} {'alloc':>10}")
+    for result in head['results']:
+        previous = base_results.get(key(result))
+        if previous is None:
+            continue
+        changes = [
+            _change(previous['ops_per_sec'], result['ops_per_sec'], higher_is_better=True),
+            _change(previous['p99_us'], result['p99_us']),
+            _change(previous['alloc_peak_bytes'], result['alloc_peak_bytes'])
+        ]
+        regressed = any(change < -args.threshold for change in changes)
+        regressions += regressed
+        params = ','.join(f'{k}={v}' for k, v in result['params'].items())
+        print(f"{result['name'] + '[' + params + ']':<60} "
+              + ' '.join(f'{change:>+9.1f}%' for change in changes)
+              + ('  REGRESSION' if regressed else ''))
+    return 1 if regressions else 0
+
+def startup(args) -> int:
+    """Measure cold start and check it against a time budget"""
+    from benchmarks.startup import measure_startup, slowest_imports
+
+    summary = measure_startup(args.backend, args.uri, args.db_name, runs=args.runs)
+    imports = slowest_imports()
+    report = {
+        'commit': _git_commit(),
+        'backend': args.backend,
+        'python': platform.python_version(),
+        'created_at': datetime.now(UTC).isoformat(),
+        'startup': summary,
+        'slowest_imports': imports
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print(f'Median of {args.runs} cold starts ({args.backend} backend):')
+    for phase, value in summary.items():
+        print(f"  {phase:<20} {'n/a' if value is None else f'{value:.1f} ms':>12}")
+    print('Slowest imports:')
+    for entry in imports:
+        print(f"  {entry['module']:<40} {entry['cumulative_ms']:>9.1f} ms")
+
+    if args.budget_ms is not None and summary['first_request_ms'] > args.budget_ms:
+        print(f"\nTime to first request {summary['first_request_ms']:.1f} ms "
+              f"is over the {args.budget_ms:.0f} ms budget")
+        return 1
+    return 0
+
+def _change(before: float, after: float, higher_is_better: bool = False) -> float:
+    """Percentage improvement from before to after (negative means worse)"""
+    if not before:
+        return 0.0
+    change = (after - before) / before * 100
+    return change if higher_is_better else -change
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks (default)')
+    run_parser.add_argument('--backend', choices=['memory', 'mongodb'], default='memory')
+    run_parser.add_argument('--uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    run_parser.add_argument('--db-name', default='cloud_storage_bench')
+    run_parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    run_parser.add_argument('--min-time', type=float, default=0.5, help='seconds to time each case')
+    run_parser.add_argument('--output', help='results file (default: benchmarks/results/<commit>-<backend>.json)')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='percentage change reported as a regression')
+    compare_parser.set_defaults(func=compare)
+
+    startup_parser = subparsers.add_parser('startup', help='measure cold start time')
+    startup_parser.add_argument('--backend', choices=['memory', 'mongodb'], default='memory')
+    startup_parser.add_argument('--uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    startup_parser.add_argument('--db-name', default='cloud_storage_bench')
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--budget-ms', type=float,
+                                help='fail if the median time to first request is over this')
+    startup_parser.add_argument('--output', help='write the measurements to this JSON file')
+    startup_parser.set_defaults(func=startup)
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv.insert(0, 'run')
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import os
+from datetime import datetime, UTC
+
+from bson.objectid import ObjectId
+
+from api.core.database import get_database, get_file_storage
+from api.core.models import Entry, Index
+
+from benchmarks.harness import benchmark
+
+KB = 1024
+MB = 1024 * KB
+
+def _seed_entries(index_id: ObjectId, user_id: ObjectId, count: int, content_size: int) -> None:
+    """Insert count text entries into an index"""
+    content = 'x' * content_size
+    Entry.get_collection().insert_many([
+        {
+            '_id': ObjectId(),
+            'index_id': index_id,
+            'user_id': user_id,
+            'type': 'text',
+            'content': content,
+            'metadata': {},
+            'keywords': ['bench'],
+            'created_at': datetime.now(UTC)
+        }
+        for _ in range(count)
+    ])
+
+@benchmark('Entry.create', content_size=[64, 4 * KB, 64 * KB])
+def entry_create(content_size):
+    user_id = ObjectId()
+    index = Index.create(user_id=user_id, name=f'bench-{ObjectId()}')
+    content = 'x' * content_size
+
+    def run():
+        Entry.create(index_id=index['_id'], user_id=user_id, type='text',
+                     content=content, keywords=['bench', 'create'])
+    return run
+
+@benchmark('Entry.find_by_index', page_size=[10, 100, 1000], content_size=[256, 4 * KB])
+def entry_find_by_index(page_size, content_size):
+    user_id = ObjectId()
+    index = Index.create(user_id=user_id, name=f'bench-{ObjectId()}')
+    _seed_entries(index['_id'], user_id, max(page_size, 1000), content_size)
+
+    def run():
+        Entry.find_by_index(index['_id'], skip=0, limit=page_size)
+    return run
+
+# Listing a page as the API does: whole documents turned into dicts, or
+# the listed fields only (raw BSON on MongoDB) through slotted models
+@benchmark('entries page', page_size=[1000], representation=['documents', 'models'])
+def entries_page(page_size, representation):
+    user_id = ObjectId()
+    index = Index.create(user_id=user_id, name=f'bench-{ObjectId()}')
+    _seed_entries(index['_id'], user_id, page_size, 256)
+    # Fields stored on entries that listings do not return
+    Entry.get_collection().update_many({'index_id': index['_id']}, {'$set': {
+        'terms': [f'term{i}' for i in range(50)],
+        'renditions': {'thumb': {'file_id': ObjectId(), 'content_type': 'image/webp', 'size': 4 * KB}}
+    }})
+
+    if representation == 'documents':
+        def run():
+            return [{
+                'id': str(entry['_id']),
+                'type': entry['type'],
+                'content': entry.get('content'),
+                'file_id': str(entry['file_id']) if entry.get('file_id') else None,
+                'metadata': entry.get('metadata'),
+                'keywords': entry.get('keywords', []),
+                'created_at': entry['created_at'].isoformat()
+            } for entry in Entry.find_by_index(index['_id'], limit=page_size)]
+    else:
+        def run():
+            return [Entry.from_document(entry).to_json()
+                    for entry in Entry.find_by_index(index['_id'], limit=page_size, fields=Entry.API_FIELDS)]
+    return run
+
+@benchmark('Index.find_by_user', indexes=[10, 100])
+def index_find_by_user(indexes):
+    user_id = ObjectId()
+    for i in range(indexes):
+        Index.create(user_id=user_id, name=f'bench-{i}')
+
+    def run():
+        Index.find_by_user(user_id, skip=0, limit=indexes)
+    return run
+
+@benchmark('MongoDBCollection.find_many', documents=[100, 1000], document_size=[128, 16 * KB])
+def collection_find_many(documents, document_size):
+    collection = get_database().get_collection('bench_documents')
+    collection.insert_many([
+        {'_id': ObjectId(), 'group': 1, 'payload': 'x' * document_size}
+        for _ in range(documents)
+    ])
+
+    def run():
+        collection.find_many({'group': 1})
+    return run
+
+# Every iteration stores a new file, so cap the data written per case
+@benchmark('MongoDBFileStorage.store_file', measure_options={'max_iterations': 50}, file_size=[KB, MB, 8 * MB])
+def file_store(file_size):
+    storage = get_file_storage()
+    data = os.urandom(file_size)
+
+    def run():
+        storage.store_file(data, filename='bench.bin', content_type='application/octet-stream')
+    return run
+
+@benchmark('MongoDBFileStorage.get_file', file_size=[KB, MB, 8 * MB])
+def file_get(file_size):
+    storage = get_file_storage()
+    file_id = storage.store_file(os.urandom(file_size), filename='bench.bin',
+                                 content_type='application/octet-stream')
+
+    def run():
+        storage.get_file(file_id)
+    return run
@@ -0,0 +1,95 @@
+import itertools
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+# Registered benchmark cases, in definition order
+CASES: List[Dict[str, Any]] = []
+
+def benchmark(name: str, measure_options: Optional[Dict[str, Any]] = None, **params: List[Any]):
+    """Register a benchmark case run once per combination of params.
+
+    The decorated function receives one value per param and returns the
+    callable to time. Setup done before returning is not measured.
+    measure_options override the defaults of measure() for this case.
+    """
+    def decorator(setup: Callable[..., Callable[[], Any]]):
+        CASES.append({
+            'name': name,
+            'params': params,
+            'setup': setup,
+            'measure_options': measure_options or {}
+        })
+        return setup
+    return decorator
+
+def expand(case: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """List the param combinations of a case"""
+    keys = list(case['params'])
+    return [dict(zip(keys, values)) for values in itertools.product(*case['params'].values())]
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of pre-sorted values"""
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def measure(fn: Callable[[], Any], min_time: float = 0.5, min_iterations: int = 20,
+            max_iterations: int = 100000, warmup: int = 3,
+            alloc_iterations: int = 50) -> Dict[str, float]:
+    """Time fn and sample its allocations.
+
+    Timing and allocation tracing are separate passes so tracemalloc does
+    not skew the latencies.
+    """
+    for _ in range(warmup):
+        fn()
+
+    durations: List[float] = []
+    started = time.perf_counter()
+    while len(durations) < max_iterations:
+        op_start = time.perf_counter_ns()
+        fn()
+        durations.append((time.perf_counter_ns() - op_start) / 1000.0)
+        if len(durations) >= min_iterations and time.perf_counter() - started >= min_time:
+            break
+    total_us = sum(durations)
+
+    tracemalloc.start()
+    try:
+        peaks, retained = 0, 0
+        runs = min(alloc_iterations, len(durations))
+        for _ in range(runs):
+            tracemalloc.reset_peak()
+            current_before = tracemalloc.get_traced_memory()[0]
+            fn()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks += peak - current_before
+            retained += current - current_before
+    finally:
+        tracemalloc.stop()
+
+    durations.sort()
+    return {
+        'iterations': len(durations),
+        'ops_per_sec': len(durations) / (total_us / 1e6) if total_us else 0.0,
+        'mean_us': total_us / len(durations),
+        'p50_us': percentile(durations, 0.50),
+        'p99_us': percentile(durations, 0.99),
+        'alloc_peak_bytes': peaks / runs,
+        'alloc_retained_bytes': retained / runs
+    }
+
+def run_cases(selected: Optional[str] = None, cleanup: Optional[Callable[[], None]] = None,
+              **measure_options) -> List[Dict[str, Any]]:
+    """Run registered cases whose name contains selected"""
+    results = []
+    for case in CASES:
+        if selected and selected not in case['name']:
+            continue
+        for params in expand(case):
+            fn = case['setup'](**params)
+            stats = measure(fn, **{**measure_options, **case['measure_options']})
+            results.append({'name': case['name'], 'params': params, **stats})
+            if cleanup:
+                cleanup()
+    return results
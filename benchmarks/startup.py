@@ -0,0 +1,87 @@
+"""Cold start measurements, each taken in a fresh interpreter"""
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in the child interpreter. Timestamps use time.time() so they can be
+# compared with the moment the parent spawned the process.
+CHILD = '''
+import json, sys, time
+started = time.time()
+from api import create_app
+imported = time.time()
+app = create_app(json.loads(sys.argv[1]))
+created = time.time()
+response = app.test_client().get('/health/live')
+first_request = time.time()
+assert response.status_code == 200, response.status_code
+ready = app.extensions['database_bootstrap'].wait(60)
+print(json.dumps({
+    'started': started, 'imported': imported, 'created': created,
+    'first_request': first_request, 'ready': time.time() if ready else None
+}))
+'''
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+def _config(backend: str, uri: str, db_name: str) -> Dict[str, Any]:
+    return {
+        'DATABASE_BACKEND': backend,
+        'DATABASE_BOOTSTRAP': 'background',
+        'MONGO_URI': uri,
+        'MONGO_DB_NAME': db_name
+    }
+
+def measure_once(backend: str, uri: str, db_name: str) -> Dict[str, float]:
+    """Start the app in a new interpreter and time its phases in milliseconds"""
+    spawned = time.time()
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD, json.dumps(_config(backend, uri, db_name))],
+        cwd=ROOT, text=True
+    )
+    marks = json.loads(output.strip().splitlines()[-1])
+    return {
+        'interpreter_ms': (marks['started'] - spawned) * 1000,
+        'import_ms': (marks['imported'] - marks['started']) * 1000,
+        'create_app_ms': (marks['created'] - marks['imported']) * 1000,
+        'first_request_ms': (marks['first_request'] - spawned) * 1000,
+        'ready_ms': (marks['ready'] - spawned) * 1000 if marks['ready'] else None
+    }
+
+def measure_startup(backend: str, uri: str, db_name: str, runs: int = 5) -> Dict[str, Any]:
+    """Median of each startup phase over several cold starts"""
+    samples = [measure_once(backend, uri, db_name) for _ in range(runs)]
+    summary = {}
+    for phase in samples[0]:
+        values = [sample[phase] for sample in samples if sample[phase] is not None]
+        summary[phase] = round(statistics.median(values), 1) if values else None
+    return summary
+
+def slowest_imports(limit: int = 15) -> List[Dict[str, Any]]:
+    """Modules imported directly by the api package, slowest first"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import api'],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    # Children are listed before their parent, one level deeper
+    children = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        depth = len(match.group(3)) // 2
+        if depth == 1:
+            children.append({'module': match.group(4), 'cumulative_ms': int(match.group(2)) / 1000})
+        elif depth == 0:
+            if match.group(4) == 'api':
+                break
+            children = []
+    children.sort(key=lambda i: i['cumulative_ms'], reverse=True)
+    return children[:limit]
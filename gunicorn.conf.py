@@ -0,0 +1,68 @@
+"""Gunicorn configuration for production serving.
+
+Run with: gunicorn -c gunicorn.conf.py run:app
+
+The app is loaded once in the master (preload_app) so code and read-only
+state are shared copy-on-write between workers, and so the rate limiter's
+shared memory is inherited by every worker. Database connections are not
+fork-safe: the master closes its connections once the app is loaded and
+every worker builds its own database factory after forking.
+
+The in-process database (DATABASE_BACKEND='memory') is single-process
+only: each worker would get its own copy of it and writes would not be
+seen by the others, so starting more than one worker with it is refused.
+
+Sending SIGHUP reloads workers gracefully: old workers stop accepting
+connections and get graceful_timeout seconds to finish in-flight requests,
+including uploads, before they are stopped.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+
+# Seconds a worker may be silent before it is restarted, and seconds
+# in-flight requests get to finish on reload or shutdown
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 300))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+def on_starting(server):
+    """Refuse to fork several workers off an in-process database"""
+    from api.core.database import DatabaseProvider
+    if server.cfg.workers > 1 and DatabaseProvider.in_process():
+        raise RuntimeError("DATABASE_BACKEND='memory' is single-process only, set WEB_CONCURRENCY=1")
+
+def when_ready(server):
+    """Close the master's database connections before workers are forked"""
+    from api.core.database import DatabaseProvider
+    DatabaseProvider.disconnect()
+
+def post_fork(server, worker):
+    """Give each worker its own database factory and connection pool"""
+    from api.core.database import DatabaseProvider
+    DatabaseProvider.after_fork()
+
+def worker_exit(server, worker):
+    """Let in-process jobs finish, then close the worker's database connections"""
+    from api.core.database import DatabaseProvider
+    jobs = getattr(worker, 'wsgi', None) and worker.wsgi.extensions.get('jobs')
+    if jobs is not None:
+        jobs.stop(timeout=graceful_timeout)
+    for name in ('invalidation', 'entry_feed'):
+        log = getattr(worker, 'wsgi', None) and worker.wsgi.extensions.get(name)
+        if log is not None:
+            log.stop(timeout=5)
+    DatabaseProvider.disconnect()
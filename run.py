@@ -8,11 +8,14 @@ load_dotenv()
 # Get environment
 env = os.environ.get('FLASK_ENV', 'development')
 
-# Create app instance
-app = create_app()
+# Settings taken from the environment
+ENV_SETTINGS = ('DATABASE_BACKEND', 'DATABASE_BOOTSTRAP', 'MONGO_URI', 'MONGO_DB_NAME', 'SECRET_KEY', 'JWT_SECRET_KEY')
+
+# Create app instance (served by gunicorn in production, see gunicorn.conf.py)
+app = create_app({key: os.environ[key] for key in ENV_SETTINGS if key in os.environ} or None)
 
 if __name__ == '__main__':
-    # Run the application
+    # Run the development server
     app.run(
         host='0.0.0.0',
         port=int(os.environ.get('PORT', 5000)),
@@ -3,13 +3,14 @@ from setuptools import setup, find_packages
 setup(
     name="simple-cloud-storage",
     version="0.1.0",
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=[
         'flask',
         'flask-jwt-extended',
         'pymongo',
         'python-magic',
-        'python-dotenv'
+        'python-dotenv',
+        'gunicorn'
     ],
     python_requires='>=3.12',
 )
\ No newline at end of file
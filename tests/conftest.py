@@ -1,3 +1,4 @@
+import os
 import pytest
 from bson.objectid import ObjectId
 from flask_jwt_extended import create_access_token
@@ -12,11 +13,19 @@ def app():
     """Create application for testing"""
     app = create_app({
         'TESTING': True,
+        'DATABASE_BACKEND': os.environ.get('TEST_DATABASE_BACKEND', 'mongodb'),
+        'DATABASE_BOOTSTRAP': 'sync',
         'MONGO_URI': 'mongodb://localhost:27017/',
         'MONGO_DB_NAME': 'cloud_storage_test',
         'SECRET_KEY': 'test-secret-key',
         'JWT_SECRET_KEY': 'test-jwt-secret-key',
-        'REGISTER_BLUEPRINTS': True
+        'REGISTER_BLUEPRINTS': True,
+        # Tests run queued jobs explicitly with app.extensions['jobs'].drain()
+        'JOBS_WORKERS': 0,
+        # Tests apply cache invalidations explicitly with poll_once(), and
+        # entry events reach streams of the same process without a listener
+        'INVALIDATION_MODE': None,
+        'ENTRY_FEED_MODE': None
     })
 
     with app.app_context():
@@ -36,6 +45,8 @@ def app():
             db.get_collection('users').delete_many({})
             db.get_collection('indexes').delete_many({})
             db.get_collection('entries').delete_many({})
+            db.get_collection('upload_sessions').delete_many({})
+            db.get_collection('jobs').delete_many({})
         except:
             pass
         finally:
@@ -53,7 +64,7 @@ def db(app):
         db = get_database()
         db.connect()  # Ensure database is connected
         # Clear database before each test
-        for collection in ['users', 'indexes', 'entries']:
+        for collection in ['users', 'indexes', 'entries', 'upload_sessions', 'jobs']:
             db.get_collection(collection).delete_many({})
         yield db
 
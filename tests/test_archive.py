@@ -0,0 +1,160 @@
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+from bson import ObjectId
+
+from api.core.models import Entry
+
+@pytest.fixture
+def populated_index(client, auth_headers, test_index):
+    """Add two text entries and a file entry to the test index"""
+    entry_ids = []
+    for content in ('First note', 'Second note'):
+        response = client.post(
+            f'/api/indexes/{test_index["_id"]}/entries',
+            json={'content': content, 'keywords': ['note']},
+            headers=auth_headers
+        )
+        entry_ids.append(response.json['id'])
+    response = client.post(
+        f'/api/indexes/{test_index["_id"]}/entries',
+        data={'file': (io.BytesIO(b'x' * 1000), 'data.bin'), 'keywords': 'file'},
+        headers=auth_headers,
+        content_type='multipart/form-data'
+    )
+    entry_ids.append(response.json['id'])
+    return test_index, entry_ids, response.json['file_id']
+
+def _manifest(members):
+    """Entries from the manifest members of an archive, in order"""
+    return [json.loads(line) for name, data in members if name.startswith('manifest/')
+            for line in data.decode().splitlines()]
+
+def test_export_tar(client, auth_headers, populated_index):
+    """Test an index is exported as a tar archive with its files"""
+    index, entry_ids, file_id = populated_index
+    response = client.get(f'/api/indexes/{index["_id"]}/export', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/x-tar'
+
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        members = [(m.name, archive.extractfile(m).read()) for m in archive.getmembers()]
+    names = [name for name, _ in members]
+    assert names == ['index.json', 'manifest/00000.ndjson', f'files/{file_id}', 'summary.json']
+    assert json.loads(members[0][1])['name'] == index['name']
+    assert [e['id'] for e in _manifest(members)] == entry_ids
+    assert members[2][1] == b'x' * 1000
+    assert json.loads(members[-1][1])['entries'] == 3
+
+def test_export_zip_resume(client, auth_headers, populated_index):
+    """Test an export resumes after a given entry"""
+    index, entry_ids, file_id = populated_index
+    response = client.get(
+        f'/api/indexes/{index["_id"]}/export?format=zip&after={entry_ids[0]}',
+        headers=auth_headers
+    )
+    assert response.status_code == 200
+
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        members = [(name, archive.read(name)) for name in archive.namelist()]
+    assert [e['id'] for e in _manifest(members)] == entry_ids[1:]
+    assert dict(members)[f'files/{file_id}'] == b'x' * 1000
+    assert json.loads(dict(members)['summary.json'])['last_entry_id'] == entry_ids[-1]
+
+    response = client.get(f'/api/indexes/{index["_id"]}/export?format=rar', headers=auth_headers)
+    assert response.status_code == 400
+
+def test_export_command(app, populated_index, tmp_path):
+    """Test the export CLI writes an archive file"""
+    index, entry_ids, _ = populated_index
+    output = tmp_path / 'export.tar'
+    result = app.test_cli_runner().invoke(args=['indexes', 'export', str(index['_id']), '-o', str(output)])
+    assert result.exit_code == 0, result.output
+
+    with tarfile.open(output) as archive:
+        assert 'summary.json' in archive.getnames()
+
+def _tar(members):
+    """Build a tar archive from (name, bytes) pairs"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def test_import_round_trip(app, client, auth_headers, populated_index):
+    """Test an exported index is imported as a new index"""
+    index, entry_ids, _ = populated_index
+    exported = client.get(f'/api/indexes/{index["_id"]}/export', headers=auth_headers).data
+
+    response = client.post('/api/indexes/import?name=Copy', data=exported, headers=auth_headers,
+                           content_type='application/x-tar')
+    assert response.status_code == 201
+    assert response.json['entries'] == 3
+    assert response.json['files'] == 1
+    assert response.json['errors'] == []
+
+    copy_id = response.json['index_id']
+    entries = client.get(f'/api/indexes/{copy_id}/entries?per_page=10', headers=auth_headers).json
+    assert sorted(e['content'] or '' for e in entries) == ['', 'First note', 'Second note']
+    file_entry = next(e for e in entries if e['type'] == 'file')
+    response = client.get(f'/api/indexes/{copy_id}/entries/{file_entry["id"]}', headers=auth_headers)
+    assert response.data == b'x' * 1000
+
+    # Imported entries are analyzed like new ones
+    app.extensions['jobs'].drain()
+    with app.app_context():
+        note = Entry.get_collection().find_one({'index_id': ObjectId(copy_id), 'content': 'First note'})
+    assert 'first' in note['extracted_keywords']
+
+    # The name is taken now
+    response = client.post('/api/indexes/import?name=Copy', data=exported, headers=auth_headers,
+                           content_type='application/x-tar')
+    assert response.status_code == 400
+
+def test_import_reports_item_errors(client, auth_headers, test_index):
+    """Test bad entries are reported without stopping the import"""
+    records = [
+        {'id': 'a', 'type': 'text', 'content': 'Kept', 'keywords': [], 'created_at': '2024-01-01T00:00:00+00:00'},
+        {'id': 'b', 'type': 'video', 'content': 'Bad type', 'created_at': '2024-01-01T00:00:00+00:00'},
+        {'id': 'c', 'type': 'file', 'file_id': 'f1', 'metadata': {'filename': 'gone.txt'},
+         'created_at': '2024-01-01T00:00:00+00:00'},
+        {'id': 'd', 'type': 'file', 'file_id': 'f2', 'metadata': {'filename': 'kept.txt'},
+         'created_at': '2024-01-01T00:00:00+00:00'}
+    ]
+    archive = _tar([
+        ('index.json', json.dumps({'version': 1, 'name': 'Ignored'}).encode()),
+        ('manifest/00000.ndjson', ''.join(json.dumps(r) + '\n' for r in records).encode()),
+        ('files/f2', b'kept')
+    ])
+
+    response = client.post(f'/api/indexes/{test_index["_id"]}/import', data=archive,
+                           headers=auth_headers, content_type='application/x-tar')
+    assert response.status_code == 200
+    assert response.json['index_id'] == str(test_index['_id'])
+    assert response.json['entries'] == 2
+    assert response.json['files'] == 1
+    assert response.json['failed'] == 2
+    assert {e['id'] for e in response.json['errors']} == {'b', 'c'}
+
+    response = client.post(f'/api/indexes/{test_index["_id"]}/import', data=b'not an archive',
+                           headers=auth_headers, content_type='application/x-tar')
+    assert response.status_code == 400
+
+def test_import_command(app, client, auth_headers, populated_index, test_user, tmp_path):
+    """Test the import CLI loads a zip export"""
+    index, _, _ = populated_index
+    path = tmp_path / 'export.zip'
+    path.write_bytes(client.get(f'/api/indexes/{index["_id"]}/export?format=zip', headers=auth_headers).data)
+
+    result = app.test_cli_runner().invoke(args=[
+        'indexes', 'import', str(path), '--user', test_user['username'], '--name', 'From CLI', '--workers', '2'
+    ])
+    assert result.exit_code == 0, result.output
+    assert 'Imported 3 entries and 1 files' in result.output
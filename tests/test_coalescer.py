@@ -0,0 +1,57 @@
+import threading
+
+from bson import ObjectId
+
+from api.core.coalescer import CoalescedInsertError, WriteCoalescer
+from api.core.models import Entry
+
+def test_concurrent_inserts_batched(app, monkeypatch):
+    """Test concurrent inserts share one insert_many and get their own outcome"""
+    with app.app_context():
+        collection = Entry.get_collection()
+        duplicate = ObjectId()
+        collection.insert_one({'_id': duplicate, 'content': 'existing'})
+
+        batches = []
+        insert_many = type(collection).insert_many
+        def counting_insert_many(self, documents, *args, **kwargs):
+            batches.append(len(documents))
+            return insert_many(self, documents, *args, **kwargs)
+        monkeypatch.setattr(type(collection), 'insert_many', counting_insert_many)
+
+    coalescer = WriteCoalescer('entries', max_batch=8)
+    documents = [{'_id': ObjectId(), 'content': f'reading {i}'} for i in range(7)]
+    documents.append({'_id': duplicate, 'content': 'duplicate'})
+    results = [None] * len(documents)
+
+    def insert(i):
+        with app.app_context():
+            try:
+                results[i] = coalescer.insert(documents[i], max_delay=5)
+            except CoalescedInsertError as e:
+                results[i] = e
+
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(len(documents))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    # The batch was flushed when it filled up, well before its deadline
+    assert batches == [8]
+    assert results[:7] == [str(document['_id']) for document in documents[:7]]
+    assert isinstance(results[7], CoalescedInsertError)
+    with app.app_context():
+        assert Entry.get_collection().count_documents({'content': {'$regex': '^reading'}}) == 7
+
+def test_route_coalesces_inserts(app, client, auth_headers, test_index):
+    """Test a route listed in WRITE_COALESCING inserts through the coalescer"""
+    app.config['WRITE_COALESCING'] = {'indexes.entries.create_entry': 0.001}
+    response = client.post(f'/api/indexes/{test_index["_id"]}/entries',
+                           json={'content': 'Sensor reading'}, headers=auth_headers)
+    assert response.status_code == 201
+    assert ('entries', None) in app.extensions['write_coalescers']
+    with app.app_context():
+        entry = Entry.get_collection().find_one({'_id': ObjectId(response.json['id'])})
+    assert entry['content'] == 'Sensor reading'
+    assert entry['index_id'] == test_index['_id']
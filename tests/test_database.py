@@ -3,6 +3,7 @@ from datetime import datetime, UTC
 from bson import ObjectId
 
 from api.core.database import (
+    BulkInsertError,
     DatabaseProvider,
     get_database,
     get_file_storage,
@@ -160,4 +161,111 @@ def test_collection_indexes(app, db):
         collection.drop_index(index_name)
         
         # After dropping index, should be able to insert duplicate
-        collection.insert_one({'value': 1})
\ No newline at end of file
+        collection.insert_one({'value': 1})
+
+def test_insert_many_errors(app, db):
+    """Test failed documents of a bulk insert are reported by position"""
+    with app.app_context():
+        collection = db.get_collection('test_collection')
+        collection.delete_many({})
+        duplicate = ObjectId()
+        collection.insert_one({'_id': duplicate})
+        
+        docs = [{'_id': ObjectId()}, {'_id': duplicate}, {'_id': ObjectId()}]
+        with pytest.raises(BulkInsertError) as ordered:
+            collection.insert_many([dict(doc) for doc in docs])
+        assert ordered.value.inserted_ids == [str(docs[0]['_id'])]
+        assert [index for index, _ in ordered.value.errors] == [1]
+        
+        collection.delete_one({'_id': docs[0]['_id']})
+        with pytest.raises(BulkInsertError) as unordered:
+            collection.insert_many([dict(doc) for doc in docs], ordered=False)
+        assert unordered.value.inserted_ids == [str(docs[0]['_id']), str(docs[2]['_id'])]
+        assert collection.count_documents({}) == 3
+
+def test_memory_backend_queries():
+    """Test query and update operators of the in-process database"""
+    from api.core.database.memory import MemoryFactory
+    
+    collection = MemoryFactory().create_database().get_collection('test_collection')
+    collection.insert_many([
+        {'_id': ObjectId(), 'value': i, 'tags': ['even' if i % 2 == 0 else 'odd']}
+        for i in range(6)
+    ])
+    
+    assert collection.count_documents({'value': {'$gte': 2, '$lt': 5}}) == 3
+    assert collection.count_documents({'tags': 'even'}) == 3
+    assert collection.count_documents({'$or': [{'value': 0}, {'value': {'$in': [4, 5]}}]}) == 3
+    
+    results = collection.find_many({'tags': {'$ne': 'even'}}, sort=[('value', -1)], limit=2)
+    assert [doc['value'] for doc in results] == [5, 3]
+    
+    # Update operators and plain field updates
+    collection.update_one({'value': 1}, {'$inc': {'value': 10}, '$addToSet': {'tags': 'big'}})
+    collection.update_one({'value': 2}, {'label': 'two'})
+    assert collection.find_one({'value': 11})['tags'] == ['odd', 'big']
+    assert collection.find_one({'value': 2})['label'] == 'two'
+    
+    # Returned documents are copies
+    doc = collection.find_one({'value': 3})
+    doc['value'] = 100
+    assert collection.count_documents({'value': 100}) == 0
+
+def test_database_provider_after_fork(app, monkeypatch):
+    """Test a new factory is built when used from a forked process"""
+    import os
+    
+    with app.app_context():
+        factory = DatabaseProvider.get_factory()
+        assert DatabaseProvider.get_factory() is factory
+        
+        # Pretend we are running in a forked worker
+        monkeypatch.setattr(os, 'getpid', lambda: -1)
+        forked = DatabaseProvider.get_factory()
+        if DatabaseProvider.in_process():
+            # The in-process database holds the data, so the fork keeps it
+            assert forked is factory
+        else:
+            assert forked is not factory
+            assert isinstance(forked, type(factory))
+        assert DatabaseProvider.get_factory() is forked
+
+def test_memory_backend_single_worker(app):
+    """Test gunicorn refuses to fork several workers off the in-process database"""
+    import os
+    import runpy
+    from types import SimpleNamespace
+    
+    hooks = runpy.run_path(os.path.join(os.path.dirname(__file__), '..', 'gunicorn.conf.py'))
+    with app.app_context():
+        for workers in (1, 4):
+            server = SimpleNamespace(cfg=SimpleNamespace(workers=workers))
+            if workers > 1 and DatabaseProvider.in_process():
+                with pytest.raises(RuntimeError):
+                    hooks['on_starting'](server)
+            else:
+                hooks['on_starting'](server)
+
+def test_projected_reads(app, db):
+    """Test projected reads return only the listed fields, and models are built from raw or decoded documents"""
+    import bson
+    from bson.raw_bson import RawBSONDocument
+    from api.core.models import Entry
+    
+    with app.app_context():
+        collection = db.get_collection('entries')
+        entry = Entry(index_id=ObjectId(), user_id=ObjectId(), type='text', content='Hello',
+                      metadata={'source': {'app': 'cli'}}).to_dict()
+        entry['_id'] = ObjectId()
+        entry['terms'] = ['hello']
+        collection.insert_one(entry)
+        
+        found = collection.find_many({'_id': entry['_id']}, fields=Entry.API_FIELDS)
+        assert set(found[0].keys()) == {'_id', 'type', 'content', 'metadata', 'keywords', 'created_at'}
+        
+        for document in (found[0], RawBSONDocument(bson.encode(entry))):
+            model = Entry.from_document(document)
+            assert not hasattr(model, '__dict__')
+            assert model.id == entry['_id']
+            assert model.to_json()['metadata'] == {'source': {'app': 'cli'}}
+            assert model.to_json()['content'] == 'Hello'
@@ -221,4 +221,57 @@ def test_unauthorized_access(client, test_index):
     response = client.get(f'/api/indexes/{test_index["_id"]}/entries/search?q=test')
     assert response.status_code == 401
     assert 'msg' in response.json
-    assert response.json['msg'] == 'Missing Authorization Header'
\ No newline at end of file
+    assert response.json['msg'] == 'Missing Authorization Header'
+
+def test_create_multiple_file_entries(client, auth_headers, test_index):
+    """Test each file part of one request becomes an entry"""
+    files = [(io.BytesIO(f'photo {i}'.encode()), f'photo{i}.jpg') for i in range(5)]
+    response = client.post(
+        f'/api/indexes/{test_index["_id"]}/entries',
+        data={'file': files, 'keywords': 'holiday'},
+        headers=auth_headers,
+        content_type='multipart/form-data'
+    )
+    
+    assert response.status_code == 201
+    data = json.loads(response.data)
+    assert data['created'] == 5
+    assert [r['filename'] for r in data['results']] == [f'photo{i}.jpg' for i in range(5)]
+    assert all(r['entry']['keywords'] == ['holiday'] for r in data['results'])
+    
+    entry_id = data['results'][3]['entry']['id']
+    response = client.get(f'/api/indexes/{test_index["_id"]}/entries/{entry_id}', headers=auth_headers)
+    assert response.data == b'photo 3'
+
+def test_pagination_headers(app, client, auth_headers, test_index):
+    """Test list and search responses carry totals and page links"""
+    base = f'/api/indexes/{test_index["_id"]}/entries'
+    for i in range(5):
+        client.post(base, json={'content': f'Note {i}', 'keywords': ['note']}, headers=auth_headers)
+
+    response = client.get(f'{base}?page=2&per_page=2', headers=auth_headers)
+    assert len(response.json) == 2
+    assert response.headers['X-Total-Count'] == '5'
+    assert response.headers['X-Total-Count-Exact'] == 'true'
+    links = response.headers['Link']
+    for rel, page in (('first', 1), ('prev', 1), ('next', 3), ('last', 3)):
+        assert f'page={page}&per_page=2>; rel="{rel}"' in links
+
+    response = client.get(f'{base}/search?q=note&per_page=2&page=3', headers=auth_headers)
+    assert response.json['total'] == 5
+    assert len(response.json['entries']) == 1
+    assert 'rel="next"' not in response.headers['Link']
+
+    # The cached count is dropped once the index changes
+    client.post(base, json={'content': 'Note 5', 'keywords': ['note']}, headers=auth_headers)
+    response = client.get(f'{base}/search?q=note', headers=auth_headers)
+    assert response.json['total'] == 6
+
+    # Past the limit the total is a lower bound, without a last page
+    app.config['COUNT_LIMIT'] = 4
+    client.post(base, json={'content': 'Note 6', 'keywords': ['note']}, headers=auth_headers)
+    response = client.get(f'{base}/search?q=note&per_page=2', headers=auth_headers)
+    assert (response.json['total'], response.json['total_exact']) == (4, False)
+    assert response.headers['X-Total-Count-Exact'] == 'false'
+    assert 'rel="next"' in response.headers['Link']
+    assert 'rel="last"' not in response.headers['Link']
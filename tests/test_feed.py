@@ -0,0 +1,77 @@
+import threading
+import time
+from datetime import datetime, UTC
+
+import pytest
+from bson import ObjectId
+
+from api.core.errors import ServiceUnavailableError
+from api.core.feed import EntryFeed
+
+def _events_url(index):
+    return f"/api/indexes/{index['_id']}/entries/events"
+
+def test_live_events(app, client, auth_headers, test_index):
+    """Test a stream pushes entries created while it is open, with heartbeats in between"""
+    app.config.update(SSE_HEARTBEAT_SECONDS=0.05, SSE_MAX_SECONDS=5)
+    response = client.get(_events_url(test_index), headers=auth_headers, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    def create():
+        time.sleep(0.2)
+        app.test_client().post(f"/api/indexes/{test_index['_id']}/entries",
+                               json={'content': 'Live note'}, headers=auth_headers)
+    writer = threading.Thread(target=create)
+    writer.start()
+
+    received = ''
+    for chunk in response.response:
+        received += chunk.decode()
+        if 'event: created' in received:
+            break
+    response.close()
+    writer.join()
+    assert received.startswith('retry: ')
+    assert ': heartbeat' in received
+    assert '"content": "Live note"' in received
+    assert app.extensions['entry_feed'].subscribers == []
+
+def test_resume_with_last_event_id(app, client, auth_headers, test_index):
+    """Test a reconnecting stream replays the events it missed"""
+    app.config.update(SSE_HEARTBEAT_SECONDS=0.05, SSE_MAX_SECONDS=0.1)
+    base = f"/api/indexes/{test_index['_id']}/entries"
+    ids = [client.post(base, json={'content': f'Note {i}'}, headers=auth_headers).json['id'] for i in range(3)]
+    assert client.delete(f'{base}/{ids[0]}', headers=auth_headers).status_code == 204
+
+    with app.app_context():
+        events = app.extensions['entry_feed'].collection().find_many(
+            {'index_id': test_index['_id']}, sort=[('_id', 1)]
+        )
+    assert [event['type'] for event in events] == ['created'] * 3 + ['deleted']
+
+    body = client.get(_events_url(test_index), headers={**auth_headers, 'Last-Event-ID': str(events[0]['_id'])}).text
+    replayed = [line[4:] for line in body.splitlines() if line.startswith('id: ')]
+    assert replayed == [str(event['_id']) for event in events[1:]]
+    assert 'event: deleted' in body
+
+    # Events older than the log are gone, so the client is told to reload
+    too_old = ObjectId.from_datetime(datetime(2000, 1, 1, tzinfo=UTC))
+    body = client.get(_events_url(test_index), headers={**auth_headers, 'Last-Event-ID': str(too_old)}).text
+    assert 'event: reset' in body
+
+def test_slow_subscriber_is_closed():
+    """Test a stream that falls behind is closed instead of buffering, and streams are capped"""
+    feed = EntryFeed(mode=None, max_queue=2, max_streams=1)
+    user_id, index_id = ObjectId(), ObjectId()
+    subscriber = feed.subscribe(user_id, index_id)
+    with pytest.raises(ServiceUnavailableError):
+        feed.subscribe(user_id)
+
+    for _ in range(3):
+        feed.deliver({'_id': ObjectId(), 'type': 'created', 'user_id': user_id, 'index_id': index_id, 'data': {}})
+    assert subscriber.closed
+
+    stream = feed.stream(subscriber, None, heartbeat=1, max_seconds=5, replay_limit=10)
+    assert list(stream) == ['retry: 1000\n\n']
+    assert feed.subscribers == []
@@ -0,0 +1,103 @@
+import io
+from datetime import datetime, timedelta, UTC
+
+import pytest
+from bson import ObjectId
+
+from api.core.database import get_file_storage
+from api.core import fsck
+from api.core.fsck import ConsistencyScan, check_consistency, id_ranges, merge_reports, problems_found
+from api.core.models import Entry
+
+def _upload(client, index_id, auth_headers, data=b'x' * 100):
+    return client.post(f'/api/indexes/{index_id}/entries', data={'file': (io.BytesIO(data), 'f.bin')},
+                       headers=auth_headers, content_type='multipart/form-data').json
+
+def test_check_consistency(app, client, auth_headers, test_index):
+    """Test dangling entries, missing files and missing renditions are reported, then repaired"""
+    base = f"/api/indexes/{test_index['_id']}/entries"
+    kept = _upload(client, test_index['_id'], auth_headers)
+    client.post(base, json={'content': 'A note'}, headers=auth_headers)
+    lost = _upload(client, test_index['_id'], auth_headers)
+
+    doomed_index = client.post('/api/indexes/', json={'name': 'Doomed'}, headers=auth_headers).json['id']
+    dangling = client.post(f'/api/indexes/{doomed_index}/entries', json={'content': 'Left behind'},
+                           headers=auth_headers).json
+    assert client.delete(f'/api/indexes/{doomed_index}', headers=auth_headers).status_code == 204
+
+    with app.app_context():
+        storage = get_file_storage()
+        storage.delete_file(lost['file_id'])
+        Entry.get_collection().update_one({'_id': ObjectId(kept['id'])}, {'$set': {
+            'renditions.thumb': {'file_id': ObjectId(), 'content_type': 'image/webp', 'size': 10}
+        }})
+
+        report = check_consistency(app.config, rate=0, examples=100)
+        assert report['entries_scanned'] == 4
+        assert report['dangling_entries'] == 1 and report['examples']['dangling_entries'] == [dangling['id']]
+        assert report['missing_files'] == 1 and report['examples']['missing_files'] == [lost['id']]
+        assert report['examples']['missing_renditions'] == [f"{kept['id']}/thumb"]
+        assert report['repaired'] == 0
+
+        report = check_consistency(app.config, repair=True, rate=0, batch_size=2)
+        assert report['repaired'] == 3
+        assert Entry.get_collection().find_one({'_id': ObjectId(lost['id'])}) is None
+        assert Entry.get_collection().find_one({'_id': ObjectId(dangling['id'])}) is None
+        assert 'thumb' not in Entry.get_collection().find_one({'_id': ObjectId(kept['id'])}).get('renditions', {})
+
+        report = check_consistency(app.config, rate=0)
+        assert problems_found(report) == 0 and report['entries_scanned'] == 2
+
+    assert client.get(f"{base}/{kept['id']}", headers=auth_headers).status_code == 200
+
+def test_corrupt_file(app, client, auth_headers, test_index):
+    """Test GridFS files lacking chunks are reported, and their entries repaired with them"""
+    with app.app_context():
+        storage = get_file_storage()
+        if not hasattr(storage, 'database'):
+            pytest.skip('Only GridFS stores files in chunks')
+    entry = _upload(client, test_index['_id'], auth_headers, data=b'c' * (600 * 1024))
+
+    with app.app_context():
+        storage.database['fs.chunks'].delete_one({'files_id': ObjectId(entry['file_id']), 'n': 1})
+        report = check_consistency(app.config, rate=0, examples=100)
+        assert entry['file_id'] in report['examples']['corrupt_files']
+        assert report['missing_files'] == 0
+
+        report = check_consistency(app.config, repair=True, rate=0, examples=100)
+        assert entry['file_id'] in report['examples']['corrupt_files']
+        assert report['examples']['missing_files'] == [entry['id']]
+        assert Entry.get_collection().find_one({'_id': ObjectId(entry['id'])}) is None
+
+def test_id_ranges(app, client, auth_headers, test_index):
+    """Test _id ranges cover every ID exactly once, and scans over them add up to a whole scan"""
+    start = datetime(2024, 1, 1, tzinfo=UTC)
+    ranges = id_ranges(ObjectId.from_datetime(start), 4, until=start + timedelta(days=4))
+    assert len(ranges) == 4 and ranges[0][0] is None and ranges[-1][1] is None
+    for days in (0, 0.5, 1, 2.9999, 3, 10):
+        object_id = ObjectId.from_datetime(start + timedelta(days=days))
+        inside = [(after, before) for after, before in ranges
+                  if (after is None or object_id > after) and (before is None or object_id < before)]
+        assert len(inside) == 1
+    assert id_ranges(None, 4) == [(None, None)]
+
+    for i in range(5):
+        client.post(f"/api/indexes/{test_index['_id']}/entries", json={'content': f'Note {i}'}, headers=auth_headers)
+    with app.app_context():
+        lowest = Entry.get_collection().find_many({}, sort=[('_id', 1)], limit=1)[0]['_id']
+        reports = []
+        for after, before in id_ranges(lowest, 3, until=datetime.now(UTC) + timedelta(seconds=3)):
+            scan = ConsistencyScan(batch_size=2)
+            scan.scan_entries(after, before)
+            reports.append(scan.report)
+        assert merge_reports(reports)['entries_scanned'] == 5
+
+def test_consistency_job_single_process(app, monkeypatch):
+    """Test queued checks never fork the job worker, whatever FSCK_PROCESSES says"""
+    calls = []
+    monkeypatch.setattr(fsck, 'check_consistency', lambda config, **options: calls.append(options) or fsck.new_report())
+    app.config['FSCK_PROCESSES'] = 4
+    with app.app_context():
+        assert fsck.schedule_consistency_check() == 1
+    app.extensions['jobs'].drain()
+    assert [options['processes'] for options in calls] == [1]
@@ -0,0 +1,60 @@
+import io
+
+import pytest
+from bson import ObjectId
+
+from api.core.database import get_file_storage
+from api.core.garbage import IOBudget, collect_garbage
+from api.core.models import Entry
+
+def _exists(storage, file_id):
+    try:
+        storage.get_file(str(file_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+def test_collect_garbage(app, client, auth_headers, test_index):
+    """Test orphaned files and the entries of deleted indexes are collected, and referenced files kept"""
+    base = f"/api/indexes/{test_index['_id']}/entries"
+    kept = client.post(base, data={'file': (io.BytesIO(b'k' * 100), 'kept.bin')}, headers=auth_headers,
+                       content_type='multipart/form-data').json['file_id']
+
+    doomed_index = client.post('/api/indexes/', json={'name': 'Doomed'}, headers=auth_headers).json['id']
+    dangling = client.post(f'/api/indexes/{doomed_index}/entries', data={'file': (io.BytesIO(b'd' * 300), 'd.bin')},
+                           headers=auth_headers, content_type='multipart/form-data').json
+    assert client.delete(f'/api/indexes/{doomed_index}', headers=auth_headers).status_code == 204
+
+    with app.app_context():
+        storage = get_file_storage()
+        orphan = storage.store_file(b'o' * 200, 'orphan.bin', 'application/octet-stream')
+        # Entries of older releases keep their file ID as a string
+        legacy = storage.store_file(b'l' * 50, 'legacy.bin', 'application/octet-stream')
+        Entry.get_collection().insert_one({'_id': ObjectId(), 'index_id': test_index['_id'],
+                                           'user_id': test_index['user_id'], 'type': 'file',
+                                           'file_id': legacy, 'metadata': {}, 'keywords': []})
+
+        # Everything is within the grace period
+        counts = collect_garbage(app.config, grace_seconds=3600, dry_run=True)
+        assert counts['orphan_files'] == 0 and counts['dangling_entries'] == 0
+
+        counts = collect_garbage(app.config, grace_seconds=0, dry_run=True)
+        assert counts['dangling_entries'] == 1
+        assert _exists(storage, orphan)
+
+        counts = collect_garbage(app.config, grace_seconds=0, io_budget=0)
+        assert counts['dangling_entries'] == 1
+        assert counts['bytes_reclaimed'] >= 500
+        assert not _exists(storage, orphan)
+        assert not _exists(storage, dangling['file_id'])
+        assert Entry.get_collection().find_one({'_id': ObjectId(dangling['id'])}) is None
+        assert _exists(storage, kept) and _exists(storage, legacy)
+
+def test_io_budget(monkeypatch):
+    """Test the budget sleeps once work runs ahead of its rate"""
+    slept = []
+    monkeypatch.setattr('api.core.garbage.time.sleep', slept.append)
+    budget = IOBudget(1000)
+    budget.spend(500)
+    budget.spend(1500)
+    assert slept and slept[-1] == pytest.approx(2.0, abs=0.1)
@@ -0,0 +1,64 @@
+import os
+import threading
+
+import pytest
+
+from api import create_app
+from api.core.database import DatabaseBootstrap, DatabaseProvider
+from api.core.database import factory
+
+@pytest.fixture
+def blocked_bootstrap(monkeypatch):
+    """Hold index creation until the returned event is set"""
+    release = threading.Event()
+    ensure_indexes = factory.ensure_indexes
+
+    def slow_ensure_indexes(db):
+        if not release.wait(10):
+            raise RuntimeError('Database unavailable')
+        ensure_indexes(db)
+
+    monkeypatch.setattr(factory, 'ensure_indexes', slow_ensure_indexes)
+    yield release
+    release.set()
+
+def test_readiness_gate(auth_headers, blocked_bootstrap):
+    """Test requests are held back until the background bootstrap finishes"""
+    app = create_app({
+        'TESTING': True,
+        'DATABASE_BACKEND': os.environ.get('TEST_DATABASE_BACKEND', 'mongodb'),
+        'DATABASE_BOOTSTRAP': 'background',
+        'MONGO_DB_NAME': 'cloud_storage_test',
+        'JWT_SECRET_KEY': 'test-jwt-secret-key',
+        'REGISTER_BLUEPRINTS': True,
+        'JOBS_WORKERS': 0,
+        'INVALIDATION_MODE': None,
+        'ENTRY_FEED_MODE': None
+    })
+    client = app.test_client()
+    try:
+        assert client.get('/health/live').status_code == 200
+        assert client.get('/health/ready').status_code == 503
+        response = client.get('/api/indexes/', headers=auth_headers)
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+        blocked_bootstrap.set()
+        assert app.extensions['database_bootstrap'].wait(5)
+        assert client.get('/health/ready').json == {'status': 'ready'}
+        assert client.get('/api/indexes/', headers=auth_headers).status_code == 200
+    finally:
+        DatabaseProvider.reset()
+
+def test_bootstrap_restarted_after_fork(app, blocked_bootstrap):
+    """Test an unfinished bootstrap is restarted when its thread is gone"""
+    bootstrap = DatabaseBootstrap()
+    # A thread that has exited, as seen by a forked child
+    bootstrap._thread = threading.Thread(target=lambda: None)
+    bootstrap._thread.start()
+    bootstrap._thread.join()
+
+    assert not bootstrap.is_ready()
+    blocked_bootstrap.set()
+    assert bootstrap.wait(5)
+    assert bootstrap.is_ready()
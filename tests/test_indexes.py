@@ -1,8 +1,12 @@
+import io
+
 import pytest
 from flask import json
 from bson import ObjectId
 from datetime import datetime, UTC
 
+from api.core.database import get_database
+
 def test_create_index(client, auth_headers):
     """Test creating a new index"""
     response = client.post('/api/indexes/', json={
@@ -50,6 +54,7 @@ def test_get_indexes(client, auth_headers, test_index, db):
     
     response = client.get('/api/indexes/', headers=auth_headers)
     assert response.status_code == 200
+    assert response.headers['X-Total-Count'] == '2'
     
     data = json.loads(response.data)
     assert isinstance(data, list)
@@ -155,4 +160,46 @@ def test_unauthorized_access(client, test_index):
     
     # Try to delete index
     response = client.delete(f'/api/indexes/{test_index["_id"]}')
-    assert response.status_code == 401
\ No newline at end of file
+    assert response.status_code == 401
+
+def test_index_stats(app, client, auth_headers, test_index):
+    """Test index stats follow entry writes and can be rebuilt"""
+    index_url = f'/api/indexes/{test_index["_id"]}'
+    client.post(f'{index_url}/entries', json={'content': 'A note'}, headers=auth_headers)
+    response = client.post(
+        f'{index_url}/entries',
+        data={'file': [(io.BytesIO(b'x' * 10), 'a.txt'), (io.BytesIO(b'x' * 5), 'b.txt')]},
+        headers=auth_headers,
+        content_type='multipart/form-data'
+    )
+    previous, newest = (result['entry'] for result in response.json['results'])
+    
+    stats = client.get('/api/indexes/', headers=auth_headers).json[0]['stats']
+    assert {k: stats[k] for k in ('entries', 'text', 'file', 'bytes')} == {
+        'entries': 3, 'text': 1, 'file': 2, 'bytes': 15
+    }
+    # Stored dates keep millisecond precision
+    newest_at = datetime.fromisoformat(newest['created_at'])
+    assert abs(datetime.fromisoformat(stats['last_entry_at']) - newest_at).total_seconds() < 0.001
+    
+    client.delete(f'{index_url}/entries/{newest["id"]}', headers=auth_headers)
+    stats = client.get(index_url, headers=auth_headers).json['stats']
+    assert (stats['entries'], stats['file'], stats['bytes']) == (2, 1, 10)
+    previous_at = datetime.fromisoformat(previous['created_at'])
+    assert abs(datetime.fromisoformat(stats['last_entry_at']) - previous_at).total_seconds() < 0.001
+    
+    # Drifted counters are recomputed from the entries
+    with app.app_context():
+        db = get_database()
+        db.get_collection('indexes').update_one({'_id': test_index['_id']}, {'$set': {'stats.entries': 99}})
+    result = app.test_cli_runner().invoke(args=['indexes', 'rebuild-stats', str(test_index['_id'])])
+    assert result.exit_code == 0, result.output
+    assert client.get(index_url, headers=auth_headers).json['stats']['entries'] == 2
+    
+    # Indexes created before stats were kept are counted on their first write
+    with app.app_context():
+        db.get_collection('indexes').update_one({'_id': test_index['_id']}, {'$unset': {'stats': ''}})
+    client.post(f'{index_url}/entries', json={'content': 'Another note'}, headers=auth_headers)
+    response = client.get(f'{index_url}/entries', headers=auth_headers)
+    assert response.headers['X-Total-Count'] == '3'
+    assert client.get(index_url, headers=auth_headers).json['stats']['text'] == 2
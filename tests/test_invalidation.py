@@ -0,0 +1,50 @@
+import time
+
+from api.core.invalidation import InvalidationBus, LocalCache, entry_tag, index_tag
+
+def test_local_cache_tags_and_expiry():
+    """Test cached values are dropped by their tags, by age and by size"""
+    cache = LocalCache('test', size=2, ttl=0.2)
+    cache.set('a', 1, ['index:1', 'entry:a'])
+    cache.set('b', 2, ['index:1', 'entry:b'])
+    assert cache.invalidate(['entry:a']) == 1
+    assert cache.get('a') is None and cache.get('b') == 2
+
+    # A value loaded before an invalidation is not cached after it
+    def load():
+        cache.invalidate(['index:1'])
+        return 3
+    assert cache.fetch('c', load, lambda value: ['index:1']) == 3
+    assert cache.get('c') is None and cache.get('b') is None
+
+    cache.set('d', 4, [])
+    cache.set('e', 5, [])
+    cache.set('f', 6, [])
+    assert len(cache) == 2 and cache.get('d') is None
+    time.sleep(0.3)
+    assert cache.get('f') is None
+
+def test_invalidations_reach_other_processes(app, client, auth_headers, test_index):
+    """Test writes drop the values other processes cached for what they changed"""
+    base = f"/api/indexes/{test_index['_id']}/entries"
+    entry_id = client.post(base, json={'content': 'Cached note'}, headers=auth_headers).json['id']
+    assert client.get(f'{base}/{entry_id}', headers=auth_headers).status_code == 200
+    assert len(app.extensions['caches']['entries']) == 1
+
+    # Another worker, with its own caches and bus
+    other = InvalidationBus(mode='poll')
+    entries = other.register(LocalCache('entries'))
+    with app.app_context():
+        other.poll_once()
+        app.extensions['invalidation'].poll_once()
+    entries.set(entry_id, {'content': 'Cached note'}, [entry_tag(entry_id), index_tag(test_index['_id'])])
+
+    assert client.delete(f'{base}/{entry_id}', headers=auth_headers).status_code == 204
+    assert len(app.extensions['caches']['entries']) == 0
+    assert client.get(f'{base}/{entry_id}', headers=auth_headers).status_code == 404
+    with app.app_context():
+        assert other.poll_once() == 1
+        assert entries.get(entry_id) is None
+        # Events are applied once, and a process skips its own
+        assert other.poll_once() == 0
+        assert app.extensions['invalidation'].poll_once() == 0
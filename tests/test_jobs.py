@@ -0,0 +1,85 @@
+import threading
+from datetime import datetime, timedelta, UTC
+
+import pytest
+
+from api.core import jobs
+from api.core.jobs import JobWorker, claim, enqueue
+from api.core.models import Job
+
+@pytest.fixture
+def handlers(monkeypatch):
+    """Record the payloads of test jobs, failing those that ask to"""
+    ran = []
+
+    def record(payload):
+        if payload.get('fail'):
+            raise RuntimeError('boom')
+        ran.append(payload['n'])
+
+    monkeypatch.setitem(jobs.HANDLERS, 'test', record)
+    return ran
+
+def test_jobs_run_by_priority(app, db, handlers):
+    """Test due jobs are claimed by priority, then in the order they are due"""
+    with app.app_context():
+        enqueue('test', {'n': 1})
+        enqueue('test', {'n': 2}, priority=5)
+        enqueue('test', {'n': 3})
+        enqueue('test', {'n': 4}, delay=60)
+
+        assert app.extensions['jobs'].drain() == 3
+        assert handlers == [2, 1, 3]
+        # Finished jobs are removed, the delayed one waits
+        assert [job['payload']['n'] for job in Job.get_collection().find_many({})] == [4]
+
+def test_failed_jobs_retry_with_backoff(app, db, handlers):
+    """Test failures are retried later until attempts run out"""
+    with app.app_context():
+        job = enqueue('test', {'fail': True}, max_attempts=2)
+        worker = JobWorker.from_config(app, backoff_base=30)
+
+        assert worker.run_once()
+        stored = Job.get_collection().find_one({'_id': job['_id']})
+        assert stored['status'] == 'queued'
+        assert stored['last_error'] == 'RuntimeError: boom'
+        # BSON dates come back naive
+        assert stored['run_at'].replace(tzinfo=UTC) > datetime.now(UTC) + timedelta(seconds=10)
+        assert not worker.run_once()
+
+        Job.get_collection().update_one({'_id': job['_id']}, {'$set': {'run_at': datetime.now(UTC)}})
+        assert worker.run_once()
+        assert Job.get_collection().find_one({'_id': job['_id']})['status'] == 'failed'
+
+        assert jobs.retry_failed('test') == 1
+        assert Job.get_collection().find_one({'_id': job['_id']})['attempts'] == 0
+
+def test_expired_lease_is_reclaimed(app, db, handlers):
+    """Test a job held by a dead worker is claimed again after its lease"""
+    with app.app_context():
+        job = enqueue('test', {'n': 1})
+        assert claim('dead-worker', lease_seconds=60)['_id'] == job['_id']
+        assert claim('other', lease_seconds=60) is None
+
+        Job.get_collection().update_one(
+            {'_id': job['_id']}, {'$set': {'lease_until': datetime.now(UTC) - timedelta(seconds=1)}}
+        )
+        # The dead worker can no longer finish or fail the job
+        assert app.extensions['jobs'].drain() == 1
+        assert handlers == [1]
+        assert not jobs.complete(job | {'attempts': 1}, 'dead-worker')
+
+def test_claims_are_exclusive(app, db, handlers):
+    """Test concurrent workers never run the same job twice"""
+    with app.app_context():
+        for n in range(50):
+            enqueue('test', {'n': n})
+    worker = JobWorker.from_config(app, threads=4, poll_interval=0.01)
+    worker.start()
+    try:
+        deadline = datetime.now(UTC) + timedelta(seconds=10)
+        while len(handlers) < 50 and datetime.now(UTC) < deadline:
+            threading.Event().wait(0.01)
+    finally:
+        worker.stop()
+    assert sorted(handlers) == list(range(50))
@@ -0,0 +1,130 @@
+import io
+
+import pytest
+from bson import ObjectId
+
+from api.core import keywords
+from api.core.keywords import extract_keywords, tokenize
+from api.core.models import Entry, Index, TermStats
+
+def _create_text(client, auth_headers, index_id, content, keywords=None):
+    response = client.post(
+        f'/api/indexes/{index_id}/entries',
+        json={'content': content, 'keywords': keywords or []},
+        headers=auth_headers
+    )
+    assert response.status_code == 201
+    return response.json['id']
+
+def test_tokenize():
+    """Test tokens are lowercased words without stopwords, numbers or short words"""
+    assert tokenize('The Quarterly budget, for 2024: an overview of the budget!') == [
+        'quarterly', 'budget', 'overview', 'budget'
+    ]
+
+def test_keywords_extracted_after_write(app, client, auth_headers, test_index):
+    """Test extracted keywords are merged into the client's keywords"""
+    entry_id = _create_text(client, auth_headers, test_index['_id'],
+                            'Migration plan: the database migration runs nightly. '
+                            'Every migration is logged.', keywords=['ops'])
+    app.extensions['jobs'].drain()
+
+    with app.app_context():
+        entry = Entry.get_collection().find_one({'_id': ObjectId(entry_id)})
+    assert entry['keywords'][0] == 'ops'
+    assert entry['extracted_keywords'][0] == 'migration'
+    assert set(entry['extracted_keywords']) <= set(entry['keywords'])
+
+    # Found through its keywords, without full text search
+    response = client.get(f'/api/indexes/{test_index["_id"]}/entries/search?q=Nightly',
+                          headers=auth_headers)
+    assert [e['id'] for e in response.json['entries']] == [entry_id]
+
+def test_terms_ranked_against_index(app, client, auth_headers, test_index):
+    """Test terms found in most entries of an index rank below rarer ones"""
+    app.config['KEYWORD_LIMIT'] = 1
+    for i in range(4):
+        _create_text(client, auth_headers, test_index['_id'], f'report report number {"abcd"[i]}')
+    entry_id = _create_text(client, auth_headers, test_index['_id'], 'report report invoice')
+    app.extensions['jobs'].drain()
+
+    with app.app_context():
+        entry = Entry.get_collection().find_one({'_id': ObjectId(entry_id)})
+        assert entry['extracted_keywords'] == ['invoice']
+        stats = TermStats.get_collection().find_one({'index_id': test_index['_id'], 'term': 'report'})
+        assert stats['df'] == 5
+        assert Index.get_collection().find_one({'_id': test_index['_id']})['analyzed_entries'] == 5
+
+    # Deleting the entry takes its terms back out of the statistics
+    client.delete(f'/api/indexes/{test_index["_id"]}/entries/{entry_id}', headers=auth_headers)
+    app.extensions['jobs'].drain()
+    with app.app_context():
+        stats = TermStats.get_collection().find_one({'index_id': test_index['_id'], 'term': 'report'})
+        assert stats['df'] == 4
+        assert TermStats.get_collection().find_one({'index_id': test_index['_id'], 'term': 'invoice'}) is None
+
+def test_failed_extraction_retried(app, client, auth_headers, test_index, monkeypatch):
+    """Test an extraction failing after its claim is counted and stored by the retry"""
+    entry_id = ObjectId(_create_text(client, auth_headers, test_index['_id'], 'Budget review of the budget'))
+    count_terms = keywords._count_terms
+    def fail(*args):
+        raise RuntimeError('Connection lost')
+
+    with app.app_context():
+        monkeypatch.setattr(keywords, '_count_terms', fail)
+        with pytest.raises(RuntimeError):
+            extract_keywords(entry_id, app.config)
+        monkeypatch.setattr(keywords, '_count_terms', count_terms)
+        monkeypatch.setattr(keywords, 'rank_terms', fail)
+        with pytest.raises(RuntimeError):
+            extract_keywords(entry_id, app.config)
+        monkeypatch.undo()
+
+        assert extract_keywords(entry_id, app.config)[0] == 'budget'
+        assert extract_keywords(entry_id, app.config) == []
+        stats = TermStats.get_collection().find_one({'index_id': test_index['_id'], 'term': 'budget'})
+        assert stats['df'] == 1
+
+def test_keywords_from_text_files(app, client, auth_headers, test_index):
+    """Test text files are read for keywords and other files are skipped"""
+    response = client.post(
+        f'/api/indexes/{test_index["_id"]}/entries',
+        data={'file': [(io.BytesIO(b'# Kubernetes\n\nKubernetes cluster setup'), 'notes.md'),
+                       (io.BytesIO(b'\x00\x01kubernetes'), 'blob.bin')]},
+        headers=auth_headers,
+        content_type='multipart/form-data'
+    )
+    assert response.status_code == 201
+    app.extensions['jobs'].drain()
+
+    with app.app_context():
+        notes, blob = (Entry.get_collection().find_one({'_id': ObjectId(result['entry']['id'])})
+                       for result in response.json['results'])
+    assert notes['extracted_keywords'][0] == 'kubernetes'
+    assert 'terms' not in blob
+
+def test_search_matches_keywords_and_content(app, client, auth_headers, test_index):
+    """Test search returns entries matching by keyword and entries whose keywords were never extracted"""
+    with app.app_context():
+        ids = []
+        for content, keywords in (('Summary of the year', ['report']), ('quarterly report draft', [])):
+            entry = Entry(index_id=test_index['_id'], user_id=test_index['user_id'], type='text',
+                          content=content, keywords=keywords).to_dict()
+            entry['_id'] = ObjectId()
+            Entry.get_collection().insert_one(entry)
+            ids.append(str(entry['_id']))
+
+    def search(query):
+        response = client.get(f'/api/indexes/{test_index["_id"]}/entries/search?q={query}', headers=auth_headers)
+        return {entry['id'] for entry in response.json['entries']}
+
+    assert search('report') == set(ids)
+    # Words of a query match independently, as in full text search
+    assert search('summary quarterly') == set(ids)
+
+    # Entries written before extraction ran are analyzed by the backfill
+    result = app.test_cli_runner().invoke(args=['indexes', 'extract-keywords', str(test_index['_id'])])
+    assert 'Queued keyword extraction for 2 entries' in result.output
+    app.extensions['jobs'].drain()
+    with app.app_context():
+        assert 'quarterly' in Entry.get_collection().find_one({'_id': ObjectId(ids[1])})['keywords']
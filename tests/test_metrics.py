@@ -0,0 +1,64 @@
+import os
+from types import SimpleNamespace
+
+from api.core.metrics import (
+    CommandMetricsListener,
+    Histogram,
+    MONGO_COMMAND_DURATION,
+    REGISTRY
+)
+
+# Label every series carries
+PID = f'pid="{os.getpid()}"'
+
+def test_histogram_rendering():
+    """Test histogram exposition is cumulative with sum and count"""
+    histogram = Histogram('test_latency_seconds', 'Test latency', ('route',), buckets=(0.1, 1.0))
+    REGISTRY.remove(histogram)
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, '/a')
+
+    lines = histogram.render()
+    assert '# TYPE test_latency_seconds histogram' in lines
+    assert f'test_latency_seconds_bucket{{{PID},route="/a",le="0.1"}} 1' in lines
+    assert f'test_latency_seconds_bucket{{{PID},route="/a",le="1.0"}} 3' in lines
+    assert f'test_latency_seconds_bucket{{{PID},route="/a",le="+Inf"}} 4' in lines
+    assert f'test_latency_seconds_sum{{{PID},route="/a"}} 6.05' in lines
+    assert f'test_latency_seconds_count{{{PID},route="/a"}} 4' in lines
+
+def test_metrics_endpoint(client, auth_headers, test_index):
+    """Test request metrics are exported per blueprint and route"""
+    client.get('/api/indexes/', headers=auth_headers)
+    client.get(f'/api/indexes/{test_index["_id"]}/entries', headers=auth_headers)
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert f'http_requests_total{{{PID},blueprint="indexes",route="/api/indexes/",method="GET",status="200"}}' in body
+    assert (f'http_request_duration_seconds_count{{{PID},blueprint="indexes.entries",'
+            'route="/api/indexes/<index_id>/entries",method="GET"}') in body
+    assert f'http_requests_in_flight{{{PID},blueprint="indexes",route="/api/indexes/"}} 0' in body
+    assert '# TYPE mongodb_command_duration_seconds histogram' in body
+    assert '# TYPE gridfs_bytes_written_total counter' in body
+    # The metrics endpoint is not rate limited
+    assert 'RateLimit-Limit' not in response.headers
+
+def test_command_listener():
+    """Test MongoDB command latencies are recorded per collection"""
+    listener = CommandMetricsListener()
+    started = SimpleNamespace(command_name='find', command={'find': 'metrics_test'},
+                              connection_id=('localhost', 27017), request_id=1)
+    succeeded = SimpleNamespace(command_name='find', duration_micros=1500,
+                                connection_id=('localhost', 27017), request_id=1)
+    listener.started(started)
+    listener.succeeded(succeeded)
+
+    # Commands without a collection are ignored
+    listener.started(SimpleNamespace(command_name='ping', command={'ping': 1},
+                                     connection_id=None, request_id=2))
+
+    lines = MONGO_COMMAND_DURATION.render()
+    assert (f'mongodb_command_duration_seconds_count{{{PID},collection="metrics_test",command="find"}} 1'
+            in lines)
+    assert not listener._pending
@@ -0,0 +1,177 @@
+import io
+
+import pytest
+from bson import ObjectId
+
+from api import create_app
+from api.core.database import DatabaseProvider, get_database, partition_context, tenant_context
+from api.core.database.memory import MemoryDatabase
+from api.core.database.partitioned import HashRing
+from api.core.invalidation import invalidate, user_tag
+from api.core.slowlog import SlowQueryLog
+from api.core.tenants import move_tenant
+
+PARTITIONS = {'p0': 'mongodb://p0/', 'p1': 'mongodb://p1/', 'p2': 'mongodb://p2/'}
+
+@pytest.fixture
+def partitioned_app():
+    """App with three in-memory partitions"""
+    app = create_app({
+        'TESTING': True,
+        'DATABASE_BACKEND': 'memory',
+        'DATABASE_BOOTSTRAP': 'sync',
+        'DATABASE_PARTITIONS': PARTITIONS,
+        'SECRET_KEY': 'test-secret-key',
+        'JWT_SECRET_KEY': 'test-jwt-secret-key',
+        'REGISTER_BLUEPRINTS': True,
+        'JOBS_WORKERS': 0,
+        'INVALIDATION_MODE': None,
+        'ENTRY_FEED_MODE': None
+    })
+    yield app
+    DatabaseProvider.reset()
+
+def _register(client, username):
+    response = client.post('/auth/register', json={'username': username, 'password': 'secret'})
+    assert response.status_code == 201
+    return ObjectId(response.json['user']['id']), {'Authorization': f"Bearer {response.json['access_token']}"}
+
+def _partition_count(name, collection, query):
+    with partition_context(name):
+        return get_database().get_collection(collection).count_documents(query)
+
+def test_hash_ring():
+    """Test keys spread over partitions and a new partition only takes keys over"""
+    keys = [str(ObjectId()) for _ in range(3000)]
+    ring = HashRing(['p0', 'p1', 'p2'])
+    owners = {key: ring.lookup(key) for key in keys}
+    for name in ('p0', 'p1', 'p2'):
+        assert 600 < list(owners.values()).count(name) < 1400
+
+    grown = HashRing(['p0', 'p1', 'p2', 'p3'])
+    moved = [key for key in keys if grown.lookup(key) != owners[key]]
+    assert all(grown.lookup(key) == 'p3' for key in moved)
+    assert len(moved) < 1400
+
+def test_tenant_data_in_its_partition(partitioned_app):
+    """Test each user's data and background jobs go to the user's partition"""
+    client = partitioned_app.test_client()
+    tenants = [_register(client, f'user{i}') for i in range(6)]
+    for user_id, headers in tenants:
+        response = client.post('/api/indexes/', json={'name': 'Notes'}, headers=headers)
+        index_id = response.json['id']
+        response = client.post(f'/api/indexes/{index_id}/entries',
+                               json={'content': 'Partition planning notes'}, headers=headers)
+        assert response.status_code == 201
+        assert len(client.get(f'/api/indexes/{index_id}/entries', headers=headers).json) == 1
+    partitioned_app.extensions['jobs'].drain()
+
+    with partitioned_app.app_context():
+        db = get_database()
+        assert db.directory.get_collection('users').count_documents({}) == 6
+        used = set()
+        for user_id, _ in tenants:
+            home = db.locate(user_id)
+            used.add(home)
+            for name in PARTITIONS:
+                expected = 1 if name == home else 0
+                assert _partition_count(name, 'indexes', {'user_id': user_id}) == expected
+                assert _partition_count(name, 'entries', {'user_id': user_id,
+                                                          'extracted_keywords': 'partition'}) == expected
+        assert len(used) > 1
+
+def test_move_tenant(partitioned_app):
+    """Test a tenant is moved with its files and keeps working"""
+    client = partitioned_app.test_client()
+    user_id, headers = _register(client, 'mover')
+    index_id = client.post('/api/indexes/', json={'name': 'Docs'}, headers=headers).json['id']
+    base = f'/api/indexes/{index_id}/entries'
+    client.post(base, json={'content': 'A note'}, headers=headers)
+    file_entry = client.post(base, data={'file': (io.BytesIO(b'x' * 1000), 'a.bin')}, headers=headers,
+                             content_type='multipart/form-data').json['id']
+
+    with partitioned_app.app_context():
+        db = get_database()
+        source = db.locate(user_id)
+        target = next(name for name in PARTITIONS if name != source)
+        counts = move_tenant(user_id, target, batch_size=1, chunk_size=256, settle_seconds=0)
+        assert (counts['indexes'], counts['entries'], counts['files']) == (1, 2, 1)
+        assert db.locate(user_id) == target
+        assert _partition_count(source, 'entries', {'user_id': user_id}) == 0
+        assert _partition_count(source, 'indexes', {'user_id': user_id}) == 0
+
+    assert len(client.get(base, headers=headers).json) == 2
+    response = client.get(f'{base}/{file_entry}', headers=headers)
+    assert response.status_code == 200
+    assert response.data == b'x' * 1000
+
+    # Writes are held back while a move is in progress
+    with partitioned_app.app_context():
+        get_database().directory.get_collection('tenant_partitions').update_one(
+            {'_id': user_id}, {'$set': {'state': 'moving', 'moving_to': source}}
+        )
+        invalidate(user_tag(user_id))
+    response = client.post(base, json={'content': 'Another note'}, headers=headers)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    assert client.get(base, headers=headers).status_code == 200
+
+def test_tenant_placement_cached(partitioned_app):
+    """Test requests reuse a tenant's cached partition until the user's tag is invalidated"""
+    client = partitioned_app.test_client()
+    user_id, headers = _register(client, 'cached')
+    index_id = client.post('/api/indexes/', json={'name': 'Docs'}, headers=headers).json['id']
+
+    with partitioned_app.app_context():
+        db = get_database()
+        other = next(name for name in PARTITIONS if name != db.locate(user_id))
+        db.directory.get_collection('tenant_partitions').insert_one(
+            {'_id': user_id, 'partition': other, 'state': 'active'}
+        )
+        assert client.get(f'/api/indexes/{index_id}', headers=headers).status_code == 200
+        invalidate(user_tag(user_id))
+        assert client.get(f'/api/indexes/{index_id}', headers=headers).status_code == 404
+
+def test_move_tenant_rolled_back(partitioned_app, monkeypatch):
+    """Test a failed move of a pinned tenant puts its entry back as it was"""
+    client = partitioned_app.test_client()
+    user_id, headers = _register(client, 'pinned')
+    index_id = client.post('/api/indexes/', json={'name': 'Docs'}, headers=headers).json['id']
+
+    with partitioned_app.app_context():
+        db = get_database()
+        source = db.locate(user_id)
+        target, other = [name for name in PARTITIONS if name != source]
+        move_tenant(user_id, target, settle_seconds=0)
+        pinned = db.directory.get_collection('tenant_partitions').find_one({'_id': user_id})
+
+        def fail(session):
+            raise RuntimeError('Interrupted')
+        monkeypatch.setattr('api.core.tenants.abort_session', fail)
+        response = client.post(f'/api/indexes/{index_id}/entries/uploads',
+                               json={'filename': 'a.bin', 'size': 10}, headers=headers)
+        assert response.status_code == 201
+        with pytest.raises(RuntimeError):
+            move_tenant(user_id, other, settle_seconds=0)
+        assert db.directory.get_collection('tenant_partitions').find_one({'_id': user_id}) == pinned
+        assert db.locate(user_id) == target
+
+def test_slow_query_explained_in_its_partition(partitioned_app, monkeypatch):
+    """Test sampled slow commands are explained in the partition they ran in"""
+    explained = []
+    def run_command(db, command):
+        explained.append(db)
+        return {}
+    monkeypatch.setattr(MemoryDatabase, 'run_command', run_command)
+    log = SlowQueryLog(path='/dev/null', explain_sample_rate=1.0)
+
+    with partitioned_app.app_context():
+        db = get_database()
+        with partition_context('p2'):
+            log.record(None, 'entries', 'find', {'find': 'entries', 'filter': {}}, 150.0)
+        log.record(None, 'users', 'find', {'find': 'users', 'filter': {}}, 150.0)
+        # A tenant whose partition was never looked up is not explained
+        with tenant_context(ObjectId()):
+            log.record(None, 'entries', 'find', {'find': 'entries', 'filter': {}}, 150.0)
+        log.flush()
+        assert explained == [db.partition('p2'), db.directory]
@@ -0,0 +1,76 @@
+import json
+import os
+
+from api.core.profiler import init_profiler, sign_profile_token, verify_profile_token
+
+def test_profile_token():
+    """Test profiling tokens are checked for signature and expiry"""
+    token = sign_profile_token('secret', ttl=60)
+    assert verify_profile_token('secret', token)
+    assert not verify_profile_token('other-secret', token)
+    assert not verify_profile_token(None, token)
+    assert not verify_profile_token('secret', token[:-1] + ('1' if token[-1] == '0' else '0'))
+    assert not verify_profile_token('secret', sign_profile_token('secret', ttl=-10))
+
+def test_profile_signed_request(app, client, auth_headers, test_index, tmp_path):
+    """Test requests with a signed header are profiled"""
+    app.config.update(PROFILER_ENABLED=True, PROFILER_SECRET='profile-secret',
+                      PROFILER_DIR=str(tmp_path))
+    init_profiler(app)
+    profiler = app.extensions['profiler']
+    
+    # Requests without the header are not profiled
+    client.get('/api/indexes/', headers=auth_headers)
+    profiler.flush()
+    assert not os.listdir(tmp_path)
+    
+    # Requests with a bad token are not profiled
+    client.get('/api/indexes/', headers={**auth_headers, 'X-Profile': '1.bad'})
+    profiler.flush()
+    assert not os.listdir(tmp_path)
+    
+    token = sign_profile_token('profile-secret')
+    response = client.get('/api/indexes/', headers={**auth_headers, 'X-Profile': token})
+    assert response.status_code == 200
+    profiler.flush()
+    
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) == 2
+    assert files[0].endswith('.json') and files[1].endswith('.prof')
+    with open(tmp_path / files[0]) as f:
+        meta = json.load(f)
+    assert meta['route'] == '/api/indexes/'
+    assert meta['user_id'] == str(test_index['user_id'])
+    assert meta['status'] == 200
+    assert 'db' in meta
+    assert 'cumulative' in meta['top_functions']
+
+def test_profile_budget(app, client, auth_headers, tmp_path):
+    """Test sampled profiles are capped per minute"""
+    app.config.update(PROFILER_ENABLED=True, PROFILER_SAMPLE_RATE=1.0,
+                      PROFILER_MAX_PER_MINUTE=2, PROFILER_DIR=str(tmp_path))
+    init_profiler(app)
+    
+    for _ in range(5):
+        client.get('/api/indexes/', headers=auth_headers)
+    app.extensions['profiler'].flush()
+    
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.json')]) == 2
+
+def test_profile_token_endpoint(app, client, auth_headers, test_user, tmp_path):
+    """Test admins can issue profiling tokens"""
+    app.config.update(PROFILER_ENABLED=True, PROFILER_SECRET='profile-secret',
+                      PROFILER_DIR=str(tmp_path), ADMIN_USERNAMES={test_user['username']})
+    init_profiler(app)
+    
+    response = client.post('/admin/profile-token', headers=auth_headers)
+    assert response.status_code == 200
+    assert verify_profile_token('profile-secret', response.json['token'])
+    
+    client.get('/api/indexes/', headers={**auth_headers, 'X-Profile': response.json['token']})
+    app.extensions['profiler'].flush()
+    
+    response = client.get('/admin/profiles', headers=auth_headers)
+    assert response.status_code == 200
+    assert len(response.json['profiles']) == 1
+    assert response.json['profiles'][0]['endpoint'] == 'indexes.get_indexes'
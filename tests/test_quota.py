@@ -0,0 +1,106 @@
+import io
+
+from api.core.models import User
+from api.core.quota import schedule_reconcile
+
+def _usage(client, auth_headers):
+    response = client.get('/auth/me', headers=auth_headers)
+    assert response.status_code == 200
+    return response.json['usage']
+
+def _upload(client, auth_headers, index_id, files):
+    return client.post(
+        f'/api/indexes/{index_id}/entries',
+        data={'file': [(io.BytesIO(data), name) for name, data in files]},
+        headers=auth_headers,
+        content_type='multipart/form-data'
+    )
+
+def test_usage_counted_on_create_and_delete(client, auth_headers, test_index):
+    """Test usage counters follow entries as they are created and deleted"""
+    base = f'/api/indexes/{test_index["_id"]}/entries'
+    client.post(base, json={'content': 'A note'}, headers=auth_headers)
+    response = _upload(client, auth_headers, test_index['_id'], [('a.txt', b'x' * 100)])
+    file_entry = response.json['id']
+    _upload(client, auth_headers, test_index['_id'], [('b.txt', b'x' * 10), ('c.txt', b'x' * 20)])
+    assert _usage(client, auth_headers) == {'bytes': 130, 'files': 3, 'entries': 4}
+
+    client.delete(f'{base}/{file_entry}', headers=auth_headers)
+    assert _usage(client, auth_headers) == {'bytes': 30, 'files': 2, 'entries': 3}
+
+def test_uploads_over_quota_rejected(app, client, auth_headers, test_index):
+    """Test writes that would exceed the quota get 413 and leave usage unchanged"""
+    app.config['QUOTA_BYTES'] = 1000
+    app.config['QUOTA_ENTRIES'] = 3
+    assert _upload(client, auth_headers, test_index['_id'], [('a.bin', b'x' * 600)]).status_code == 201
+    # Rejected on its declared length, before the body is read
+    response = _upload(client, auth_headers, test_index['_id'], [('b.bin', b'x' * 600)])
+    assert response.status_code == 413
+    assert _usage(client, auth_headers) == {'bytes': 600, 'files': 1, 'entries': 1}
+
+    response = client.post(f'/api/indexes/{test_index["_id"]}/entries/uploads',
+                           json={'filename': 'big.bin', 'size': 500}, headers=auth_headers)
+    assert response.status_code == 413
+    response = client.post(f'/api/indexes/{test_index["_id"]}/entries/uploads',
+                           json={'filename': 'small.bin', 'size': 300}, headers=auth_headers)
+    assert response.status_code == 201
+    # An open upload session holds its reservation until it is discarded
+    assert _usage(client, auth_headers) == {'bytes': 900, 'files': 2, 'entries': 2}
+    url = f'/api/indexes/{test_index["_id"]}/entries/uploads/{response.json["id"]}'
+    assert client.delete(url, headers=auth_headers).status_code == 204
+    assert _usage(client, auth_headers) == {'bytes': 600, 'files': 1, 'entries': 1}
+
+    response = _upload(client, auth_headers, test_index['_id'],
+                       [('c.txt', b'c'), ('d.txt', b'd'), ('e.txt', b'e')])
+    assert response.status_code == 413
+    assert _usage(client, auth_headers)['entries'] == 1
+
+def test_import_over_quota_rejected(app, client, auth_headers, test_index):
+    """Test imports are held to the entry quota, and uploads of unknown size are refused"""
+    base = f'/api/indexes/{test_index["_id"]}/entries'
+    for i in range(3):
+        client.post(base, json={'content': f'Note {i}'}, headers=auth_headers)
+    exported = client.get(f'/api/indexes/{test_index["_id"]}/export', headers=auth_headers).data
+
+    app.config['QUOTA_ENTRIES'] = 5
+    response = client.post('/api/indexes/import?name=Copy', data=exported, headers=auth_headers,
+                           content_type='application/x-tar')
+    assert response.status_code == 413
+    assert _usage(client, auth_headers)['entries'] == 3
+
+    # A chunked body has no Content-Length to reserve against
+    chunked = {**auth_headers, 'Transfer-Encoding': 'chunked'}
+    response = client.post('/api/indexes/import?name=Other', data=exported, headers=chunked,
+                           content_type='application/x-tar')
+    assert response.status_code == 411
+    response = client.post(base, data={'file': (io.BytesIO(b'x'), 'a.bin')}, headers=chunked,
+                           content_type='multipart/form-data')
+    assert response.status_code == 411
+    assert _usage(client, auth_headers) == {'bytes': 0, 'files': 0, 'entries': 3}
+
+def test_import_command_over_quota_rejected(app, client, auth_headers, test_index, test_user, tmp_path):
+    """Test command line imports are held to the entry quota too"""
+    base = f'/api/indexes/{test_index["_id"]}/entries'
+    for i in range(3):
+        client.post(base, json={'content': f'Note {i}'}, headers=auth_headers)
+    path = tmp_path / 'export.tar'
+    path.write_bytes(client.get(f'/api/indexes/{test_index["_id"]}/export', headers=auth_headers).data)
+
+    app.config['QUOTA_ENTRIES'] = 5
+    result = app.test_cli_runner().invoke(args=['indexes', 'import', str(path), '--user', test_user['username'],
+                                                  '--name', 'Copy'])
+    assert result.exit_code != 0
+    assert 'quota' in result.output.lower()
+    assert _usage(client, auth_headers)['entries'] == 3
+
+def test_reconcile_repairs_drift(app, client, auth_headers, test_index, test_user):
+    """Test the reconciliation job recomputes usage from stored entries"""
+    _upload(client, auth_headers, test_index['_id'], [('a.txt', b'x' * 100)])
+    client.post(f'/api/indexes/{test_index["_id"]}/entries', json={'content': 'Note'},
+                headers=auth_headers)
+    with app.app_context():
+        User.get_collection().update_one({'_id': test_user['_id']},
+                                         {'$set': {'usage': {'bytes': 7, 'files': 9, 'entries': 0}}})
+        schedule_reconcile(test_user['_id'])
+    app.extensions['jobs'].drain()
+    assert _usage(client, auth_headers) == {'bytes': 100, 'files': 1, 'entries': 2}
@@ -0,0 +1,99 @@
+import io
+import pytest
+
+from api.core.ratelimit import MemoryBucketStore, SharedMemoryBucketStore
+
+@pytest.mark.parametrize('store_class', [MemoryBucketStore, SharedMemoryBucketStore])
+def test_bucket_refill(store_class):
+    """Test token bucket consumption and refill"""
+    store = store_class(64)
+
+    # Burst of 3 is allowed, the fourth request is not
+    for _ in range(3):
+        allowed, _ = store.consume('read:user', 1, 3, 1.0, now=100.0)
+        assert allowed
+    allowed, tokens = store.consume('read:user', 1, 3, 1.0, now=100.0)
+    assert not allowed
+    assert tokens == 0
+
+    # Other keys have their own bucket
+    allowed, _ = store.consume('read:other', 1, 3, 1.0, now=100.0)
+    assert allowed
+
+    # Tokens come back at the refill rate
+    allowed, tokens = store.consume('read:user', 1, 3, 1.0, now=102.0)
+    assert allowed
+    assert tokens == 1
+
+def test_memory_store_evicts_least_recently_used():
+    """Test a full store drops its idle buckets rather than every bucket"""
+    store = MemoryBucketStore(2)
+    store.consume('read:busy', 3, 3, 1.0, now=100.0)
+    store.consume('read:idle', 1, 3, 1.0, now=100.0)
+    store.consume('read:busy', 0, 3, 1.0, now=100.0)
+    store.consume('read:new', 1, 3, 1.0, now=100.0)
+
+    # The busy bucket is still empty, the idle one starts over
+    allowed, _ = store.consume('read:busy', 1, 3, 1.0, now=100.0)
+    assert not allowed
+    _, tokens = store.consume('read:idle', 1, 3, 1.0, now=100.0)
+    assert tokens == 2
+
+def test_rate_limit_headers(client, auth_headers, test_index):
+    """Test rate limit headers on regular responses"""
+    response = client.get('/api/indexes/', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.headers['RateLimit-Limit'] == '120'
+    assert response.headers['RateLimit-Remaining'] == '119'
+    assert 'RateLimit-Reset' in response.headers
+
+def test_rate_limit_exceeded(app, client, auth_headers, test_index):
+    """Test requests beyond the burst are rejected"""
+    app.config['RATELIMIT_LIMITS']['search'] = (2, 0.5)
+    url = f'/api/indexes/{test_index["_id"]}/entries/search?q=test'
+
+    for _ in range(2):
+        assert client.get(url, headers=auth_headers).status_code != 429
+
+    response = client.get(url, headers=auth_headers)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '2'
+    assert response.headers['RateLimit-Remaining'] == '0'
+
+    # Reads are limited separately
+    response = client.get(f'/api/indexes/{test_index["_id"]}', headers=auth_headers)
+    assert response.status_code == 200
+
+def test_upload_charged_by_size(app, client, auth_headers, test_index):
+    """Test uploads are charged by size, and one larger than the budget takes all of it"""
+    app.config['RATELIMIT_LIMITS']['upload'] = (1024, 1024.0)
+
+    def upload(size):
+        return client.post(
+            f'/api/indexes/{test_index["_id"]}/entries',
+            data={'file': (io.BytesIO(b'x' * size), 'big.txt')},
+            headers=auth_headers,
+            content_type='multipart/form-data'
+        )
+
+    response = upload(4096)
+    assert response.status_code == 201
+    assert response.headers['RateLimit-Remaining'] == '0'
+
+    response = upload(100)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+
+def test_raw_uploads_charged_by_size(app, client, auth_headers, test_index):
+    """Test imports and upload chunks are charged to the upload bucket by size"""
+    app.config['RATELIMIT_LIMITS']['upload'] = (1024, 1.0)
+    exported = client.get(f'/api/indexes/{test_index["_id"]}/export', headers=auth_headers).data
+    assert len(exported) > 1024
+
+    response = client.post(f'/api/indexes/{test_index["_id"]}/import', data=exported, headers=auth_headers,
+                           content_type='application/x-tar')
+    assert response.status_code == 200
+    assert response.headers['RateLimit-Remaining'] == '0'
+    response = client.put(f'/api/indexes/{test_index["_id"]}/entries/uploads/{"0" * 24}/chunks/0',
+                          data=b'x' * 10, headers=auth_headers)
+    assert response.status_code == 429
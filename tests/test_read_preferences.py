@@ -0,0 +1,51 @@
+from pymongo.read_preferences import SecondaryPreferred
+
+from api.core import read_preferences
+from api.core.database import set_read_preference
+from api.core.database.mongodb import MongoDB
+from api.core.read_preferences import PrimaryPins
+
+def test_primary_pins():
+    """Test pins expire and are kept per caller"""
+    pins = PrimaryPins(64)
+    pins.pin('user:a', until=105.0)
+    assert pins.is_pinned('user:a', now=104.0)
+    assert not pins.is_pinned('user:a', now=106.0)
+    assert not pins.is_pinned('user:b', now=104.0)
+
+def test_collections_follow_read_preference():
+    """Test collections and file storage read with the context's read preference"""
+    db = MongoDB('mongodb://localhost:27017/', 'cloud_storage_test')
+    db.connect()
+    try:
+        set_read_preference('secondaryPreferred', 120)
+        assert db.get_collection('entries').collection.read_preference == SecondaryPreferred(max_staleness=120)
+        assert db.file_storage().database.read_preference == SecondaryPreferred(max_staleness=120)
+        set_read_preference(None)
+        assert db.get_collection('entries').collection.read_preference.mode == 0
+        assert db.file_storage() is db._file_storage
+    finally:
+        set_read_preference(None)
+        db.disconnect()
+
+def test_reads_routed_until_caller_writes(app, client, auth_headers, test_index, monkeypatch):
+    """Test reads go to secondaries except right after the caller's own writes"""
+    app.config['READ_PREFERENCES'] = {'read': 'secondaryPreferred'}
+    modes = []
+    monkeypatch.setattr(read_preferences, 'set_read_preference',
+                        lambda mode, max_staleness=None: modes.append(mode))
+    entries = f'/api/indexes/{test_index["_id"]}/entries'
+
+    client.get(entries, headers=auth_headers)
+    client.get(f'{entries}/search?q=note', headers=auth_headers)
+    assert modes == ['secondaryPreferred', None, None, None]
+
+    modes.clear()
+    client.post(entries, json={'content': 'A note'}, headers=auth_headers)
+    client.get(entries, headers=auth_headers)
+    assert modes == [None, None, None, None]
+
+    # Other callers are not pinned
+    modes.clear()
+    client.get(entries)
+    assert modes[0] == 'secondaryPreferred'
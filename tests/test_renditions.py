@@ -0,0 +1,99 @@
+import io
+import time
+from datetime import datetime, timedelta, UTC
+
+import pytest
+from bson import ObjectId
+
+from api.core.database import get_file_storage
+from api.core.models import Entry
+
+Image = pytest.importorskip('PIL.Image')
+
+def _image(size=(1000, 600), mode='RGB', image_format='JPEG'):
+    output = io.BytesIO()
+    Image.new(mode, size, 'red').save(output, image_format)
+    return output.getvalue()
+
+def _upload(client, auth_headers, index_id, data, filename):
+    response = client.post(
+        f'/api/indexes/{index_id}/entries',
+        data={'file': (io.BytesIO(data), filename)},
+        headers=auth_headers,
+        content_type='multipart/form-data'
+    )
+    assert response.status_code == 201
+    return response.json['id']
+
+def test_renditions_generated_after_upload(app, client, auth_headers, test_index):
+    """Test renditions are generated in the background and cached by clients"""
+    entry_id = _upload(client, auth_headers, test_index['_id'], _image(), 'photo.jpg')
+    app.extensions['jobs'].drain()
+
+    with app.app_context():
+        entry = Entry.get_collection().find_one({'_id': ObjectId(entry_id)})
+    assert set(entry['renditions']) == {'thumb', 'small', 'medium'}
+    assert (entry['renditions']['medium']['width'], entry['renditions']['medium']['height']) == (800, 480)
+
+    url = f'/api/indexes/{test_index["_id"]}/entries/{entry_id}'
+    response = client.get(f'{url}?rendition=thumb', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert max(Image.open(io.BytesIO(response.data)).size) == 128
+
+    etag = response.headers['ETag']
+    response = client.get(f'{url}?rendition=thumb', headers={**auth_headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+
+    # The original is untouched and the renditions go with the entry
+    assert client.get(url, headers=auth_headers).data == _image()
+    assert client.delete(url, headers=auth_headers).status_code == 204
+    with app.app_context():
+        with pytest.raises(FileNotFoundError):
+            get_file_storage().get_file(str(entry['renditions']['thumb']['file_id']))
+
+def test_rendition_generated_on_demand(app, client, auth_headers, test_index):
+    """Test a missing rendition is generated when requested, keeping transparency"""
+    with app.app_context():
+        file_id = get_file_storage().store_file(_image((200, 100), 'RGBA', 'PNG'),
+                                                filename='logo.png', content_type='image/png')
+        entry = Entry.create(index_id=ObjectId(test_index['_id']), user_id=ObjectId(test_index['user_id']),
+                             type='file', file_id=ObjectId(file_id),
+                             metadata={'filename': 'logo.png', 'content_type': 'image/png'})
+
+    url = f'/api/indexes/{test_index["_id"]}/entries/{entry["_id"]}'
+    response = client.get(f'{url}?rendition=thumb', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert Image.open(io.BytesIO(response.data)).size == (128, 64)
+
+def test_rendition_leased_by_another_process(app, client, auth_headers, test_index):
+    """Test an entry another process is rendering is waited for, and taken over once its lease ends"""
+    entry_id = ObjectId(_upload(client, auth_headers, test_index['_id'], _image(), 'photo.jpg'))
+    with app.app_context():
+        until = datetime.now(UTC) + timedelta(seconds=0.3)
+        Entry.get_collection().update_one({'_id': entry_id}, {'$set': {'rendering_until': until}})
+        started = time.monotonic()
+        renditions = app.extensions['renditions'].generate(entry_id)
+        assert time.monotonic() - started >= 0.2
+        assert set(renditions) == {'thumb', 'small', 'medium'}
+        assert 'rendering_until' not in Entry.get_collection().find_one({'_id': entry_id})
+
+        # The queued job finds the renditions in place
+        app.extensions['jobs'].drain()
+        assert Entry.get_collection().find_one({'_id': entry_id})['renditions'] == renditions
+
+def test_rendition_errors(client, auth_headers, test_index):
+    """Test unknown renditions and non-image entries are rejected"""
+    entry_id = _upload(client, auth_headers, test_index['_id'], _image(), 'photo.jpg')
+    url = f'/api/indexes/{test_index["_id"]}/entries/{entry_id}'
+    assert client.get(f'{url}?rendition=huge', headers=auth_headers).status_code == 400
+
+    response = client.post(
+        f'/api/indexes/{test_index["_id"]}/entries',
+        json={'content': 'Not an image'},
+        headers=auth_headers
+    )
+    url = f'/api/indexes/{test_index["_id"]}/entries/{response.json["id"]}'
+    assert client.get(f'{url}?rendition=thumb', headers=auth_headers).status_code == 400
@@ -0,0 +1,82 @@
+import json
+from types import SimpleNamespace
+
+from api.core.slowlog import SlowQueryListener, SlowQueryLog, command_shape, plan_summary
+
+def _command_events(request_id, duration_micros, command, reply):
+    """Build fake started/succeeded command events"""
+    started = SimpleNamespace(command_name=next(iter(command)), command=command,
+                              database_name='cloud_storage_test',
+                              connection_id=('localhost', 27017), request_id=request_id)
+    succeeded = SimpleNamespace(command_name=next(iter(command)), duration_micros=duration_micros,
+                                reply=reply, connection_id=('localhost', 27017),
+                                request_id=request_id)
+    return started, succeeded
+
+def test_command_shape():
+    """Test literal values are stripped from query shapes"""
+    shape = json.loads(command_shape('find', {
+        'find': 'entries',
+        'filter': {'index_id': 'abc', 'keywords': {'$in': ['a', 'b', 'c']},
+                   '$text': {'$search': 'meeting'}},
+        'sort': {'created_at': -1},
+        'limit': 10
+    }))
+    assert shape == {
+        'filter': {'index_id': '?', 'keywords': {'$in': ['?']}, '$text': {'$search': '?'}},
+        'sort': {'created_at': -1}
+    }
+
+def test_plan_summary():
+    """Test winning plans are summarized as a chain of stages"""
+    plan = {'stage': 'LIMIT', 'inputStage': {
+        'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'index_id_1_created_at_-1'}
+    }}
+    assert plan_summary(plan) == 'LIMIT > FETCH > IXSCAN(index_id_1_created_at_-1)'
+
+def test_slow_commands_logged(tmp_path):
+    """Test only commands over the threshold are logged and grouped by shape"""
+    log = SlowQueryLog(path=str(tmp_path / 'slow.log'))
+    listener = SlowQueryListener(log, threshold_ms=10)
+
+    for request_id, (duration, index_id) in enumerate([(50000, 'a'), (20000, 'b'), (1000, 'c')]):
+        started, succeeded = _command_events(
+            request_id, duration,
+            {'find': 'entries', 'filter': {'index_id': index_id}},
+            {'cursor': {'firstBatch': [{}, {}]}, 'ok': 1}
+        )
+        listener.started(started)
+        listener.succeeded(succeeded)
+    started, succeeded = _command_events(
+        99, 30000, {'insert': 'entries', 'documents': [{}]}, {'n': 1, 'ok': 1}
+    )
+    listener.started(started)
+    listener.succeeded(succeeded)
+    log.flush()
+
+    assert len(log.entries()) == 3
+    shapes = log.top_shapes()
+    assert shapes[0]['command'] == 'find'
+    assert shapes[0]['shape'] == {'filter': {'index_id': '?'}}
+    assert shapes[0]['count'] == 2
+    assert shapes[0]['total_ms'] == 70.0
+    assert shapes[0]['docs_returned'] == 4
+    assert shapes[1]['command'] == 'insert'
+
+def test_slow_queries_endpoint(app, client, auth_headers, test_user, tmp_path):
+    """Test the admin endpoint lists top query shapes"""
+    log = SlowQueryLog(path=str(tmp_path / 'slow.log'))
+    log.record('cloud_storage_test', 'entries', 'find', {'find': 'entries', 'filter': {'x': 1}}, 150.0)
+    log.flush()
+    app.extensions['slow_query_log'] = log
+
+    # Only admins may list slow queries
+    response = client.get('/admin/slow-queries', headers=auth_headers)
+    assert response.status_code == 403
+
+    app.config['ADMIN_USERNAMES'] = {test_user['username']}
+    response = client.get('/admin/slow-queries', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json['enabled']
+    assert response.json['shapes'][0]['collection'] == 'entries'
+    assert response.json['shapes'][0]['total_ms'] == 150.0
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, UTC
+
+import pytest
+from bson import ObjectId
+
+from api.core.database import get_database, get_file_storage
+from api.core.errors import ValidationError
+from api.core.uploads import abort_session, expire_sessions, write_chunk
+
+def _start(client, auth_headers, index_id, size, chunk_size=4):
+    response = client.post(
+        f'/api/indexes/{index_id}/entries/uploads',
+        json={'filename': 'big.bin', 'size': size, 'chunk_size': chunk_size,
+              'content_type': 'application/octet-stream', 'keywords': ['big']},
+        headers=auth_headers
+    )
+    assert response.status_code == 201
+    return response.json
+
+def test_chunked_upload(client, auth_headers, test_index):
+    """Test chunks uploaded out of order are committed as one file entry"""
+    data = b'0123456789'
+    session = _start(client, auth_headers, test_index['_id'], len(data))
+    assert session['chunk_count'] == 3
+    url = f'/api/indexes/{test_index["_id"]}/entries/uploads/{session["id"]}'
+
+    assert client.put(f'{url}/chunks/2', data=data[8:], headers=auth_headers).status_code == 204
+    assert client.put(f'{url}/chunks/0', data=data[:4], headers=auth_headers).status_code == 204
+    # Re-sending a chunk is allowed, a wrong size is not
+    assert client.put(f'{url}/chunks/0', data=data[:4], headers=auth_headers).status_code == 204
+    assert client.put(f'{url}/chunks/1', data=b'xx', headers=auth_headers).status_code == 400
+    assert client.put(f'{url}/chunks/3', data=b'xx', headers=auth_headers).status_code == 400
+
+    status = client.get(url, headers=auth_headers).json
+    assert status['received'] == [0, 2]
+    assert status['missing'] == 1
+    assert client.post(f'{url}/commit', headers=auth_headers).status_code == 400
+
+    assert client.put(f'{url}/chunks/1', data=data[4:8], headers=auth_headers).status_code == 204
+    response = client.post(f'{url}/commit', headers=auth_headers)
+    assert response.status_code == 201
+    assert response.json['type'] == 'file'
+    assert response.json['keywords'] == ['big']
+
+    response = client.get(f'/api/indexes/{test_index["_id"]}/entries/{response.json["id"]}',
+                          headers=auth_headers)
+    assert response.data == data
+    # The session is gone once committed
+    assert client.get(url, headers=auth_headers).status_code == 404
+
+def test_abort_and_expire_uploads(app, client, auth_headers, test_index):
+    """Test aborted and expired sessions are removed with their chunks"""
+    session = _start(client, auth_headers, test_index['_id'], 8)
+    url = f'/api/indexes/{test_index["_id"]}/entries/uploads/{session["id"]}'
+    client.put(f'{url}/chunks/0', data=b'abcd', headers=auth_headers)
+    with app.app_context():
+        # A session another request is committing cannot be aborted under it
+        sessions = get_database().get_collection('upload_sessions')
+        sessions.update_one({'_id': ObjectId(session['id'])}, {'$set': {'status': 'committing'}})
+        assert client.delete(url, headers=auth_headers).status_code == 400
+        sessions.update_one({'_id': ObjectId(session['id'])}, {'$set': {'status': 'open'}})
+    assert client.delete(url, headers=auth_headers).status_code == 204
+    assert client.get(url, headers=auth_headers).status_code == 404
+
+    session = _start(client, auth_headers, test_index['_id'], 8)
+    url = f'/api/indexes/{test_index["_id"]}/entries/uploads/{session["id"]}'
+    client.put(f'{url}/chunks/0', data=b'abcd', headers=auth_headers)
+    with app.app_context():
+        stored = get_database().get_collection('upload_sessions').find_one({'_id': ObjectId(session['id'])})
+        assert expire_sessions() == 0
+        assert expire_sessions(now=datetime.now(UTC) + timedelta(days=2)) == 1
+        assert get_file_storage().delete_chunks(str(stored['file_id'])) == 0
+    assert client.get(url, headers=auth_headers).status_code == 404
+
+def test_chunk_written_after_abort(app, client, auth_headers, test_index):
+    """Test a chunk racing an abort is deleted, and chunks need a Content-Length"""
+    session = _start(client, auth_headers, test_index['_id'], 8)
+    url = f'/api/indexes/{test_index["_id"]}/entries/uploads/{session["id"]}'
+    response = client.put(f'{url}/chunks/0', data=b'abcd',
+                          headers={**auth_headers, 'Transfer-Encoding': 'chunked'})
+    assert response.status_code == 411
+
+    with app.app_context():
+        # The writer read the session just before the abort
+        stale = get_database().get_collection('upload_sessions').find_one({'_id': ObjectId(session['id'])})
+        abort_session(stale)
+        with pytest.raises(ValidationError):
+            write_chunk(stale, 0, b'abcd', 60)
+        assert get_file_storage().delete_chunks(str(stale['file_id'])) == 0